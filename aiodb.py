@@ -0,0 +1,73 @@
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+# Async access to the SQLite pool, for the asyncio serving mode (asgi.py).
+#
+# sqlite3 has no async API, so every call runs on a small, fixed set of threads
+# (ASYNC_DB_THREADS, by default one per pooled connection). Coroutines waiting for the
+# database are just queued futures - thousands of them cost no threads at all.
+#
+#   rows, next_cursor = await get_async_db().run(models.get_gallery_page, limit=24)
+#
+# run(fn, ...) borrows a connection, calls fn(conn, ...) and hands the connection back.
+# call(fn, ...) runs fn(...) on the same threads without a connection - for the other work that
+# blocks: session and cache backends, rendering, after_request hooks.
+# The caller's context (the Flask app and request) goes with it to the thread, so fn may
+# use current_app, session and render_template as it would in a normal view.
+
+
+class AsyncDatabase:
+    def __init__(self, app):
+        self.app = app
+        self.threads = app.config['ASYNC_DB_THREADS']
+        self._executor = None
+
+    def _get_executor(self):
+        # Created on first use, so a pre-fork parent never owns the threads
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='aiodb')
+        return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self._call, fn, args, kwargs)
+        return await loop.run_in_executor(self._get_executor(), contextvars.copy_context().run, call)
+
+    async def call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(fn, *args, **kwargs)
+        return await loop.run_in_executor(self._get_executor(), contextvars.copy_context().run, call)
+
+    def _call(self, fn, args, kwargs):
+        pool = self.app.extensions['db_pool']
+        conn = pool.acquire()
+        try:
+            return fn(conn, *args, **kwargs)
+        finally:
+            pool.release(conn)
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+def init_app(app):
+    app.config.setdefault('ASYNC_DB_THREADS', app.config['DB_POOL_SIZE'])
+    app.extensions['async_db'] = AsyncDatabase(app)
+    logging.info(f"Async database layer ready ({app.config['ASYNC_DB_THREADS']} threads)")
+
+
+def get_async_db():
+    return current_app.extensions['async_db']
@@ -1,99 +1,241 @@
-from flask import Flask, render_template, url_for, request, redirect, session, flash, jsonify
+from flask import Flask, render_template, url_for, request, redirect, session, flash, jsonify, abort, current_app
+from flask.cli import with_appcontext
 import sqlite3
-import secrets
 import logging
+import click
+import math
+import time
 
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import os
 import uuid
 
-# Setup flask to run
-app = Flask(__name__) # Create a Flask application instance
-app.secret_key = secrets.token_hex(32)  # Generates a random 32-character key
-app.config['UPLOAD_FOLDER'] = 'uploads' # Name of the upload folder
-app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'} # Uploaded file types
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 # 16 MB limit
+import db
+import cache
+import assets
+import likes
+import images
+import models
+import search
+import featured
+import leaderboard
+import layout
+import compression
+import events
+import signals
+import passwords
+import ratelimit
+import sessions
+import metrics
+import uploads
+import migrations
+import archive
+from db import get_db
+
+# Views are collected by @route and added to each app made by create_app()
+routes = []
+
+
+def route(rule, **options):
+    def register(view):
+        routes.append((rule, options, view))
+        return view
+    return register
+
+
+# Wipe the database and rebuild it from the migrations (development only - deletes everything!)
+def init_db():
+    conn = get_db()
+    conn.executescript('''
+        DROP TABLE IF EXISTS ArtworkSearch;
+        DROP TABLE IF EXISTS CommentSearch;
+        DROP TABLE IF EXISTS Sessions;
+        DROP TABLE IF EXISTS ArchiveImports;
+        DROP TABLE IF EXISTS ArtistStats;
+        DROP TABLE IF EXISTS LeaderboardScores;
+        DROP TABLE IF EXISTS LeaderboardState;
+        DROP TABLE IF EXISTS LikeRemovals;
+        DROP TABLE IF EXISTS Likes;
+        DROP TABLE IF EXISTS Comments;
+        DROP TABLE IF EXISTS Artworks;
+        DROP TABLE IF EXISTS Users;
+        PRAGMA user_version = 0;
+    ''')
+    migrations.migrate(conn)
+    print("Database initialized.")
 
-logging.basicConfig(level=logging.INFO) # Show errors in the console
 
-# Function to return the database connection object 
-def get_db_connection():
-    print("Attempting to connect to the database...")  # Add this line
-    conn = sqlite3.connect('database.db', check_same_thread=False)
-    conn.row_factory = sqlite3.Row # This allows us to access columns by name
-    return conn
+# Bring an existing database up to the latest schema without losing data
+def migrate_db():
+    conn = get_db()
+    applied = migrations.migrate(conn)
+    print(f"Database at schema version {migrations.schema_version(conn)} (applied: {applied or 'nothing'}).")
 
-# Function to return true if file extention is in the list - only allows image files
-def allowed_file(filename): # Check if the file is allowed
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'} # Set of allowed file extensions
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS # Check if the file extension is in the allowed list
 
+# flask --app app init-db
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    init_db()
 
 
+# flask --app app migrate
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    migrate_db()
 
-def init_db():
-    conn = get_db_connection()
-    conn.execute('PRAGMA foreign_keys = ON')
-    conn.executescript('''
-        DROP TABLE IF EXISTS Comments;
-        DROP TABLE IF EXISTS Artworks;
-        DROP TABLE IF EXISTS Users;
-        DROP TABLE IF EXISTS Likes;
 
-        CREATE TABLE Users (
-            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL UNIQUE,
-            email TEXT NOT NULL UNIQUE,
-            password TEXT NOT NULL,
-            first_name TEXT NOT NULL,
-            surname TEXT NOT NULL                                  
-        );
-
-        CREATE TABLE Artworks (
-            artwork_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            title TEXT NOT NULL,
-            description TEXT,
-            submission_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            image_path TEXT,
-            pending INTEGER DEFAULT 1,
-            FOREIGN KEY (user_id) REFERENCES Users(user_id)
-        );
-
-        CREATE TABLE Comments (
-            comment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            artwork_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            comment TEXT NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (artwork_id) REFERENCES Artworks(artwork_id),
-            FOREIGN KEY (user_id) REFERENCES Users(user_id)
-        );
-                       
-        CREATE TABLE Likes (
-            like_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            artwork_id INTEGER NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES Users(user_id),
-            FOREIGN KEY (artwork_id) REFERENCES Artworks(artwork_id),
-            UNIQUE (user_id, artwork_id)
-        );
-    ''')
+# flask --app app check-plans - exits with an error if a hot query would scan a whole table
+@click.command('check-plans')
+@with_appcontext
+def check_plans_command():
+    problems = migrations.check_query_plans(get_db())
+    for name, details in problems.items():
+        print(f"{name}: {'; '.join(details)}")
+    if problems:
+        raise SystemExit(1)
+    print(f"All {len(migrations.HOT_QUERIES)} hot queries use an index.")
+
+
+# flask --app app reconcile-likes - rebuild every like_count from the Likes table
+@click.command('reconcile-likes')
+@with_appcontext
+def reconcile_likes_command():
+    fixed = likes.get_service().reconcile()
+    print(f"Corrected like_count on {fixed} artworks.")
+
 
+# flask --app app make-admin <username> - lets a judge use the moderation page
+@click.command('make-admin')
+@with_appcontext
+@click.argument('username')
+def make_admin_command(username):
+    conn = get_db()
+    updated = conn.execute("UPDATE Users SET user_type = 'admin' WHERE username = ?", (username,)).rowcount
     conn.commit()
-    conn.close()
-    print("Database initialized.")
+    print(f"{username} is now an admin." if updated else f"No user called {username}.")
+
+# flask --app app rotate-keys - sign new sessions with a fresh key; the old ones stay valid for now
+@click.command('rotate-keys')
+@with_appcontext
+def rotate_keys_command():
+    keys = current_app.extensions['sessions']['key_ring'].rotate()
+    print(f"New signing key added; {len(keys)} keys in the ring. Running workers pick it up within seconds.")
+
+
+# flask --app app gc-uploads - delete upload files no artwork refers to (the workers also do this hourly)
+@click.command('gc-uploads')
+@with_appcontext
+@click.option('--dry-run', is_flag=True, help='Only report what would be deleted.')
+@click.option('--grace', type=float, help='Keep files younger than this many seconds (default UPLOAD_GC_GRACE).')
+def gc_uploads_command(dry_run, grace):
+    files, size = uploads.get_collector().collect(dry_run=dry_run, grace=grace)
+    verb = 'Would remove' if dry_run else 'Removed'
+    print(f"{verb} {files} orphaned files ({size / 1024 / 1024:.1f} MB).")
+
+
+# flask --app app compile-templates - fill the bytecode cache (TEMPLATE_CACHE_DIR) at build time
+@click.command('compile-templates')
+@with_appcontext
+def compile_templates_command():
+    started = time.perf_counter()
+    count = layout.compile_templates(current_app)
+    print(f"Compiled {count} templates into {current_app.config['TEMPLATE_CACHE_DIR']} "
+          f"in {(time.perf_counter() - started) * 1000:.0f} ms.")
+
+# flask --app app compress-assets - write .br/.gz siblings of style.css and the other static text files
+@click.command('compress-assets')
+@with_appcontext
+def compress_assets_command():
+    count = compression.precompress_static(current_app)
+    print(f"Wrote {count} precompressed files ({', '.join(compression.available_encodings())}).")
+
+# flask --app app import-archive PATH - bulk-load a directory of images or a CSV/JSONL manifest.
+# Safe to run again after an interruption: entries already imported are skipped.
+@click.command('import-archive')
+@with_appcontext
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--artist', default='archive', help='Artist for images not in a per-artist folder or manifest row.')
+@click.option('--link', is_flag=True, help='Hard-link images into the upload folder instead of copying them.')
+@click.option('--pending', is_flag=True, help='Send everything to the moderation queue instead of approving it.')
+@click.option('--batch-size', default=1000, show_default=True, help='Artworks inserted per transaction.')
+@click.option('--workers', type=int, help='Image processing processes (default: one per CPU).')
+def import_archive_command(source, artist, link, pending, batch_size, workers):
+    try:
+        stats = archive.import_archive(get_db(), current_app, source, default_artist=artist, link=link,
+                                       approve=not pending, batch_size=batch_size, workers=workers, echo=click.echo)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    current_app.extensions['fragment_cache'].bump('gallery')
+    print(f"Done: {stats}. Running workers show the new artworks as their caches expire.")
+
+
+# flask --app app export-archive OUTPUT.tar[.gz] - dump the database and images ('-' for stdout)
+@click.command('export-archive')
+@with_appcontext
+@click.argument('output')
+@click.option('--no-media', is_flag=True, help='Only the JSONL files, without the images.')
+@click.option('--passwords', is_flag=True, help='Include password hashes in users.jsonl.')
+def export_archive_command(output, no_media, passwords):
+    echo = (lambda message: click.echo(message, err=True)) if output == '-' else click.echo
+    archive.export_archive(get_db(), current_app.static_folder, output, include_media=not no_media,
+                           include_passwords=passwords, echo=echo)
+
+
+# Leaderboard statistics (JSON)
+@route('/stats/leaderboard')
+def leaderboard_stats():
+    return jsonify(dict(leaderboard.get_leaderboard().stats(), **leaderboard.get_year_ranks().stats()))
+
+
+# Live event stream statistics (JSON)
+@route('/stats/events')
+def event_stats():
+    return jsonify(events.get_hub().stats())
+
+
+# Session store statistics (JSON)
+@route('/stats/sessions')
+def session_stats():
+    return jsonify(dict(sessions.get_store().stats(),
+                        swept_total=current_app.extensions['sessions']['sweeper'].swept))
+
+
+# Moderation queue and upload collector statistics (JSON)
+@route('/stats/uploads')
+def upload_stats():
+    return jsonify(dict(uploads.get_collector().stats(), pending_artworks=models.count_pending(get_db())))
+
 
 # Root
-@app.route('/', methods=['GET', 'POST'])
+@route('/', methods=['GET', 'POST'])
 def index():
-    return render_template('index.html')
+    # The page body is the same for everyone; the greeting, nav and messages are added around it
+    body = cache.get_cache().cached('page:index', lambda: render_template('fragments/index_body.html'))
+    return render_template('index.html', body=body, featured=featured_html())
+
+
+# The featured artworks section. One selection is rendered per FEATURED_ROTATE_SECONDS and
+# shared by every visitor; the sampler never touches more than the artworks it picks.
+def featured_html():
+    config = current_app.config
+    rotate = config['FEATURED_ROTATE_SECONDS']
+
+    def render():
+        artwork_ids = featured.get_sampler().sample(config['FEATURED_COUNT'], config['FEATURED_WEIGHTING'])
+        cards = gallery_cards(get_db(), artwork_ids, {})
+        return render_template('fragments/featured.html', cards=cards) if cards else ''
+
+    if not rotate:
+        return render()
+    fragment_cache = cache.get_cache()
+    key = f"featured:{fragment_cache.generation('featured')}:{int(time.time() // rotate)}"
+    return fragment_cache.cached(key, render, ttl=rotate)
 
 
 # Register Route
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         username = request.form['username']
@@ -106,9 +248,13 @@ def register():
             flash("All fields are required.", "danger")
             return render_template('sign_up.html')
 
-        hashed_password = generate_password_hash(password)
+        try:
+            hashed_password = passwords.get_hasher().hash(password)
+        except passwords.HasherBusy as e:
+            flash("The server is busy. Please try again in a moment.", "danger")
+            return render_template('sign_up.html'), 503, {'Retry-After': str(e.retry_after)}
 
-        conn = get_db_connection()
+        conn = get_db()
         try:
             conn.execute(
                 'INSERT INTO Users (username, email, password, first_name, surname) VALUES (?, ?, ?, ?, ?)',
@@ -118,11 +264,10 @@ def register():
             flash("Registration successful. Please log in.", "success")
             return redirect(url_for('login'))
         except sqlite3.IntegrityError as e:
+            conn.rollback()
             logging.error(f"Database error: {e}")
             flash("Username or email already exists.", "danger")
             return render_template('sign_up.html')
-        finally:
-            conn.close()
 
     return render_template('sign_up.html')
 
@@ -130,19 +275,36 @@ def register():
 
 
 # Login Route
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
 
-        conn = get_db_connection()
+        # Turn away floods before they cost a hash
+        retry_after = ratelimit.get_login_limiter().check(request.remote_addr, username)
+        if retry_after:
+            flash('Too many login attempts. Please wait a moment and try again.', 'danger')
+            return render_template('login.html'), 429, {'Retry-After': str(math.ceil(retry_after))}
+
+        conn = get_db()
         user = conn.execute('SELECT * FROM Users WHERE username = ?', (username,)).fetchone()
-        conn.close()
 
-        if user and check_password_hash(user['password'], password):
+        try:
+            valid, new_hash = passwords.get_hasher().verify(user['password'] if user else None, password)
+        except passwords.HasherBusy as e:
+            flash('The server is busy. Please try again in a moment.', 'danger')
+            return render_template('login.html'), 503, {'Retry-After': str(e.retry_after)}
+
+        if valid:
+            if new_hash:  # PASSWORD_METHOD has changed since this password was stored
+                conn.execute('UPDATE Users SET password = ? WHERE user_id = ?', (new_hash, user['user_id']))
+                conn.commit()
+            ratelimit.get_login_limiter().succeeded(username)
+            session.regenerate()  # New session ID at login, so a planted one is worthless
             session['user_id'] = user['user_id']  # Store user_id in session
             session['username'] = user['username']  # Store user_id in session
+            session['user_type'] = user['user_type']  # 'admin' can moderate
             flash('Login successful!', 'success')
             return redirect(url_for('index'))
         else:
@@ -152,41 +314,627 @@ def login():
 
 
 # Gallery
-@app.route('/gallery', methods=['GET', 'POST'])
+@route('/gallery', methods=['GET', 'POST'])
 def gallery():
-    return render_template('gallery.html')
+    conn = get_db()
+    page, artworks = gallery_first_page(conn, current_app.config['GALLERY_PAGE_SIZE'])
+    cards = gallery_cards(conn, page['ids'], artworks)
+
+    # Per-user part, added after the cache: which of these the visitor has liked
+    liked = likes.get_service().liked_ids(conn, session['user_id'], page['ids']) if 'user_id' in session else set()
+    return compression.stream_page('gallery.html', cards=cards, liked=liked, next_cursor=page['next'])
+
+
+# Which artworks are on the first gallery page, as ({'ids': [...], 'next': cursor}, artworks) -
+# the same for everyone until an approval or rejection. `artworks` holds any rows loaded to work
+# it out. Only the first page is rendered; the rest is loaded from /api/gallery as the visitor scrolls.
+def gallery_first_page(conn, limit):
+    fragment_cache = cache.get_cache()
+    page_key = f"gallery:{fragment_cache.generation('gallery')}:first:{limit}"
+    page = fragment_cache.get(page_key)
+    artworks = {}
+    if page is None:
+        rows, next_cursor = models.get_gallery_page(conn, limit=limit)
+        artworks = {artwork['artwork_id']: artwork for artwork in rows}
+        page = {'ids': list(artworks), 'next': next_cursor}
+        fragment_cache.set(page_key, page)
+    return page, artworks
+
+
+# Rendered gallery cards for artwork_ids as [(artwork_id, html)], from the cache where possible.
+# `artworks` may already hold some of the rows; anything else missing is loaded in one query.
+def gallery_cards(conn, artwork_ids, artworks):
+    fragment_cache = cache.get_cache()
+    keys = [f'card:{artwork_id}' for artwork_id in artwork_ids]
+    cards = dict(zip(artwork_ids, fragment_cache.get_many(keys)))
+
+    missing = [artwork_id for artwork_id, html in cards.items() if html is None]
+    to_load = [artwork_id for artwork_id in missing if artwork_id not in artworks]
+    artworks.update({a['artwork_id']: a for a in models.get_artworks_by_ids(conn, to_load)})
+    for artwork_id in missing:
+        if artwork_id in artworks:
+            cards[artwork_id] = render_template('fragments/gallery_card.html', artwork=artworks[artwork_id])
+            fragment_cache.set(f'card:{artwork_id}', cards[artwork_id])
+
+    return [(artwork_id, cards[artwork_id]) for artwork_id in artwork_ids if cards[artwork_id] is not None]
+
+
+# Gallery API - one page of artworks as JSON, continuing after the ?after= cursor
+@route('/api/gallery')
+def api_gallery():
+    limit = request.args.get('limit', current_app.config['GALLERY_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['GALLERY_MAX_PAGE_SIZE']))
+
+    try:
+        artworks, next_cursor = models.get_gallery_page(
+            get_db(), session.get('user_id'), after=request.args.get('after'), limit=limit
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    return jsonify({'success': True, 'artworks': [artwork_json(a) for a in artworks], 'next': next_cursor})
+
+
+# Shape a gallery row for the JSON API
+def artwork_json(artwork):
+    if 'is_liked' in artwork:
+        artwork['is_liked'] = bool(artwork['is_liked'])
+    artwork['image_url'] = url_for('static', filename=artwork['image_path'])
+    artwork['image_srcset'] = images.srcset(artwork['image_variants'])
+    artwork['image_webp_srcset'] = images.srcset(artwork['image_variants'], 'webp')
+    del artwork['image_variants']
+    return artwork
+
+
+# Search page
+@route('/search')
+def search_page():
+    query = request.args.get('q', '').strip()
+    results = search.search_artworks(get_db(), query, current_app.config['SEARCH_RESULTS']) if query else []
+    return render_template('search.html', query=query, results=results)
+
+
+# Search API - the same results as JSON
+@route('/api/search')
+def api_search():
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', current_app.config['SEARCH_RESULTS'], type=int)
+    limit = max(1, min(limit, current_app.config['GALLERY_MAX_PAGE_SIZE']))
+    results = search.search_artworks(get_db(), query, limit)
+    return jsonify({'success': True, 'query': query, 'results': [search_result_json(r) for r in results]})
+
+
+# Shape a search result for the JSON API
+def search_result_json(result):
+    result['title_html'] = str(result['title_html'])
+    result['snippet_html'] = str(result['snippet_html'])
+    result['image_url'] = url_for('static', filename=result['image_path'])
+    result['url'] = url_for('view_artwork', artwork_id=result['artwork_id'])
+    del result['image_variants']
+    return result
+
+
+# Artwork Like Route - toggles the like and returns the new count as JSON
+@route('/like/<int:artwork_id>', methods=['POST'])
+def like_artwork(artwork_id):
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'You must be logged in to like artwork.'}), 401
+
+    try:
+        # Counted in memory and written to the database with the next batch (see likes.py)
+        liked, like_count = likes.get_service().toggle(get_db(), session['user_id'], artwork_id)
+    except likes.ArtworkNotFound:
+        return jsonify({'success': False, 'error': 'Artwork not found.'}), 404
+    except sqlite3.Error as e:
+        logging.error(f"Database error: {e}")
+        return jsonify({'success': False, 'error': 'Database error.'}), 500
+
+    signals.artwork_liked.send(current_app._get_current_object(), artwork_id=artwork_id, user_id=session['user_id'],
+                               liked=liked, like_count=like_count)
+    return jsonify({'success': True, 'like_count': like_count, 'is_liked': liked})
+
+
+# Artwork Page
+@route('/artwork/<int:artwork_id>')
+def view_artwork(artwork_id):
+    conn = get_db()
+    page = artwork_page(conn, artwork_id)
+
+    # Pending artworks are only visible to the artist and admins
+    if page is None or not can_see(page):
+        abort(404)
+
+    user_liked = 'user_id' in session and likes.get_service().has_liked(conn, session['user_id'], artwork_id)
+    return render_template('view.html', page=page, artwork_id=artwork_id, user_liked=user_liked)
+
+
+# The artwork, its like count and newest comments, rendered and cached until the next
+# like/comment/moderation. Older comments are fetched a page at a time from the comments API.
+# Returns None if there is no such artwork.
+def artwork_page(conn, artwork_id):
+    page = cache.get_cache().get(f'artwork:{artwork_id}')
+    if page is None:
+        artwork = models.get_artwork(conn, artwork_id)
+        if artwork is None:
+            return None
+        comments, older = models.get_comments(conn, artwork_id, limit=current_app.config['COMMENTS_PAGE_SIZE'])
+        newest = models.encode_comment_cursor(comments[0]) if comments else models.FIRST_COMMENT_CURSOR
+        page = {
+            'title': artwork['title'],
+            'user_id': artwork['user_id'],
+            'pending': artwork['pending'],
+            'html': render_template('fragments/artwork.html', artwork=artwork, comments=comments,
+                                    older_cursor=older, newest_cursor=newest),
+        }
+        cache.get_cache().set(f'artwork:{artwork_id}', page)
+    return page
+
+
+def can_see(page):
+    return not page['pending'] or session.get('user_id') == page['user_id'] or session.get('user_type') == 'admin'
+
+
+# Artwork Comment Route. A form post redirects back to the page; a fetch() from the page
+# (X-Requested-With: XMLHttpRequest) gets just the new comment's <li> to insert.
+@route('/comment/<int:artwork_id>', methods=['POST'])
+def post_comment(artwork_id):
+    inline = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    if 'user_id' not in session:
+        if inline:
+            return 'You must be logged in to comment.', 401
+        flash("You must be logged in to comment.", "warning")
+        return redirect(url_for('login'))
+
+    comment_text = request.form.get('comment', '').strip()
+    if not comment_text:
+        if inline:
+            return 'Comment cannot be empty.', 400
+        flash("Comment cannot be empty.", "danger")
+        return redirect(url_for('view_artwork', artwork_id=artwork_id))
+
+    conn = get_db()
+    try:
+        comment_id = models.add_comment(conn, artwork_id, session['user_id'], comment_text)
+    except sqlite3.IntegrityError:
+        abort(404)
+
+    signals.comment_posted.send(current_app._get_current_object(), artwork_id=artwork_id, comment_id=comment_id, user_id=session['user_id'])
+    if inline:
+        return render_template('fragments/comment.html', comment=models.get_comment(conn, comment_id)), 201
+    flash("Comment posted!", "success")
+    return redirect(url_for('view_artwork', artwork_id=artwork_id))
+
+
+# Live like counts and comments for the artworks on a page, as Server-Sent Events:
+#   /events?artworks=1,2,3
+# Each open stream holds a request thread here; asgi.py serves the same endpoint on its event loop.
+# Past EVENTS_MAX_THREAD_STREAMS the answer is 503, and the page polls /api/likes instead.
+@route('/events')
+def event_stream():
+    config = current_app.config
+    try:
+        artwork_ids = events.parse_artwork_ids(request.args.get('artworks', ''), config['EVENTS_MAX_ARTWORKS'])
+    except ValueError as e:
+        return str(e), 400
+    hub = events.get_hub()
+    try:
+        subscriber = hub.subscribe(artwork_ids)
+    except events.TooManyStreams:
+        return 'Too many live streams open; try again shortly.', 503, {'Retry-After': '30'}
+    return current_app.response_class(events.stream(hub, subscriber, config['EVENTS_KEEPALIVE']),
+                                      mimetype='text/event-stream', headers=events.STREAM_HEADERS)
+
+
+# Like counts for the artworks on a page, for browsers that can't hold a live stream open:
+#   /api/likes?artworks=1,2,3
+@route('/api/likes')
+def api_likes():
+    try:
+        artwork_ids = events.parse_artwork_ids(request.args.get('artworks', ''),
+                                               current_app.config['EVENTS_MAX_ARTWORKS'])
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'likes': models.get_like_counts(get_db(), artwork_ids)})
+
+
+# Comments API for an open artwork page:
+#   ?before=<cursor>  the next page of older comments, newest first
+#   ?after=<cursor>   comments posted since, oldest first, and the cursor to ask from next time
+@route('/api/artwork/<int:artwork_id>/comments')
+def api_comments(artwork_id):
+    conn = get_db()
+    page = artwork_page(conn, artwork_id)
+    if page is None or not can_see(page):
+        return jsonify({'success': False, 'error': 'Artwork not found.'}), 404
+
+    limit = request.args.get('limit', current_app.config['COMMENTS_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['GALLERY_MAX_PAGE_SIZE']))
+    try:
+        if 'after' in request.args:
+            comments, newest = models.get_comments_since(conn, artwork_id, request.args['after'], limit)
+            result = {'comments': comments, 'newest': newest}
+        else:
+            comments, older = models.get_comments(conn, artwork_id, request.args.get('before'), limit)
+            result = {'comments': comments, 'next': older}
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    for comment in comments:
+        del comment['user_id']
+    return jsonify(dict(result, success=True))
+
+
+# Artist profile - totals from the ArtistStats summary table and per-year ranks from
+# leaderboard.YearRanks, then their approved artworks a page at a time (?after=<cursor>).
+# Artists also see how many of their own submissions are still waiting for moderation.
+@route('/artist/<username>')
+def artist_profile(username):
+    conn = get_db()
+    profile = artist_profile_with_ranks(conn, username)
+    if profile is None:
+        abort(404)
+
+    try:
+        artworks, next_cursor = models.get_artist_artworks(conn, profile['user_id'], request.args.get('after'),
+                                                           current_app.config['GALLERY_PAGE_SIZE'])
+    except ValueError:
+        abort(400)
+    cards = gallery_cards(conn, [a['artwork_id'] for a in artworks], {a['artwork_id']: a for a in artworks})
+
+    pending = None
+    if session.get('user_id') == profile['user_id'] or session.get('user_type') == 'admin':
+        pending = models.count_pending_for_artist(conn, profile['user_id'])
+    return compression.stream_page('artist.html', profile=profile, cards=cards, next_cursor=next_cursor,
+                                   pending=pending)
+
+
+# Artist API - the profile figures as JSON
+@route('/api/artist/<username>')
+def api_artist(username):
+    profile = artist_profile_with_ranks(get_db(), username)
+    if profile is None:
+        return jsonify({'success': False, 'error': 'Artist not found.'}), 404
+    return jsonify(dict(profile, success=True))
+
+
+# models.get_artist_profile plus each year's rank among that year's artists
+def artist_profile_with_ranks(conn, username):
+    profile = models.get_artist_profile(conn, username)
+    if profile is not None:
+        ranks = leaderboard.get_year_ranks()
+        for year in profile['years']:
+            year['rank'], year['artists'] = ranks.artist(year['year'], profile['user_id'])
+    return profile
+
+
+# One page of an artist's approved artworks as JSON, continuing after the ?after= cursor
+@route('/api/artist/<username>/artworks')
+def api_artist_artworks(username):
+    conn = get_db()
+    user = conn.execute('SELECT user_id FROM Users WHERE username = ?', (username,)).fetchone()
+    if user is None:
+        return jsonify({'success': False, 'error': 'Artist not found.'}), 404
+
+    limit = request.args.get('limit', current_app.config['GALLERY_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['GALLERY_MAX_PAGE_SIZE']))
+    try:
+        artworks, next_cursor = models.get_artist_artworks(conn, user['user_id'], request.args.get('after'), limit)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'artworks': [artwork_json(a) for a in artworks], 'next': next_cursor})
+
+
+# Artwork statistics API - likes, comments and rank within its competition year
+@route('/api/artwork/<int:artwork_id>/stats')
+def api_artwork_stats(artwork_id):
+    stats = models.get_artwork_stats(get_db(), artwork_id)
+    if stats is None or not can_see(stats):
+        return jsonify({'success': False, 'error': 'Artwork not found.'}), 404
+    stats['rank'] = None if stats['pending'] else leaderboard.get_year_ranks().artwork(stats['year'], artwork_id)
+    del stats['user_id']
+    return jsonify(dict(stats, success=True))
+
+
+# People's Choice - the most-liked artworks on one board (?board=all|year|hour|day)
+@route('/leaderboard')
+def leaderboard_page():
+    board = request.args.get('board', 'all')
+    try:
+        entries = leaderboard_entries(board, current_app.config['LEADERBOARD_SIZE'])
+    except ValueError:
+        abort(404)
+    return render_template('leaderboard.html', board=board, boards=leaderboard.get_leaderboard().boards,
+                           entries=entries)
+
+
+# Leaderboard API - ?board=, ?limit= and ?offset= for the next page
+@route('/api/leaderboard')
+def api_leaderboard():
+    limit = request.args.get('limit', current_app.config['LEADERBOARD_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['GALLERY_MAX_PAGE_SIZE']))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    board = request.args.get('board', 'all')
+    try:
+        entries = leaderboard_entries(board, limit, offset)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'board': board, 'artworks': [artwork_json(a) for a in entries]})
+
+
+# One artwork's rank and score on every board
+@route('/api/leaderboard/<int:artwork_id>')
+def api_leaderboard_rank(artwork_id):
+    ranks = {}
+    for board in leaderboard.get_leaderboard().boards:
+        rank, score, ranked = leaderboard.get_leaderboard().rank(board, artwork_id)
+        ranks[board] = {'rank': rank, 'score': score, 'ranked': ranked}
+    return jsonify({'success': True, 'artwork_id': artwork_id, 'boards': ranks})
+
+
+# Gallery rows for a stretch of a leaderboard, with each artwork's rank and score on it
+def leaderboard_entries(board, limit, offset=0):
+    top = leaderboard.get_leaderboard().top(board, limit, offset)
+    artworks = {a['artwork_id']: a for a in models.get_artworks_by_ids(get_db(), [entry[0] for entry in top])}
+    return [dict(artworks[artwork_id], rank=rank, score=score)
+            for artwork_id, score, rank in top if artwork_id in artworks]
+
+
+# Approve or reject many artworks in one transaction, then tell the caches (and the upload
+# collector) about each one. Returns the IDs that changed.
+def moderate(conn, action, artwork_ids):
+    app = current_app._get_current_object()
+    if action == 'approve':
+        done = models.approve_artworks(conn, artwork_ids)
+        for artwork_id in done:
+            signals.artwork_approved.send(app, artwork_id=artwork_id)
+    else:
+        done = [row['artwork_id'] for row in models.reject_artworks(conn, artwork_ids)]
+        for artwork_id in done:
+            signals.artwork_rejected.send(app, artwork_id=artwork_id)
+    return done
+
+
+# Admin Approve Route - the moderation queue a page at a time, oldest first
+@route('/admin/approve', methods=['GET', 'POST'])
+def admin_approve():
+    if session.get('user_type') != 'admin':
+        flash("You must be an admin to access this page.", "danger")
+        return redirect(url_for('index')) # Return use to the index page
+
+    conn = get_db()
+
+    if request.method == 'POST':
+        action = request.form.get('action')
+        # Either one artwork's own button or the ticked boxes with a bulk button
+        artwork_ids = request.form.getlist('artwork_ids', type=int) or request.form.getlist('artwork_id', type=int)
+        artwork_ids = artwork_ids[:current_app.config['MODERATION_MAX_BATCH']]
+
+        if action not in ('approve', 'reject') or not artwork_ids:
+            flash("Select at least one artwork.", "danger")
+        else:
+            done = moderate(conn, action, artwork_ids)
+            if not done:
+                flash("Artwork not found.", "danger")
+            elif action == 'approve':
+                flash("Artwork approved!" if len(done) == 1 else f"{len(done)} artworks approved!", "success")
+            else:
+                flash("Artwork rejected and removed." if len(done) == 1 else f"{len(done)} artworks rejected and removed.", "warning")
+
+        return redirect(url_for('admin_approve', after=request.args.get('after')))
+
+    try:
+        artworks, next_cursor = models.get_moderation_page(conn, after=request.args.get('after'),
+                                                          limit=current_app.config['MODERATION_PAGE_SIZE'])
+    except ValueError:
+        return redirect(url_for('admin_approve'))
+    return compression.stream_page('admin_approve.html', artworks=artworks, next_cursor=next_cursor,
+                                   pending=models.count_pending(conn))
+
+
+# Moderation queue as JSON: /api/moderation?after=<cursor>&limit=50
+@route('/api/moderation')
+def api_moderation_queue():
+    if session.get('user_type') != 'admin':
+        return jsonify({'success': False, 'error': 'Only admins can moderate.'}), 403
+
+    limit = request.args.get('limit', current_app.config['MODERATION_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['GALLERY_MAX_PAGE_SIZE']))
+    conn = get_db()
+    try:
+        artworks, next_cursor = models.get_moderation_page(conn, after=request.args.get('after'), limit=limit)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'artworks': [artwork_json(a) for a in artworks], 'next': next_cursor,
+                    'pending': models.count_pending(conn)})
+
+
+# Bulk moderation: POST {"action": "approve" | "reject", "artwork_ids": [1, 2, ...]}
+@route('/api/moderation', methods=['POST'])
+def api_moderate():
+    if session.get('user_type') != 'admin':
+        return jsonify({'success': False, 'error': 'Only admins can moderate.'}), 403
+
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    artwork_ids = data.get('artwork_ids')
+    if action not in ('approve', 'reject'):
+        return jsonify({'success': False, 'error': 'action must be "approve" or "reject".'}), 400
+    if (not isinstance(artwork_ids, list) or not artwork_ids
+            or not all(isinstance(i, int) and not isinstance(i, bool) for i in artwork_ids)):
+        return jsonify({'success': False, 'error': 'artwork_ids must be a list of artwork IDs.'}), 400
+    if len(artwork_ids) > current_app.config['MODERATION_MAX_BATCH']:
+        return jsonify({'success': False,
+                        'error': f"At most {current_app.config['MODERATION_MAX_BATCH']} artworks at a time."}), 400
+
+    try:
+        done = moderate(get_db(), action, artwork_ids)
+    except sqlite3.Error as e:
+        logging.error(f"Database error: {e}")
+        return jsonify({'success': False, 'error': 'Database error.'}), 500
+
+    missing = sorted(set(artwork_ids) - set(done))
+    key = 'approved' if action == 'approve' else 'rejected'
+    return jsonify({'success': True, key: done, 'not_found': missing})
 
 
 # Upload Route
-@app.route('/upload', methods=['GET', 'POST'])
+@route('/upload', methods=['GET', 'POST'])
 def upload():
-    print ("hello")
+    if 'user_id' not in session:
+        flash("You must be logged in to upload artwork.", "warning")
+        return redirect(url_for('login'))
+
+    if request.method == 'POST':
+        title = request.form.get('title', '').strip()
+        description = request.form.get('description', '').strip()
+        image = request.files.get('image')
+
+        if not title:
+            flash('Please give your artwork a title.', 'danger')
+            return render_template('submit.html')
+
+        if not image or image.filename == '':
+            flash('No file selected.', 'danger')
+            return render_template('submit.html')
+
+        try:
+            # The file was already streamed to a temp file while the form was parsed;
+            # this checks its magic bytes and moves it to uploads/<sha256>.<ext>
+            image_path, duplicate = uploads.save_upload(image)
+        except uploads.InvalidImage as e:
+            flash(str(e), 'danger')
+            return render_template('submit.html')
+
+        try:
+            conn = get_db()
+            artwork_id = models.create_artwork(conn, session['user_id'], title, description, image_path)
+            variants = models.get_image_variants(conn, image_path) if duplicate else None
+            if variants:
+                models.set_image_variants(conn, artwork_id, variants) # Same file as an earlier upload
+            else:
+                images.get_pipeline().submit(artwork_id, image_path) # Thumbnails are made in the background
+
+            logging.info(f"File uploaded: Original='{image.filename}', Saved to='{image_path}'")
+            flash("Artwork uploaded and pending approval.", "success")
+            return redirect(url_for('gallery'))
+        except Exception as e:
+            logging.error(f"Error during file upload: {e}")
+            flash("An error occurred during upload. Please try again.", "danger")
+            return render_template('submit.html')
+
     return render_template('submit.html')
 
 
 # Logout
-@app.route('/logout')
+@route('/logout')
 def logout():
-    session.pop('user_id', None)  # Remove user_id from session
+    session.clear()  # Everything the logged-in session held, not just the login keys
+    session.regenerate()  # And the ID it was known by
     flash('You have been logged out.', 'info')
     return redirect(url_for('index'))
 
 
+# Database pool statistics (JSON) for monitoring
+@route('/stats/db')
+def db_stats():
+    return jsonify(db.pool_stats())
 
 
+# Like batching statistics (JSON)
+@route('/stats/likes')
+def like_stats():
+    return jsonify(likes.get_service().stats())
 
 
+# Fragment cache statistics (JSON)
+@route('/stats/cache')
+def cache_stats():
+    return jsonify(dict(cache.get_cache().stats(), layout=current_app.extensions['layout'].stats(),
+                        compression=current_app.extensions['compression'].stats()))
 
 
+# Prometheus metrics for this worker process
+@route('/metrics')
+def prometheus_metrics():
+    return metrics.get_metrics().render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+# Password hashing and login rate limiting statistics (JSON)
+@route('/stats/auth')
+def auth_stats():
+    return jsonify({'hasher': passwords.get_hasher().stats(), 'login_limiter': ratelimit.get_login_limiter().stats()})
+
 
 
 
-if __name__ == '__main__':
-    try:
-        os.makedirs(os.path.join(app.static_folder, app.config['UPLOAD_FOLDER']), exist_ok=True)
-    except OSError as e:
-        logging.error(f"Could not create upload folder: {e}")
 
-    init_db()  # Uncomment to reset DB
+
+
+
+
+
+# Application factory - builds a configured app. `config` (a dict) overrides the defaults below.
+# Nothing here touches the schema; run `flask --app app migrate` or `python serve.py --migrate`.
+def create_app(config=None):
+    app = Flask(__name__) # Create a Flask application instance
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') # Optional - otherwise the key ring in SECRET_KEY_FILE is used
+    app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'sqlite') # Where session data lives
+    app.config['UPLOAD_FOLDER'] = 'uploads' # Name of the upload folder
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 # 16 MB limit
+    app.config['UPLOAD_CHUNK_SIZE'] = 64 * 1024 # Uploads are written to disk in 64 KB pieces
+    app.config['DATABASE'] = os.environ.get('DATABASE', 'database.db') # SQLite file
+    app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 8)) # Connections shared by the request threads
+    app.config['GALLERY_PAGE_SIZE'] = 24 # Artworks per gallery page
+    app.config['GALLERY_MAX_PAGE_SIZE'] = 100 # Largest ?limit= the gallery API accepts
+    app.config['SEARCH_RESULTS'] = 20 # Results per search
+    app.config['COMMENTS_PAGE_SIZE'] = 20 # Comments shown per page of an artwork's thread
+    app.config['MODERATION_PAGE_SIZE'] = 50 # Pending artworks per page of the moderation queue
+    app.config['MODERATION_MAX_BATCH'] = 1000 # Most artworks approved/rejected in one request
+    app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', 2)) # Processes making thumbnails (0 = inline)
+    app.config['ASSET_SENDFILE'] = os.environ.get('ASSET_SENDFILE') # 'x-sendfile' or 'x-accel' behind a proxy
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0)) # Proxies in front (1 behind nginx) - see ratelimit.py
+    app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory') # 'redis' to share the cache - required with several workers
+    app.config['CACHE_URL'] = os.environ.get('CACHE_URL', 'redis://localhost:6379/0')
+    app.config['EVENTS_BACKEND'] = os.environ.get('EVENTS_BACKEND', 'memory') # 'redis' to reach streams in every worker
+    app.config['LIKE_FLUSH_INTERVAL'] = float(os.environ.get('LIKE_FLUSH_INTERVAL', 0.25)) # Seconds between batched like writes
+    app.config['PASSWORD_WORKERS'] = int(os.environ.get('PASSWORD_WORKERS', 2)) # Processes hashing passwords (0 = inline)
+    app.config['PASSWORD_METHOD'] = os.environ.get('PASSWORD_METHOD', 'scrypt:32768:8:1') # Hash method and cost
+    app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100)) # Log SQL statements slower than this
+    if config:
+        app.config.update(config)
+
+    logging.basicConfig(level=logging.INFO) # Show errors in the console
+
+    db.init_app(app) # Pooled connections, handed out per request with get_db()
+    metrics.init_app(app) # Per-endpoint timings, SQL counts, slow-query log, Server-Timing
+    compression.init_app(app) # gzip/brotli for HTML and JSON, precompressed static siblings
+    images.init_app(app) # Background thumbnail/WebP pipeline for uploads
+    uploads.init_app(app) # Stream uploads to disk, named by their SHA-256
+    assets.init_app(app) # Fingerprinted, long-cached static files with ETags and Range support
+    cache.init_app(app) # Rendered fragments, invalidated by the events in signals.py
+    layout.init_app(app) # Shared base layout: bytecode-cached templates, nav rendered once per process
+    likes.init_app(app) # Likes are counted in memory and written to the database in batches
+    passwords.init_app(app) # Password hashing off the request threads, with back-pressure
+    ratelimit.init_app(app) # Token buckets in front of /login
+    sessions.init_app(app) # Server-side sessions behind a short signed ID, persistent key ring
+    featured.init_app(app) # Home page picks drawn from an in-memory array of approved artworks
+    events.init_app(app) # Live like counts and comments over Server-Sent Events
+    leaderboard.init_app(app) # Most-liked artworks, all time and per window, ranked in memory
+
+    for rule, options, view in routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    for command in (init_db_command, migrate_command, check_plans_command, reconcile_likes_command,
+                    make_admin_command, rotate_keys_command, gc_uploads_command, import_archive_command,
+                    export_archive_command, compile_templates_command, compress_assets_command):
+        app.cli.add_command(command)
+    return app
+
+
+# Development server only - use serve.py in production
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        if migrations.schema_version(get_db()) < migrations.LATEST_VERSION:
+            logging.warning("Database schema is out of date - run `flask --app app migrate`")
     #app.run(host='0.0.0.0')
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
@@ -0,0 +1,433 @@
+import os
+import io
+import csv
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import images
+import uploads
+from models import _chunks
+
+# Bulk import and export of competition archives.
+#
+# import_archive() loads a directory of images or a CSV/JSONL manifest in batches:
+#   1. entries already imported (by source key, see ArchiveImports) are skipped, so an
+#      interrupted import is simply run again;
+#   2. the batch's images are hashed and copied (or hard-linked) into the upload folder as
+#      <sha256>.<ext> on a thread pool, exactly as uploads.py stores a form upload;
+#   3. artists and artworks are inserted with executemany in one transaction, together with
+#      the ArchiveImports rows that mark them done;
+#   4. thumbnails and WebP variants are made on a process pool while the next batch loads.
+#      Imported artworks that still have no variants are picked up again on the next run.
+#
+# export_archive() streams users, artworks, comments and likes as JSONL files, plus every image
+# the artworks refer to, into a tar file. Rows are read with a cursor and spooled to temp files,
+# so memory use doesn't grow with the archive. artworks.jsonl is itself an import manifest.
+#
+# Manifest fields (CSV header or JSONL keys); only image and title are required:
+#   id, image, title, description, artist, email, first_name, surname, submission_date, approved
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+UNUSABLE_PASSWORD = '!'  # Matches no password - imported artists reset theirs to sign in
+HASH_CHUNK = 1024 * 1024
+
+
+class ImportStats:
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.failed = 0
+        self.users_created = 0
+        self.variants = 0
+
+    def __str__(self):
+        return (f'{self.imported} imported, {self.skipped} already imported, {self.failed} failed, '
+                f'{self.users_created} artists created, {self.variants} images processed')
+
+
+# --- Reading entries ---
+
+def _truthy(value, default=True):
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y', 'approved')
+
+
+def _title_from_filename(path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return ' '.join(stem.replace('_', ' ').replace('-', ' ').split()).title() or stem
+
+
+def _entry(raw, base_dir, default_artist):
+    image = raw.get('image') or raw.get('image_path')
+    if not image:
+        raise ValueError('no image')
+    artist = (raw.get('artist') or default_artist).strip()
+    return {
+        'source': str(raw.get('id') or image),
+        'image': os.path.join(base_dir, image),
+        'title': (raw.get('title') or _title_from_filename(image)).strip(),
+        'description': raw.get('description') or None,
+        'artist': artist,
+        'email': raw.get('email') or f'{artist.lower()}@archive.invalid',
+        'first_name': raw.get('first_name') or artist,
+        'surname': raw.get('surname') or '',
+        'submission_date': raw.get('submission_date') or None,
+        'approved': _truthy(raw.get('approved')),
+    }
+
+
+# Images under `directory`, in a stable order. Images in a sub-folder are credited to an
+# artist of that name, the rest to default_artist.
+def _directory_entries(directory, default_artist):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            relative = os.path.relpath(os.path.join(root, name), directory).replace(os.sep, '/')
+            folder = relative.split('/', 1)[0] if '/' in relative else None
+            yield {'image': relative, 'artist': folder or default_artist}
+
+
+def _manifest_rows(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.csv'):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+# Yields (entry, None) or (None, error message) for each artwork in a directory or manifest
+def read_entries(source, default_artist='archive'):
+    if os.path.isdir(source):
+        base_dir, rows = source, _directory_entries(source, default_artist)
+    elif source.lower().endswith(('.csv', '.jsonl', '.json')):
+        base_dir, rows = os.path.dirname(os.path.abspath(source)), _manifest_rows(source)
+    else:
+        raise ValueError(f'{source} is not a directory, .csv or .jsonl manifest')
+
+    for number, raw in enumerate(rows, 1):
+        try:
+            yield _entry(raw, base_dir, default_artist), None
+        except (ValueError, AttributeError) as e:
+            yield None, f'entry {number}: {e}'
+
+
+# --- Storing images ---
+
+# Hash, type-check and copy (or hard-link) one image into `directory` as <sha256>.<ext>.
+# Runs on a thread; returns the file name.
+def store_image(path, directory, link=False):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        head = f.read(uploads.SNIFF_BYTES)
+        kind = uploads.sniff_image_type(head)
+        if kind is None:
+            raise uploads.InvalidImage('not a PNG, JPEG or GIF image')
+        digest.update(head)
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+
+    filename = f'{digest.hexdigest()}.{kind}'
+    destination = os.path.join(directory, filename)
+    if os.path.exists(destination):
+        os.utime(destination)  # As for a duplicate upload - restarts the collector's grace period
+        return filename
+    if link:
+        try:
+            os.link(path, destination)
+            return filename
+        except FileExistsError:
+            return filename
+        except OSError:
+            pass  # Different filesystem - copy instead
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out, open(path, 'rb') as f:
+            shutil.copyfileobj(f, out, HASH_CHUNK)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return filename
+
+
+# --- Import ---
+
+def _already_imported(conn, sources):
+    done = set()
+    for chunk in _chunks(sources):
+        placeholders = ', '.join('?' * len(chunk))
+        done.update(row[0] for row in conn.execute(
+            f'SELECT source FROM ArchiveImports WHERE source IN ({placeholders})', chunk))
+    return done
+
+
+def _user_ids(conn, usernames):
+    ids = {}
+    for chunk in _chunks(usernames):
+        placeholders = ', '.join('?' * len(chunk))
+        ids.update((row[1], row[0]) for row in conn.execute(
+            f'SELECT user_id, username FROM Users WHERE username IN ({placeholders})', chunk))
+    return ids
+
+
+# Insert a batch's artists and artworks, and mark the entries imported, in one transaction.
+# Artwork IDs are handed out up front so the rows can go in with executemany.
+def _insert_batch(conn, entries, stats):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        artists = {}
+        for entry in entries:
+            artists.setdefault(entry['artist'], entry)
+        user_ids = _user_ids(conn, list(artists))
+        new_users = [(name, e['email'], UNUSABLE_PASSWORD, e['first_name'], e['surname'])
+                     for name, e in artists.items() if name not in user_ids]
+        if new_users:
+            # OR IGNORE: an email already taken by another account leaves that artist out
+            # (and their entries fail below), rather than aborting the batch
+            conn.executemany('INSERT OR IGNORE INTO Users (username, email, password, first_name, surname) '
+                             'VALUES (?, ?, ?, ?, ?)', new_users)
+            user_ids.update(_user_ids(conn, [user[0] for user in new_users]))
+            stats.users_created += sum(1 for user in new_users if user[0] in user_ids)
+
+        stats.failed += sum(1 for entry in entries if entry['artist'] not in user_ids)
+        entries = [entry for entry in entries if entry['artist'] in user_ids]
+        last_id = max(conn.execute('SELECT COALESCE(MAX(artwork_id), 0) FROM Artworks').fetchone()[0],
+                      (conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'Artworks'").fetchone() or [0])[0])
+        rows = []
+        for artwork_id, entry in enumerate(entries, last_id + 1):
+            entry['artwork_id'] = artwork_id
+            rows.append((artwork_id, user_ids[entry['artist']], entry['title'], entry['description'],
+                         entry['submission_date'], entry['image_path'], 0 if entry['approved'] else 1,
+                         entry['image_path']))
+        # An image already in the gallery shares the variants made for it
+        conn.executemany('''
+            INSERT INTO Artworks (artwork_id, user_id, title, description, submission_date, image_path, pending,
+                                  image_variants)
+            VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?,
+                    (SELECT MAX(image_variants) FROM Artworks WHERE image_path = ?))
+        ''', rows)
+        conn.executemany('INSERT INTO ArchiveImports (source, artwork_id) VALUES (?, ?)',
+                         [(entry['source'], entry['artwork_id']) for entry in entries])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    stats.imported += len(entries)
+    return entries
+
+
+# Imported images with no variants yet - from this run, or one that was interrupted
+def _images_without_variants(conn, image_paths=None):
+    if image_paths is None:
+        return [row[0] for row in conn.execute('''
+            SELECT DISTINCT a.image_path FROM ArchiveImports i
+            JOIN Artworks a ON a.artwork_id = i.artwork_id
+            WHERE a.image_variants IS NULL
+        ''')]
+    missing = []
+    for chunk in _chunks(sorted(set(image_paths))):
+        placeholders = ', '.join('?' * len(chunk))
+        missing.extend(row[0] for row in conn.execute(f'''
+            SELECT image_path FROM Artworks WHERE image_path IN ({placeholders})
+            GROUP BY image_path HAVING MAX(image_variants) IS NULL
+        ''', chunk))
+    return missing
+
+
+def _save_variants(conn, done):
+    conn.executemany('UPDATE Artworks SET image_variants = ? WHERE image_path = ?',
+                     [(json.dumps(variants), image_path) for image_path, variants in done])
+    conn.commit()
+
+
+def import_archive(conn, app, source, default_artist='archive', link=False, approve=True, batch_size=1000,
+                   workers=None, echo=print):
+    stats = ImportStats()
+    directory = uploads.upload_directory(app)
+    folder = app.config['UPLOAD_FOLDER']
+    widths, quality = app.config['IMAGE_VARIANT_WIDTHS'], app.config['IMAGE_QUALITY']
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+
+    resizing = images.Image is not None
+    if not resizing:
+        echo('Pillow is not installed - importing without image variants')
+    copier = ThreadPoolExecutor(max_workers=min(32, workers * 4), thread_name_prefix='archive-copy')
+    resizer = ProcessPoolExecutor(max_workers=workers) if resizing else None
+    pending_variants = {}  # future -> image_path
+
+    def submit_variants(image_paths):
+        for image_path in image_paths:
+            future = resizer.submit(images.make_variants, app.static_folder, image_path, widths, quality)
+            pending_variants[future] = image_path
+
+    def collect_variants(wait=False):
+        done = []
+        for future in [f for f in pending_variants if wait or f.done()]:
+            image_path = pending_variants.pop(future)
+            try:
+                done.append((image_path, future.result()))
+            except Exception as e:
+                logging.error(f"Image processing failed for '{image_path}': {e}")
+        if done:
+            _save_variants(conn, done)
+            stats.variants += len(done)
+
+    try:
+        if resizing:
+            submit_variants(_images_without_variants(conn))  # Left over from an interrupted run
+
+        def batches():
+            batch = []
+            for entry, error in read_entries(source, default_artist):
+                if error:
+                    stats.failed += 1
+                    echo(f'Skipped {error}')
+                    continue
+                batch.append(entry)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        for batch in batches():
+            done = _already_imported(conn, [entry['source'] for entry in batch])
+            seen = set()
+            todo = []
+            for entry in batch:
+                if entry['source'] in done or entry['source'] in seen:
+                    stats.skipped += 1
+                else:
+                    seen.add(entry['source'])
+                    todo.append(entry)
+            if not todo:
+                continue
+
+            stored = []
+            futures = [(entry, copier.submit(store_image, entry['image'], directory, link)) for entry in todo]
+            for entry, future in futures:
+                try:
+                    entry['image_path'] = f'{folder}/{future.result()}'
+                    if not approve:
+                        entry['approved'] = False
+                    stored.append(entry)
+                except (OSError, uploads.InvalidImage) as e:
+                    stats.failed += 1
+                    echo(f"Skipped {entry['image']}: {e}")
+
+            if stored:
+                inserted = _insert_batch(conn, stored, stats)
+                if resizing:
+                    submit_variants(_images_without_variants(conn, [entry['image_path'] for entry in inserted]))
+                    collect_variants()
+            echo(f'{stats} ({time.perf_counter() - started:.1f}s)')
+
+        if resizing and pending_variants:
+            echo(f'Waiting for {len(pending_variants)} images to finish processing...')
+            collect_variants(wait=True)
+    finally:
+        copier.shutdown(wait=True)
+        if resizer is not None:
+            resizer.shutdown(wait=True, cancel_futures=True)
+    return stats
+
+
+# --- Export ---
+
+EXPORT_TABLES = [
+    ('users.jsonl', 'SELECT user_id, username, email, first_name, surname, user_type FROM Users ORDER BY user_id'),
+    ('artworks.jsonl', '''
+        SELECT 'artwork:' || a.artwork_id AS id, a.artwork_id, 'media/' || a.image_path AS image, a.title,
+               a.description, u.username AS artist, u.email, u.first_name, u.surname, a.submission_date,
+               a.pending = 0 AS approved, a.like_count, a.image_variants
+        FROM Artworks a JOIN Users u ON u.user_id = a.user_id
+        ORDER BY a.artwork_id'''),
+    ('comments.jsonl', 'SELECT comment_id, artwork_id, user_id, comment, timestamp FROM Comments ORDER BY comment_id'),
+    ('likes.jsonl', 'SELECT user_id, artwork_id, timestamp FROM Likes ORDER BY like_id'),
+]
+
+
+def _add_stream(tar, name, fileobj, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    tar.addfile(info, fileobj)
+
+
+# Each table goes through a temp file first (a tar member's size must be known up front)
+def _export_table(conn, tar, name, sql, include_passwords):
+    if include_passwords and name == 'users.jsonl':
+        sql = sql.replace('user_type FROM', 'user_type, password FROM')
+    rows = 0
+    with tempfile.TemporaryFile() as spool:
+        writer = io.TextIOWrapper(spool, encoding='utf-8', newline='\n')
+        cursor = conn.execute(sql)
+        while True:
+            batch = cursor.fetchmany(1000)
+            if not batch:
+                break
+            for row in batch:
+                record = dict(row)
+                if 'approved' in record:
+                    record['approved'] = bool(record['approved'])
+                if record.get('image_variants'):
+                    record['image_variants'] = json.loads(record['image_variants'])
+                writer.write(json.dumps(record, ensure_ascii=False) + '\n')
+            rows += len(batch)
+        writer.flush()
+        size = spool.tell()
+        spool.seek(0)
+        _add_stream(tar, name, spool, size)
+        writer.detach()
+    return rows
+
+
+# Every file the artworks refer to, once each (duplicates share a file and its variants)
+def _media_paths(conn):
+    for image_path, variants in conn.execute('''
+            SELECT image_path, MAX(image_variants) FROM Artworks
+            WHERE image_path IS NOT NULL GROUP BY image_path'''):
+        yield image_path
+        if variants:
+            for variant in json.loads(variants).values():
+                yield variant['webp']
+                yield variant['fallback']
+
+
+def export_archive(conn, static_folder, output, include_media=True, include_passwords=False, echo=print):
+    compress = output.endswith(('.gz', '.tgz'))
+    stream = sys.stdout.buffer if output == '-' else None
+    counts = {}
+    files = missing = 0
+    with tarfile.open(None if stream else output, 'w|gz' if compress else 'w|', fileobj=stream) as tar:
+        for name, sql in EXPORT_TABLES:
+            counts[name] = _export_table(conn, tar, name, sql, include_passwords)
+        if include_media:
+            for path in _media_paths(conn):
+                full_path = os.path.join(static_folder, path)
+                if not os.path.isfile(full_path):
+                    missing += 1
+                    continue
+                tar.add(full_path, arcname=f'media/{path}', recursive=False)
+                files += 1
+    summary = ', '.join(f'{count} {name.split(".")[0]}' for name, count in counts.items())
+    echo(f'Exported {summary}, {files} media files' + (f' ({missing} missing on disk)' if missing else ''))
+    return counts, files
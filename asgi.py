@@ -0,0 +1,344 @@
+# Asyncio serving mode - the same app as an ASGI application.
+#
+#   uvicorn --factory asgi:create_asgi_app --workers 4 --port 8000
+#
+# Under WSGI every request holds a thread for its whole life, including the time spent trickling
+# bytes to a slow phone. Here the server's event loop owns the connections, so idle and slow
+# clients cost a coroutine each instead of a thread.
+#
+# The busiest read paths - gallery, artwork page, like, search and their JSON APIs - are ported to
+# async handlers below; they reach SQLite through aiodb's bounded executor, and the other blocking
+# work (session store, cache, rendering, after_request hooks) goes to the same threads.
+# Every other route (uploads, login, moderation, static files) still runs as WSGI on a bounded
+# pool of ASYNC_WSGI_THREADS threads, so the two modes serve exactly the same site.
+import sys
+import asyncio
+import logging
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import render_template, session, current_app, request, jsonify, abort
+from werkzeug.test import run_wsgi_app
+
+import app as views
+import aiodb
+import cache
+import events
+import likes
+import models
+import search
+import signals
+
+SPOOL_SIZE = 1024 * 1024  # Request bodies larger than this are spooled to disk while they arrive
+
+
+# Async versions of the hot views. Same endpoints, templates and JSON as app.py.
+
+async def gallery():
+    adb = aiodb.get_async_db()
+    page, artworks = await adb.run(views.gallery_first_page, current_app.config['GALLERY_PAGE_SIZE'])
+    cards = await adb.run(views.gallery_cards, page['ids'], artworks)
+    liked = set()
+    if 'user_id' in session:
+        liked = await adb.run(likes.get_service().liked_ids, session['user_id'], page['ids'])
+    return await adb.call(render_template, 'gallery.html', cards=cards, liked=liked, next_cursor=page['next'])
+
+
+async def api_gallery():
+    limit = request.args.get('limit', current_app.config['GALLERY_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['GALLERY_MAX_PAGE_SIZE']))
+    try:
+        artworks, next_cursor = await aiodb.get_async_db().run(
+            models.get_gallery_page, session.get('user_id'), after=request.args.get('after'), limit=limit
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'artworks': [views.artwork_json(a) for a in artworks], 'next': next_cursor})
+
+
+async def view_artwork(artwork_id):
+    adb = aiodb.get_async_db()
+    page = await adb.call(cache.get_cache().get, f'artwork:{artwork_id}')
+    if page is None:
+        page = await adb.run(views.artwork_page, artwork_id)
+    if page is None or not views.can_see(page):
+        abort(404)
+
+    user_liked = False
+    if 'user_id' in session:
+        user_liked = await adb.run(likes.get_service().has_liked, session['user_id'], artwork_id)
+    return await adb.call(render_template, 'view.html', page=page, artwork_id=artwork_id, user_liked=user_liked)
+
+
+async def like_artwork(artwork_id):
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'You must be logged in to like artwork.'}), 401
+
+    adb = aiodb.get_async_db()
+    try:
+        liked, like_count = await adb.run(likes.get_service().toggle, session['user_id'], artwork_id)
+    except likes.ArtworkNotFound:
+        return jsonify({'success': False, 'error': 'Artwork not found.'}), 404
+    except sqlite3.Error as e:
+        logging.error(f"Database error: {e}")
+        return jsonify({'success': False, 'error': 'Database error.'}), 500
+
+    # Receivers invalidate the (possibly Redis) cache and publish to live streams
+    await adb.call(signals.artwork_liked.send, current_app._get_current_object(), artwork_id=artwork_id,
+                   user_id=session['user_id'], liked=liked, like_count=like_count)
+    return jsonify({'success': True, 'like_count': like_count, 'is_liked': liked})
+
+
+async def search_page():
+    adb = aiodb.get_async_db()
+    query = request.args.get('q', '').strip()
+    results = []
+    if query:
+        results = await adb.run(search.search_artworks, query, current_app.config['SEARCH_RESULTS'])
+    return await adb.call(render_template, 'search.html', query=query, results=results)
+
+
+async def api_search():
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', current_app.config['SEARCH_RESULTS'], type=int)
+    limit = max(1, min(limit, current_app.config['GALLERY_MAX_PAGE_SIZE']))
+    results = await aiodb.get_async_db().run(search.search_artworks, query, limit)
+    return jsonify({'success': True, 'query': query, 'results': [views.search_result_json(r) for r in results]})
+
+
+# Each open stream is a coroutine waiting on its queue - no thread is held between events
+async def event_stream():
+    config = current_app.config
+    try:
+        artwork_ids = events.parse_artwork_ids(request.args.get('artworks', ''), config['EVENTS_MAX_ARTWORKS'])
+    except ValueError as e:
+        return str(e), 400
+    hub = events.get_hub()
+    try:
+        subscriber = hub.subscribe(artwork_ids, loop=asyncio.get_running_loop())
+    except events.TooManyStreams:
+        return 'Too many live streams open; try again shortly.', 503, {'Retry-After': '30'}
+    response = current_app.response_class(mimetype='text/event-stream', headers=events.STREAM_HEADERS)
+    response.async_body = events.stream_async(hub, subscriber, config['EVENTS_KEEPALIVE'])  # Sent by AsyncApp._stream
+    return response
+
+
+# Endpoint name -> async handler
+ASYNC_VIEWS = {
+    'gallery': gallery,
+    'api_gallery': api_gallery,
+    'view_artwork': view_artwork,
+    'like_artwork': like_artwork,
+    'search_page': search_page,
+    'api_search': api_search,
+    'event_stream': event_stream,
+}
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+# Build a WSGI environ from an ASGI HTTP scope
+def make_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,  # The whole body has been read, with or without a Content-Length
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class AsyncApp:
+    def __init__(self, app):
+        self.app = app
+        self.max_body = app.config['MAX_CONTENT_LENGTH']
+        self.wsgi_threads = app.config['ASYNC_WSGI_THREADS']
+        self._wsgi_executor = None
+
+    def _get_wsgi_executor(self):
+        if self._wsgi_executor is None:
+            self._wsgi_executor = ThreadPoolExecutor(max_workers=self.wsgi_threads, thread_name_prefix='wsgi')
+        return self._wsgi_executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise NotImplementedError(f"Unsupported ASGI scope type {scope['type']!r}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.app.extensions['async_db'].shutdown()
+                if self._wsgi_executor is not None:
+                    self._wsgi_executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive):
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        size = 0
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if self.max_body is not None and size > self.max_body:
+                body.close()
+                raise RequestTooLarge()
+            body.write(chunk)
+            more = message.get('more_body', False)
+        body.seek(0)
+        return body
+
+    async def _http(self, scope, receive, send):
+        try:
+            body = await self._read_body(receive)
+        except RequestTooLarge:
+            await self._send(send, 413, [(b'content-type', b'text/plain')], [b'Request Entity Too Large'])
+            return
+
+        try:
+            environ = make_environ(scope, body)
+            ctx = self.app.request_context(environ)
+            ctx.push()
+            rule = ctx.request.url_rule
+            handler = ASYNC_VIEWS.get(rule.endpoint) if rule is not None else None
+            if handler is None or ctx.request.routing_exception is not None:
+                ctx.pop()
+                await self._wsgi(environ, send)
+                return
+
+            error = None
+            try:
+                response = await self._dispatch(handler, ctx)
+            except Exception as e:
+                error = e
+                response = self.app.handle_exception(e)
+            finally:
+                ctx.pop(error)
+            if getattr(response, 'async_body', None) is not None:
+                await self._stream(receive, send, response)
+            else:
+                await self._send(send, response.status_code, response.headers.to_wsgi_list(), [response.get_data()])
+        finally:
+            body.close()
+
+    # The async equivalent of Flask's full_dispatch_request. Anything that may block - reading the
+    # session from its store, and the after_request hooks (saving the session, compressing the
+    # body) - runs on aiodb's threads, so a slow store or an exhausted pool never stalls the loop.
+    async def _dispatch(self, handler, ctx):
+        adb = self.app.extensions['async_db']
+        try:
+            if getattr(ctx.session, 'sid', None):
+                await adb.call(ctx.session.load)
+            rv = self.app.preprocess_request()
+            if rv is None:
+                rv = await handler(**ctx.request.view_args)
+        except Exception as e:
+            rv = self.app.handle_user_exception(e)
+            return await adb.call(self.app.finalize_request, rv, from_error_handler=True)
+        return await adb.call(self.app.finalize_request, rv)
+
+    # Run the WSGI app on the bounded thread pool, streaming its body back chunk by chunk
+    async def _wsgi(self, environ, send):
+        loop = asyncio.get_running_loop()
+        executor = self._get_wsgi_executor()
+        app_iter, status, headers = await loop.run_in_executor(executor, run_wsgi_app, self.app, environ)
+        iterator = iter(app_iter)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers.to_wsgi_list()],
+            })
+            while True:
+                chunk = await loop.run_in_executor(executor, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    # Send a response whose body is an async generator (see event_stream) until it ends or the
+    # client goes away - the request body has been read, so the next message is the disconnect
+    async def _stream(self, receive, send, response):
+        body = response.async_body
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response.headers.to_wsgi_list()],
+        })
+
+        async def pump():
+            async for chunk in body:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        pumping = asyncio.ensure_future(pump())
+        watching = asyncio.ensure_future(disconnected())
+        try:
+            done, _ = await asyncio.wait({pumping, watching}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (pumping, watching):
+                task.cancel()
+            await asyncio.gather(pumping, watching, return_exceptions=True)
+            await body.aclose()
+        if watching not in done:  # Otherwise the client is gone - nothing more to send
+            await send({'type': 'http.response.body', 'body': b''})
+
+    async def _send(self, send, status, headers, chunks):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.lower().encode('latin-1') if isinstance(k, str) else k,
+                         v.encode('latin-1') if isinstance(v, str) else v) for k, v in headers],
+        })
+        await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+
+# ASGI application factory. `config` is passed on to app.create_app().
+def create_asgi_app(config=None):
+    app = views.create_app(config)
+    app.config.setdefault('ASYNC_WSGI_THREADS', 16)  # Threads for the routes that are still WSGI
+    aiodb.init_app(app)
+    return AsyncApp(app)
@@ -0,0 +1,125 @@
+import os
+import re
+import hashlib
+import threading
+import mimetypes
+
+from flask import request, send_from_directory, current_app, abort
+from werkzeug.security import safe_join
+
+import compression
+
+# Static and upload serving with long-lived caching.
+#  - url_for('static', filename=...) gets ?v=<content hash> added, so a changed file gets a new URL
+#    and fingerprinted URLs can be cached forever (Cache-Control: immutable).
+#  - Uploads are already named by their SHA-256 (see uploads.py), so they are immutable as-is.
+#  - Every response carries a strong ETag made from the content hash; Werkzeug answers
+#    If-None-Match with 304 and Range with 206.
+#  - Text assets with an up-to-date .br/.gz sibling (see compression.py) are sent as that sibling
+#    when the client accepts the encoding.
+#  - With ASSET_SENDFILE = 'x-sendfile' or 'x-accel' the body is left to the fronting proxy
+#    (nginx's gzip_static picks up the .gz siblings itself).
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# uploads/<sha256>.<ext> and uploads/<sha256>_<variant>.<ext>
+CONTENT_ADDRESSED = re.compile(r'^(?:.*/)?([0-9a-f]{64})(?:_[a-z]+)?\.[a-z0-9]+$')
+
+
+# Caches the hash of each static file, re-hashing only when its size or mtime changes
+class Fingerprints:
+    def __init__(self, folder):
+        self.folder = folder
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        path = safe_join(self.folder, filename)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._cache.get(filename)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(chunk)
+        fingerprint = digest.hexdigest()[:16]
+        with self._lock:
+            self._cache[filename] = (key, fingerprint)
+        return fingerprint
+
+
+# The content hash for a static file: taken from the name for uploads, computed otherwise
+def content_hash(filename):
+    match = CONTENT_ADDRESSED.match(filename)
+    if match:
+        return match.group(1)[:16], True
+    return current_app.extensions['fingerprints'].get(filename), False
+
+
+# url_defaults hook - adds ?v=<hash> to url_for('static', ...)
+def add_fingerprint(endpoint, values):
+    if endpoint != 'static' or 'v' in values or 'filename' not in values:
+        return
+    fingerprint, immutable = content_hash(values['filename'])
+    if fingerprint and not immutable:
+        values['v'] = fingerprint
+
+
+# Replacement for Flask's static view
+def serve_static(filename):
+    fingerprint, immutable = content_hash(filename)
+    immutable = immutable or (fingerprint is not None and request.args.get('v') == fingerprint)
+    mode = current_app.config['ASSET_SENDFILE']
+
+    if mode == 'x-accel':
+        path = safe_join(current_app.static_folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = current_app.config['ASSET_ACCEL_PREFIX'] + filename
+        response.set_etag(fingerprint)
+        response.make_conditional(request)
+    elif (sibling := compression.precompressed(current_app.static_folder, filename)) is not None:
+        # style.css.br / .gz written by compress-assets; its own ETag, since the bytes differ
+        compressed, encoding = sibling
+        response = send_from_directory(current_app.static_folder, compressed, conditional=True,
+                                       etag=f'{fingerprint}-{encoding}' if fingerprint else True,
+                                       mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+    else:
+        # conditional=True gives us If-None-Match -> 304 and Range -> 206;
+        # USE_X_SENDFILE (set when ASSET_SENDFILE = 'x-sendfile') hands the body to the proxy
+        response = send_from_directory(current_app.static_folder, filename,
+                                       conditional=True, etag=fingerprint or True)
+
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = ONE_YEAR
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.no_cache = True  # Revalidate with the ETag every time
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('ASSET_SENDFILE', None)  # None, 'x-sendfile' (Apache/lighttpd) or 'x-accel' (nginx)
+    app.config.setdefault('ASSET_ACCEL_PREFIX', '/protected-static/')  # nginx internal location for static/
+    if app.config['ASSET_SENDFILE'] == 'x-sendfile':
+        app.config['USE_X_SENDFILE'] = True
+
+    app.extensions['fingerprints'] = Fingerprints(app.static_folder)
+    app.url_defaults(add_fingerprint)
+    app.view_functions['static'] = serve_static
@@ -0,0 +1,87 @@
+# Gallery benchmark - seeds N approved artworks (with likes) into a throwaway database
+# and reports how many SQL statements and how long a GET /gallery takes as N grows.
+#
+# Usage: python benchmarks/bench_gallery.py [N ...]
+import os
+import sys
+import random
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE'] = DB_PATH
+os.environ['DB_POOL_SIZE'] = '1'  # One connection, so we can trace every statement it runs
+
+from app import create_app, init_db  # noqa: E402
+from db import get_db  # noqa: E402
+
+app = create_app()
+
+USERS = 200
+LIKES_PER_ARTWORK = 10
+REPEATS = 5
+
+
+def seed(conn, n_artworks):
+    conn.execute('DELETE FROM Likes')
+    conn.execute('DELETE FROM Artworks')
+    conn.execute('DELETE FROM Users')
+    conn.executemany(
+        'INSERT INTO Users (user_id, username, email, password, first_name, surname) VALUES (?, ?, ?, ?, ?, ?)',
+        [(i, f'user{i}', f'user{i}@example.com', 'x', 'First', 'Last') for i in range(1, USERS + 1)]
+    )
+    conn.executemany(
+        'INSERT INTO Artworks (artwork_id, user_id, title, description, image_path, pending) VALUES (?, ?, ?, ?, ?, 0)',
+        [(i, random.randint(1, USERS), f'Artwork {i}', 'Benchmark artwork', 'images/logo.jpg')
+         for i in range(1, n_artworks + 1)]
+    )
+    likes = set()
+    for artwork_id in range(1, n_artworks + 1):
+        for user_id in random.sample(range(1, USERS + 1), LIKES_PER_ARTWORK):
+            likes.add((user_id, artwork_id))
+    conn.executemany('INSERT INTO Likes (user_id, artwork_id) VALUES (?, ?)', likes)
+    conn.commit()
+
+
+def run(n_artworks):
+    with app.app_context():
+        conn = get_db()
+        seed(conn, n_artworks)
+        statements = []
+        conn.set_trace_callback(statements.append)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['username'] = 'user1'
+
+    timings = []
+    for _ in range(REPEATS):
+        statements.clear()
+        started = time.perf_counter()
+        response = client.get('/gallery')
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200
+
+    with app.app_context():
+        get_db().set_trace_callback(None)
+
+    timings.sort()
+    return len(statements), timings[len(timings) // 2] * 1000
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [100, 1000, 5000]
+    with app.app_context():
+        init_db()
+
+    print(f"{'artworks':>10} {'queries':>8} {'median ms':>10}")
+    for n in sizes:
+        queries, ms = run(n)
+        print(f'{n:>10} {queries:>8} {ms:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
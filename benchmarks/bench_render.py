@@ -0,0 +1,109 @@
+# Template rendering benchmark - how long a fresh worker takes to get every template ready
+# (compiling from source, then loading from the bytecode cache when one is configured), and
+# how long each page takes to render for a signed-in visitor, without touching the database.
+#
+# Usage: python benchmarks/bench_render.py [renders per page, default 2000]
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE'] = DB_PATH
+
+from flask import render_template  # noqa: E402
+
+from app import create_app, init_db  # noqa: E402
+
+app = create_app()
+
+LOAD_REPEATS = 5
+
+CARD = ('<a href="/artwork/{0}"><picture><img src="/static/uploads/{0}.jpg" alt="Artwork {0}" loading="lazy">'
+        '</picture></a><h3 class="art-title">Artwork {0}</h3><p class="caption">by user{0}</p>'
+        '<span class="like-count" id="like-count-{0}">{0}</span>')
+
+
+def artwork(i):
+    return {'artwork_id': i, 'user_id': i, 'title': f'Artwork {i}', 'description': 'Benchmark artwork',
+            'submission_date': '2025-06-01 12:00:00', 'image_path': f'uploads/{i:064x}.jpg', 'image_variants': None,
+            'like_count': i, 'artist_name': f'user{i}', 'rank': i, 'score': 100 - i}
+
+
+# Each page with the sort of context its route passes
+PAGES = {
+    'index.html': {'body': '<section class="common"><h1>Welcome</h1></section>', 'featured': ''},
+    'login.html': {},
+    'sign_up.html': {},
+    'submit.html': {},
+    'search.html': {'query': 'sun', 'results': []},
+    'gallery.html': {'cards': [(i, CARD.format(i)) for i in range(1, 25)], 'liked': {1, 5}, 'next_cursor': 'abc'},
+    'view.html': {'page': {'title': 'Artwork 1', 'user_id': 1, 'pending': 0, 'html': CARD.format(1)},
+                  'artwork_id': 1, 'user_liked': True},
+    'artist.html': {'profile': {'user_id': 1, 'username': 'user1', 'first_name': 'First', 'surname': 'Last',
+                                'totals': {'uploads': 3, 'likes': 30, 'comments': 4},
+                                'years': [{'year': '2025', 'uploads': 3, 'likes': 30, 'comments': 4,
+                                           'rank': 2, 'artists': 40}]},
+                    'cards': [(i, CARD.format(i)) for i in range(1, 25)], 'next_cursor': None, 'pending': 1},
+    'leaderboard.html': {'board': 'all', 'boards': ('all', 'year', 'hour', 'day'),
+                         'entries': [artwork(i) for i in range(1, 21)]},
+    'admin_approve.html': {'artworks': [artwork(i) for i in range(1, 51)], 'next_cursor': None, 'pending': 50},
+}
+
+
+# Seconds for a fresh environment to load every template, compiling or from the bytecode cache
+def load_all(bytecode_cache):
+    timings = []
+    for _ in range(LOAD_REPEATS):
+        env = app.create_jinja_environment()
+        env.filters.update(app.jinja_env.filters)  # Filters and globals added by init_app() hooks
+        env.globals.update(app.jinja_env.globals)
+        env.bytecode_cache = bytecode_cache
+        started = time.perf_counter()
+        for name in env.list_templates():
+            env.get_template(name)
+        timings.append(time.perf_counter() - started)
+    return min(timings), len(env.list_templates())
+
+
+def render_times(name, context, renders):
+    timings = []
+    with app.test_request_context('/'):
+        from flask import session
+        session['user_id'] = 1
+        session['username'] = 'user1'
+        render_template(name, **context)  # Compile (or load) outside the timing
+        for _ in range(renders):
+            started = time.perf_counter()
+            render_template(name, **context)
+            timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95)]
+
+
+def main():
+    renders = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with app.app_context():
+        init_db()
+
+    compile_seconds, count = load_all(None)
+    print(f'{count} templates: {compile_seconds * 1000:.1f} ms to compile from source')
+    cache = app.jinja_env.bytecode_cache
+    if cache is not None:
+        load_all(cache)  # Fill it
+        cached_seconds, _ = load_all(cache)
+        print(f'{count} templates: {cached_seconds * 1000:.1f} ms from the bytecode cache')
+
+    print(f"\n{'page':<20} {'median us':>10} {'p95 us':>10}")
+    total = 0
+    for name, context in PAGES.items():
+        median, p95 = render_times(name, context, renders)
+        total += median
+        print(f'{name:<20} {median * 1e6:>10.1f} {p95 * 1e6:>10.1f}')
+    print(f"{'all pages':<20} {total * 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
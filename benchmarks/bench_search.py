@@ -0,0 +1,89 @@
+# Search benchmark - seeds N approved artworks with random titles/descriptions into a throwaway
+# database and reports the median time of search.search_artworks() for a few typical queries.
+#
+# Usage: python benchmarks/bench_search.py [N ...]
+import os
+import sys
+import random
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE'] = DB_PATH
+
+from app import create_app, init_db  # noqa: E402
+from db import get_db  # noqa: E402
+import search  # noqa: E402
+
+app = create_app()
+
+USERS = 200
+REPEATS = 9
+WORDS = ('sunset bay harbour boats dawn mangrove pelican island jetty storm reef tide lighthouse '
+         'portrait abstract oil watercolour charcoal sketch study blue orange green gold quiet '
+         'morning evening coast river bridge market garden family memory light shadow').split()
+QUERIES = ['sunset', 'blue harb', 'li', 'watercolour storm coast', 'user17']
+
+# Real text follows Zipf's law: a few words are everywhere, most are rare. The themed words sit
+# just below the 100 commonest ("the", "and", ...) in a 20,000-word vocabulary drawn with weight
+# 1/rank, so each one turns up in a few percent of artworks - common, but not in half of them.
+FILLER = [f'w{i:x}' for i in range(20000 - len(WORDS))]
+VOCABULARY = FILLER[:100] + WORDS + FILLER[100:]
+WEIGHTS = [1 / rank for rank in range(1, len(VOCABULARY) + 1)]
+
+
+def sentence(n):
+    return ' '.join(random.choices(VOCABULARY, WEIGHTS, k=n))
+
+
+def seed(conn, n_artworks):
+    conn.execute('DELETE FROM Comments')
+    conn.execute('DELETE FROM Artworks')
+    conn.execute('DELETE FROM Users')
+    conn.executemany(
+        'INSERT INTO Users (user_id, username, email, password, first_name, surname) VALUES (?, ?, ?, ?, ?, ?)',
+        [(i, f'user{i}', f'user{i}@example.com', 'x', 'First', 'Last') for i in range(1, USERS + 1)]
+    )
+    conn.executemany(
+        'INSERT INTO Artworks (artwork_id, user_id, title, description, image_path, pending) VALUES (?, ?, ?, ?, ?, 0)',
+        [(i, random.randint(1, USERS), sentence(3).title(), sentence(25), 'images/logo.jpg')
+         for i in range(1, n_artworks + 1)]
+    )
+    conn.executemany(
+        'INSERT INTO Comments (artwork_id, user_id, comment) VALUES (?, ?, ?)',
+        [(random.randint(1, n_artworks), random.randint(1, USERS), sentence(12)) for _ in range(n_artworks)]
+    )
+    conn.commit()
+
+
+def run(n_artworks):
+    results = {}
+    with app.app_context():
+        conn = get_db()
+        seed(conn, n_artworks)
+        for query in QUERIES:
+            timings = []
+            for _ in range(REPEATS):
+                started = time.perf_counter()
+                search.search_artworks(conn, query)
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            results[query] = timings[len(timings) // 2] * 1000
+    return results
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+    with app.app_context():
+        init_db()
+
+    print(f"{'artworks':>10} " + ' '.join(f'{q[:12]:>13}' for q in QUERIES) + '   (median ms)')
+    for n in sizes:
+        results = run(n)
+        print(f'{n:>10} ' + ' '.join(f'{results[q]:>13.1f}' for q in QUERIES))
+
+
+if __name__ == '__main__':
+    main()
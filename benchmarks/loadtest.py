@@ -0,0 +1,541 @@
+# Load test for the whole site - seeds a synthetic database, drives a realistic mix of gallery
+# browsing, artwork views, like toggles, searches, logins and uploads from many concurrent
+# virtual users, and reports p50/p95/p99 latency and throughput per route.
+#
+# Usage:
+#   python benchmarks/loadtest.py run [--mix browse] [--concurrency 16] [--duration 30]
+#       Seeds a throwaway database and drives the app in-process through the Flask test client.
+#
+#   python benchmarks/loadtest.py seed --database /tmp/load.db [--artworks 20000 ...]
+#   DATABASE=/tmp/load.db CACHE_BACKEND=redis EVENTS_BACKEND=redis python serve.py --workers 4 &
+#   python benchmarks/loadtest.py run --url http://127.0.0.1:8000 --database /tmp/load.db
+#       Seeds a database for a real server, then drives that server over HTTP. The database is
+#       only read to pick artwork IDs and usernames. The server keeps its own login rate limits,
+#       so expect some 429s from /login unless they were raised. Without the Redis backends
+#       serve.py runs a single worker.
+#
+#   python benchmarks/loadtest.py compare old.json new.json [--tolerance 0.15]
+#       Compares two result files route by route; exits 1 if any p95 got worse by more than
+#       the tolerance, so it can gate a merge.
+#
+# Every run writes its results (with the git commit and the settings used) to
+# benchmarks/results/<commit>-<time>.json unless --output says otherwise.
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+import http.cookiejar
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'loadtest-password'
+UPLOAD_FOLDER = 'uploads/loadtest'  # Under static/, removed after an in-process run
+
+WORDS = ('sunset', 'harbour', 'portrait', 'forest', 'abstract', 'city', 'winter', 'garden', 'river',
+         'study', 'night', 'mountain', 'still', 'life', 'blue', 'red', 'golden', 'storm', 'bridge',
+         'market', 'dancer', 'window', 'shadow', 'light', 'sea', 'field', 'bird', 'horse', 'tower')
+
+# Relative weights of each action. Reads dominate, as they do on the live site.
+MIXES = {
+    'browse': {'gallery': 25, 'api_gallery': 15, 'artwork': 35, 'search': 10, 'like': 12, 'login': 2, 'upload': 1},
+    'write': {'gallery': 15, 'api_gallery': 5, 'artwork': 20, 'search': 5, 'like': 45, 'login': 5, 'upload': 5},
+    'read': {'gallery': 35, 'api_gallery': 20, 'artwork': 35, 'search': 10},
+}
+
+# Status each action is expected to answer with; anything else counts as an error
+EXPECTED = {'gallery': 200, 'api_gallery': 200, 'artwork': 200, 'search': 200, 'like': 200,
+            'login': 302, 'upload': 302}
+
+
+# --- Seeding ---
+
+def title(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 4))).title()
+
+
+def seed(conn, users, artworks, likes, comments, pending=0.02, password_hash='x', rng=None):
+    rng = rng or random.Random(1)
+    now = datetime.now()
+
+    def when(days):
+        return (now - timedelta(seconds=rng.uniform(0, days * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+
+    conn.executemany(
+        'INSERT INTO Users (user_id, username, email, password, first_name, surname) VALUES (?, ?, ?, ?, ?, ?)',
+        [(i, f'user{i}', f'user{i}@example.com', password_hash, 'Load', f'Tester{i}') for i in range(1, users + 1)]
+    )
+    conn.executemany(
+        'INSERT INTO Artworks (artwork_id, user_id, title, description, submission_date, image_path, pending) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        [(i, rng.randint(1, users), title(rng), f'A {rng.choice(WORDS)} piece in {rng.choice(WORDS)} tones.',
+          when(3 * 365), 'images/logo.jpg', int(rng.random() < pending))
+         for i in range(1, artworks + 1)]
+    )
+
+    # A few artworks get most of the likes, as on the real site
+    weights = [1 / rank for rank in range(1, artworks + 1)]
+    cumulative = []
+    total = 0
+    for w in weights:
+        total += w
+        cumulative.append(total)
+    order = list(range(1, artworks + 1))
+    rng.shuffle(order)
+    likes = min(likes, users * artworks)
+    pairs = set()
+    while len(pairs) < likes:
+        for artwork_id in rng.choices(order, cum_weights=cumulative, k=likes - len(pairs)):
+            pairs.add((rng.randint(1, users), artwork_id))
+    conn.executemany('INSERT INTO Likes (user_id, artwork_id, timestamp) VALUES (?, ?, ?)',
+                     [(u, a, when(365)) for u, a in pairs])
+
+    conn.executemany(
+        'INSERT INTO Comments (artwork_id, user_id, comment, timestamp) VALUES (?, ?, ?, ?)',
+        [(rng.choices(order, cum_weights=cumulative)[0], rng.randint(1, users),
+          f'Love the {rng.choice(WORDS)} in this one', when(365)) for _ in range(comments)]
+    )
+    conn.commit()
+
+
+def seed_database(app, args):
+    from werkzeug.security import generate_password_hash
+    from app import init_db
+    from db import get_db
+
+    started = time.perf_counter()
+    with app.app_context():
+        init_db()
+        password_hash = generate_password_hash(PASSWORD, method=app.config['PASSWORD_METHOD'])
+        seed(get_db(), args.users, args.artworks, args.likes, args.comments, args.pending, password_hash,
+             random.Random(args.seed))
+    print(f'Seeded {args.users} users, {args.artworks} artworks, {args.likes} likes, {args.comments} comments '
+          f'in {time.perf_counter() - started:.1f}s')
+
+
+def load_targets(database):
+    import sqlite3
+    conn = sqlite3.connect(database)
+    try:
+        artwork_ids = [row[0] for row in conn.execute('SELECT artwork_id FROM Artworks WHERE pending = 0')]
+        usernames = [row[0] for row in conn.execute('SELECT username FROM Users')]
+    finally:
+        conn.close()
+    if not artwork_ids or not usernames:
+        sys.exit(f'{database} has no approved artworks or users - run the seed command first')
+    return artwork_ids, usernames
+
+
+# --- Clients. Both answer request(method, path, data=None, files=None) -> (status, headers, body). ---
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, files=None):
+        if files:
+            data = dict(data or {})
+            for name, (filename, content) in files.items():
+                data[name] = (io.BytesIO(content), filename)
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.headers, response.get_data()
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                                  NoRedirect)
+
+    def request(self, method, path, data=None, files=None):
+        body = None
+        headers = {}
+        if files:
+            body, headers['Content-Type'] = multipart(data or {}, files)
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(req, timeout=30) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+
+def multipart(fields, files):
+    boundary = f'loadtest{random.getrandbits(64):x}'
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+# A small PNG with a random colour, so uploads aren't all deduplicated to one file
+def random_png(rng, size=64):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), tuple(rng.randrange(256) for _ in range(3))).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+# --- Virtual users ---
+
+class Recorder:
+    def __init__(self):
+        self.samples = []  # (action, status, seconds, ok, sql queries, sql ms)
+        self.lock = threading.Lock()
+        self.recording = False
+
+    def add(self, action, status, seconds, headers):
+        if not self.recording:
+            return
+        queries, sql_ms = server_timing(headers) if headers is not None else (None, None)
+        with self.lock:
+            self.samples.append((action, status, seconds, status == EXPECTED[action], queries, sql_ms))
+
+
+# Read the db entry of the Server-Timing header, if the server sends one
+def server_timing(headers):
+    if hasattr(headers, 'getlist'):
+        values = headers.getlist('Server-Timing')  # Werkzeug, from the test client
+    else:
+        values = headers.get_all('Server-Timing') or []  # http.client
+    for value in values:
+        if value.startswith('db;'):
+            fields = dict(part.split('=', 1) for part in value.split(';')[1:] if '=' in part)
+            try:
+                return int(fields.get('desc', '"0').strip('"').split()[0]), float(fields.get('dur', 0))
+            except ValueError:
+                return None, None
+    return None, None
+
+
+class VirtualUser:
+    def __init__(self, client, username, artwork_ids, recorder, rng):
+        self.client = client
+        self.username = username
+        self.artwork_ids = artwork_ids
+        self.recorder = recorder
+        self.rng = rng
+        self.cursor = None
+
+    def call(self, action, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            status, headers, body = self.client.request(method, path, **kwargs)
+        except OSError:
+            status, headers, body = 0, None, b''
+        self.recorder.add(action, status, time.perf_counter() - started, headers)
+        return status, body
+
+    def gallery(self):
+        self.call('gallery', 'GET', '/gallery')
+
+    # Page through the JSON gallery, going back to the start now and then
+    def api_gallery(self):
+        path = '/api/gallery'
+        if self.cursor and self.rng.random() < 0.8:
+            path += f'?after={self.cursor}'
+        status, body = self.call('api_gallery', 'GET', path)
+        self.cursor = json.loads(body).get('next') if status == 200 else None
+
+    def artwork(self):
+        self.call('artwork', 'GET', f'/artwork/{self.rng.choice(self.artwork_ids)}')
+
+    def search(self):
+        words = ' '.join(self.rng.sample(WORDS, self.rng.randint(1, 2)))
+        self.call('search', 'GET', f'/api/search?q={urllib.parse.quote(words)}')
+
+    def like(self):
+        self.call('like', 'POST', f'/like/{self.rng.choice(self.artwork_ids)}')
+
+    def login(self):
+        self.call('login', 'POST', '/login', data={'username': self.username, 'password': PASSWORD})
+
+    def upload(self):
+        self.call('upload', 'POST', '/upload', data={'title': title(self.rng), 'description': 'Load test upload'},
+                  files={'image': ('loadtest.png', random_png(self.rng))})
+
+
+def drive(make_client, usernames, artwork_ids, mix, concurrency, duration, warmup, requests, recorder, rng_seed):
+    actions = list(mix)
+    weights = [mix[a] for a in actions]
+    deadline = {}
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def take():
+        if not recorder.recording:
+            return True  # Still warming up
+        if requests is None:
+            return time.monotonic() < deadline['end']
+        with lock:
+            remaining[0] -= 1
+            return remaining[0] >= 0
+
+    def worker(n):
+        rng = random.Random(rng_seed + n)
+        user = VirtualUser(make_client(), usernames[n % len(usernames)], artwork_ids, recorder, rng)
+        user.login()
+        ready.wait()
+        while take():
+            getattr(user, rng.choices(actions, weights)[0])()
+
+    ready = threading.Event()
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    # Warm up (caches, pools, lazily started workers) before anything is recorded
+    ready.set()
+    time.sleep(warmup)
+    deadline['end'] = time.monotonic() + (duration or 0)
+    started = time.perf_counter()
+    recorder.recording = True
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+# --- Reporting ---
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def summarise(samples, elapsed):
+    by_action = {}
+    for sample in samples:
+        by_action.setdefault(sample[0], []).append(sample)
+
+    routes = {}
+    for action, rows in sorted(by_action.items()) + [('total', samples)]:
+        latencies = sorted(row[2] * 1000 for row in rows)
+        statuses = {}
+        for row in rows:
+            statuses[str(row[1])] = statuses.get(str(row[1]), 0) + 1
+        queries = [row[4] for row in rows if row[4] is not None]
+        sql_ms = [row[5] for row in rows if row[5] is not None]
+        routes[action] = {
+            'requests': len(rows),
+            'errors': sum(1 for row in rows if not row[3]),
+            'throughput_rps': round(len(rows) / elapsed, 2) if elapsed else 0,
+            'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'max_ms': round(latencies[-1], 3) if latencies else 0,
+            'sql_queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+            'sql_ms_mean': round(sum(sql_ms) / len(sql_ms), 3) if sql_ms else None,
+            'statuses': statuses,
+        }
+    return routes
+
+
+def print_table(routes):
+    print(f"{'route':<12} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'queries':>7}")
+    for action, r in routes.items():
+        queries = f"{r['sql_queries_mean']:.1f}" if r['sql_queries_mean'] is not None else '-'
+        print(f"{action:<12} {r['requests']:>8} {r['errors']:>6} {r['throughput_rps']:>8.1f} {r['p50_ms']:>8.2f} "
+              f"{r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} {queries:>7}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+# Routes whose p95 in `new` is worse than in `old` by more than `tolerance` (a fraction)
+def regressions(old, new, tolerance):
+    found = []
+    for action, result in new['routes'].items():
+        before = old['routes'].get(action)
+        if not before or not before['p95_ms']:
+            continue
+        change = result['p95_ms'] / before['p95_ms'] - 1
+        if change > tolerance:
+            found.append((action, before['p95_ms'], result['p95_ms'], change))
+    return found
+
+
+def print_comparison(old, new, tolerance):
+    print(f"{'route':<12} {'p95 before':>10} {'p95 after':>10} {'change':>8} {'req/s before':>12} {'req/s after':>11}")
+    for action, result in new['routes'].items():
+        before = old['routes'].get(action)
+        if not before:
+            continue
+        change = (result['p95_ms'] / before['p95_ms'] - 1) * 100 if before['p95_ms'] else 0
+        print(f"{action:<12} {before['p95_ms']:>10.2f} {result['p95_ms']:>10.2f} {change:>+7.1f}% "
+              f"{before['throughput_rps']:>12.1f} {result['throughput_rps']:>11.1f}")
+    found = regressions(old, new, tolerance)
+    for action, before, after, change in found:
+        print(f'REGRESSION: {action} p95 {before:.2f} ms -> {after:.2f} ms ({change * 100:+.0f}%)')
+    return found
+
+
+# --- Commands ---
+
+def parse_mix(text):
+    if text in MIXES:
+        return dict(MIXES[text])
+    mix = {}
+    for part in text.split(','):
+        action, _, weight = part.partition('=')
+        if action.strip() not in EXPECTED:
+            raise argparse.ArgumentTypeError(f"unknown action {action!r} (choose from {', '.join(EXPECTED)})")
+        mix[action.strip()] = float(weight or 1)
+    return mix
+
+
+def add_seed_arguments(parser):
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--artworks', type=int, default=10000)
+    parser.add_argument('--likes', type=int, default=100000)
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--pending', type=float, default=0.02, help='Fraction of artworks left pending')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed, for repeatable runs')
+
+
+def command_seed(args):
+    os.environ['DATABASE'] = os.path.abspath(args.database)
+    if os.path.exists(os.environ['DATABASE']):
+        sys.exit(f'{args.database} already exists - remove it or pick another path')
+    from app import create_app
+    seed_database(create_app(), args)
+
+
+def command_run(args):
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+
+    if args.url:
+        if not args.database:
+            sys.exit('--url needs --database, the file the server is using, to pick artworks and users')
+        artwork_ids, usernames = load_targets(args.database)
+        duration = drive(lambda: HTTPClient(args.url), usernames, artwork_ids, args.mix, args.concurrency,
+                         args.duration, args.warmup, args.requests, recorder, args.seed)
+        target = args.url
+    else:
+        workdir = tempfile.mkdtemp()
+        os.environ['DATABASE'] = os.path.join(workdir, 'load.db')
+        from app import create_app
+        app = create_app({
+            'UPLOAD_FOLDER': UPLOAD_FOLDER,
+            # Every virtual user logs in from the same address
+            'LOGIN_RATE_PER_IP': 1e9, 'LOGIN_BURST_PER_IP': 1e9,
+            'LOGIN_RATE_PER_USERNAME': 1e9, 'LOGIN_BURST_PER_USERNAME': 1e9,
+        })
+        seed_database(app, args)
+        artwork_ids, usernames = load_targets(os.environ['DATABASE'])
+        try:
+            duration = drive(lambda: TestClient(app), usernames, artwork_ids, args.mix, args.concurrency,
+                             args.duration, args.warmup, args.requests, recorder, args.seed)
+        finally:
+            shutil.rmtree(os.path.join(app.static_folder, UPLOAD_FOLDER), ignore_errors=True)
+            shutil.rmtree(workdir, ignore_errors=True)
+        target = 'test-client'
+
+    routes = summarise(recorder.samples, duration)
+    print_table(routes)
+
+    result = {
+        'commit': git_commit(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'target': target,
+        'settings': {
+            'mix': args.mix, 'concurrency': args.concurrency, 'duration': args.duration, 'requests': args.requests,
+            'warmup': args.warmup, 'users': args.users, 'artworks': args.artworks, 'likes': args.likes,
+            'comments': args.comments, 'seed': args.seed,
+        },
+        'elapsed_seconds': round(duration, 3),
+        'routes': routes,
+    }
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results',
+                                         f"{result['commit']}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'Results written to {output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            if print_comparison(json.load(f), result, args.tolerance):
+                sys.exit(1)
+
+
+def command_compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']}")
+    if print_comparison(old, new, args.tolerance):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the gallery app.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='Create and seed a database for a server to use')
+    seed_parser.add_argument('--database', required=True)
+    add_seed_arguments(seed_parser)
+    seed_parser.set_defaults(handler=command_seed)
+
+    run_parser = commands.add_parser('run', help='Drive the app and report latency per route')
+    add_seed_arguments(run_parser)
+    run_parser.add_argument('--mix', type=parse_mix, default='browse',
+                            help=f"A preset ({', '.join(MIXES)}) or weights like gallery=5,like=2")
+    run_parser.add_argument('--concurrency', type=int, default=16, help='Virtual users')
+    run_parser.add_argument('--duration', type=float, default=30, help='Seconds to record for')
+    run_parser.add_argument('--requests', type=int, help='Stop after this many requests instead of --duration')
+    run_parser.add_argument('--warmup', type=float, default=3, help='Seconds to run before recording')
+    run_parser.add_argument('--url', help='Drive a running server instead of the in-process test client')
+    run_parser.add_argument('--database', help="With --url, the server's database")
+    run_parser.add_argument('--output', help='Where to write the JSON results')
+    run_parser.add_argument('--baseline', help='Earlier results to compare against')
+    run_parser.add_argument('--tolerance', type=float, default=0.15, help='Allowed p95 slowdown, as a fraction')
+    run_parser.set_defaults(handler=command_run)
+
+    compare_parser = commands.add_parser('compare', help='Compare two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--tolerance', type=float, default=0.15)
+    compare_parser.set_defaults(handler=command_compare)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+from flask import current_app
+
+import signals
+
+# Cache for rendered page fragments.
+# Values must be JSON-serialisable (strings, lists, dicts) so they can live in a shared backend.
+#
+# Keys are invalidated precisely by the events in signals.py:
+#   card:<id>        one gallery card        - like (and its flush), approve, reject, new image variants
+#   artwork:<id>     the artwork page body   - like (and its flush), comment, approve, reject, new image variants
+#   gallery:<gen>:…  which artworks are on a gallery page - approve, reject (bumps the generation)
+#   page:index       the home page body      - TTL only
+
+
+# In-process LRU with a per-entry TTL, bounded by both entry count and total size
+class MemoryBackend:
+    def __init__(self, max_entries=2048, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (expires_at, size, value), oldest first
+        self._counters = {}  # Generation counters live outside the LRU so they are never evicted
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return entry[2]
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ttl):
+        size = len(value) if isinstance(value, str) else len(json.dumps(value))
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + ttl, size, value)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))  # Evict the least recently used
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._remove(key)
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        self._bytes -= self._data.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._data), 'bytes': self._bytes}
+
+
+# Shared backend so every worker process sees the same cache and the same invalidations
+class RedisBackend:
+    def __init__(self, url, prefix='georgie:'):
+        import redis  # Optional dependency, only needed for CACHE_BACKEND = 'redis'
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        values = self._redis.mget([self.prefix + key for key in keys])
+        return [json.loads(value) if value is not None else None for value in values]
+
+    def set(self, key, value, ttl):
+        self._redis.set(self.prefix + key, json.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, *keys):
+        if keys:
+            self._redis.delete(*[self.prefix + key for key in keys])
+
+    def counter(self, key):
+        return int(self._redis.get(self.prefix + key) or 0)
+
+    def incr(self, key):
+        return self._redis.incr(self.prefix + key)
+
+    def clear(self):
+        for key in self._redis.scan_iter(self.prefix + '*'):
+            self._redis.delete(key)
+
+    def stats(self):
+        return {'backend': 'redis'}
+
+
+class FragmentCache:
+    def __init__(self, backend, default_ttl=300, enabled=True):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def get_many(self, keys):
+        if not self.enabled:
+            return [None] * len(keys)
+        values = self.backend.get_many(keys)
+        found = sum(value is not None for value in values)
+        self.hits += found
+        self.misses += len(values) - found
+        return values
+
+    def set(self, key, value, ttl=None):
+        if self.enabled:
+            self.backend.set(key, value, ttl or self.default_ttl)
+
+    def delete(self, *keys):
+        self.backend.delete(*keys)
+
+    # Return the cached value for key, calling make() and caching its result on a miss
+    def cached(self, key, make, ttl=None):
+        value = self.get(key)
+        if value is None:
+            value = make()
+            if value is not None:
+                self.set(key, value, ttl)
+        return value
+
+    # Generations let a whole family of keys (e.g. every gallery page) be dropped in one step
+    def generation(self, namespace):
+        if not self.enabled:
+            return 0
+        return self.backend.counter(f'gen:{namespace}')
+
+    def bump(self, namespace):
+        self.backend.incr(f'gen:{namespace}')
+
+    def stats(self):
+        return dict(self.backend.stats(), hits=self.hits, misses=self.misses)
+
+
+def get_cache():
+    return current_app.extensions['fragment_cache']
+
+
+# Event handlers - drop exactly the fragments an event made stale
+def _on_liked(app, artwork_id, **extra):
+    app.extensions['fragment_cache'].delete(f'card:{artwork_id}', f'artwork:{artwork_id}')
+
+
+# Fragments re-rendered between a click and its flush still show the old like_count
+def _on_likes_flushed(app, artwork_ids, **extra):
+    keys = [f'{prefix}:{artwork_id}' for artwork_id in artwork_ids for prefix in ('card', 'artwork')]
+    app.extensions['fragment_cache'].delete(*keys)
+
+
+# Fragments rendered before the thumbnails were made only point at the original upload
+def _on_updated(app, artwork_id, **extra):
+    app.extensions['fragment_cache'].delete(f'card:{artwork_id}', f'artwork:{artwork_id}')
+
+
+def _on_comment(app, artwork_id, **extra):
+    app.extensions['fragment_cache'].delete(f'artwork:{artwork_id}')
+
+
+def _on_moderated(app, artwork_id, **extra):
+    cache = app.extensions['fragment_cache']
+    cache.delete(f'card:{artwork_id}', f'artwork:{artwork_id}')
+    cache.bump('gallery')
+
+
+def init_app(app):
+    app.config.setdefault('CACHE_ENABLED', True)
+    app.config.setdefault('CACHE_BACKEND', 'memory')  # 'memory' (one process only) or 'redis' (shared)
+    app.config.setdefault('CACHE_URL', 'redis://localhost:6379/0')
+    app.config.setdefault('CACHE_DEFAULT_TTL', 300)
+    app.config.setdefault('CACHE_MAX_ENTRIES', 2048)
+    app.config.setdefault('CACHE_MAX_BYTES', 32 * 1024 * 1024)
+
+    if app.config['CACHE_BACKEND'] == 'redis':
+        backend = RedisBackend(app.config['CACHE_URL'])
+    else:
+        backend = MemoryBackend(app.config['CACHE_MAX_ENTRIES'], app.config['CACHE_MAX_BYTES'])
+    app.extensions['fragment_cache'] = FragmentCache(
+        backend, app.config['CACHE_DEFAULT_TTL'], app.config['CACHE_ENABLED']
+    )
+
+    signals.artwork_liked.connect(_on_liked, app)
+    signals.likes_flushed.connect(_on_likes_flushed, app)
+    signals.comment_posted.connect(_on_comment, app)
+    signals.artwork_approved.connect(_on_moderated, app)
+    signals.artwork_rejected.connect(_on_moderated, app)
+    signals.artwork_updated.connect(_on_updated, app)
+    logging.info(f"Fragment cache ready ({app.config['CACHE_BACKEND']})")
@@ -0,0 +1,244 @@
+import os
+import zlib
+import logging
+import mimetypes
+import threading
+
+from flask import current_app, request, stream_template, get_flashed_messages
+from werkzeug.security import safe_join
+
+import db
+
+# brotli is optional - without it everything is still compressed, with gzip only
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response compression and streamed pages.
+#
+#  - HTML, JSON and other text responses of at least COMPRESS_MIN_SIZE bytes are compressed on the
+#    way out, with brotli or gzip - whichever the client's Accept-Encoding prefers. Smaller bodies
+#    (most like/comment API answers) go out as they are: they fit in a packet either way.
+#    Content-Length is set on the compressed body, so keep-alive connections stay reusable.
+#  - Streamed pages (stream_page below) are compressed as they stream, flushing the compressor at
+#    every chunk so the browser gets each part as soon as it is rendered. Server-Sent Event
+#    streams and files sent from disk are left alone.
+#  - Static text assets (style.css, ...) get .br/.gz siblings written once, by
+#    `flask --app app compress-assets` or serve.py's preload, and assets.serve_static sends those
+#    when the client accepts them - so they are never compressed per request.
+
+COMPRESSIBLE = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript', 'text/xml', 'text/csv',
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+}  # Not text/event-stream: each event must reach the browser the moment it is written
+
+# Content-Encoding -> file suffix for precompressed static siblings, in order of preference
+SIBLINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def available_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+# The encoding to answer this request with, or None for an uncompressed body
+def negotiate(encodings=None):
+    return request.accept_encodings.best_match(encodings or available_encodings())
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 = gzip header and trailer
+    return compressor.compress(data) + compressor.flush()
+
+
+# Compress an iterable of chunks, flushing after each one so nothing waits for the end of the page
+def compress_stream(chunks, encoding, level, stats):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    size = compressed = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if not chunk:
+                continue
+            size += len(chunk)
+            out = process(chunk) + flush()
+            compressed += len(out)
+            yield out
+        out = finish()
+        compressed += len(out)
+        yield out
+    finally:
+        stats.record(size, compressed)
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+class Compressor:
+    def __init__(self, app):
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.levels = {'gzip': app.config['COMPRESS_LEVEL'], 'br': app.config['COMPRESS_BROTLI_QUALITY']}
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def record(self, size, compressed):
+        with self._lock:
+            self.responses += 1
+            self.bytes_in += size
+            self.bytes_out += compressed
+
+    def after_request(self, response):
+        if response.mimetype not in COMPRESSIBLE:
+            return response
+        response.vary.add('Accept-Encoding')
+        if (response.status_code < 200 or response.status_code in (204, 206, 304)
+                or response.direct_passthrough or 'Content-Encoding' in response.headers
+                or response.cache_control.no_transform):
+            return response
+        streamed = response.is_streamed
+        if not streamed and response.calculate_content_length() < self.min_size:
+            return response
+        encoding = negotiate()
+        if encoding is None:
+            return response
+
+        level = self.levels[encoding]
+        if streamed:
+            response.response = compress_stream(response.response, encoding, level, self)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            compressed = compress(data, encoding, level)
+            if len(compressed) >= len(data):
+                return response
+            self.record(len(data), len(compressed))
+            response.set_data(compressed)  # Also sets Content-Length
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{encoding}', weak)  # A different body needs a different ETag
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                'encodings': list(available_encodings()),
+                'responses': self.responses,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
+
+
+# Join the template's small pieces into chunks of at least `size` bytes
+def _buffered(pieces, size):
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+# render_template for large pages - the response is sent while the template renders. Views must
+# have finished with the database first: the connection goes back to the pool here, rather than
+# being held until a slow client has downloaded the whole page.
+def stream_page(template_name, **context):
+    # Flashed messages are popped from the session now; the session is saved before the body renders
+    get_flashed_messages(with_categories=True)
+    db.close_db()
+    pieces = stream_template(template_name, **context)
+    return current_app.response_class(_buffered(pieces, current_app.config['STREAM_CHUNK_SIZE']),
+                                      mimetype='text/html')
+
+
+# The precompressed sibling of a static file to send instead of it, as (filename, encoding), or None.
+# A sibling older than its file is stale (the file was edited since) and not used.
+def precompressed(folder, filename):
+    if mimetypes.guess_type(filename)[0] not in COMPRESSIBLE:
+        return None
+    accepted = request.accept_encodings
+    ranked = sorted((s for s in SIBLINGS if accepted[s[0]]), key=lambda s: -accepted[s[0]])  # br first on a tie
+    if not ranked:
+        return None
+    path = safe_join(folder, filename)
+    if path is None:
+        return None
+    try:
+        modified = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    for encoding, suffix in ranked:
+        try:
+            if os.stat(path + suffix).st_mtime_ns >= modified:
+                return filename + suffix, encoding
+        except OSError:
+            continue
+    return None
+
+
+# Write .br/.gz siblings, at the highest settings, for every compressible static file worth it.
+# Uploads are skipped (they are images). Up-to-date siblings are left alone. Returns how many
+# files were written.
+def precompress_static(app):
+    folder = app.static_folder
+    skip = os.path.join(folder, app.config['UPLOAD_FOLDER'])
+    written = 0
+    for directory, subdirectories, files in os.walk(folder):
+        if directory == skip or directory.startswith(skip + os.sep):
+            subdirectories[:] = []
+            continue
+        for name in files:
+            path = os.path.join(directory, name)
+            if mimetypes.guess_type(name)[0] not in COMPRESSIBLE:
+                continue
+            stat = os.stat(path)
+            if stat.st_size < app.config['COMPRESS_MIN_SIZE']:
+                continue
+            data = None
+            for encoding, suffix in SIBLINGS:
+                if encoding == 'br' and brotli is None:
+                    continue
+                target = path + suffix
+                try:
+                    if os.stat(target).st_mtime_ns >= stat.st_mtime_ns:
+                        continue
+                except OSError:
+                    pass
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                compressed = compress(data, encoding, 11 if encoding == 'br' else 9)
+                if len(compressed) >= len(data):
+                    continue
+                temporary = f'{target}.{os.getpid()}.tmp'
+                with open(temporary, 'wb') as f:
+                    f.write(compressed)
+                os.replace(temporary, target)
+                written += 1
+    return written
+
+
+def init_app(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024)        # Smaller bodies aren't worth compressing
+    app.config.setdefault('COMPRESS_LEVEL', 6)              # gzip level for responses (1-9)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)     # brotli quality for responses (0-11)
+    app.config.setdefault('STREAM_CHUNK_SIZE', 4096)        # Bytes of a streamed page sent at a time
+
+    compressor = Compressor(app)
+    app.extensions['compression'] = compressor
+    app.after_request(compressor.after_request)
+    logging.info(f"Response compression: {', '.join(available_encodings())}")
@@ -0,0 +1,162 @@
+import sqlite3
+import threading
+import queue
+import time
+import logging
+
+from flask import g, current_app
+
+
+# Raised when every pooled connection is busy for longer than DB_POOL_TIMEOUT
+class PoolTimeout(Exception):
+    pass
+
+
+# A small fixed-size pool of SQLite connections.
+# Connections are created lazily (up to `size`) and the PRAGMAs are applied once,
+# when the connection is opened, instead of on every request.
+class ConnectionPool:
+    def __init__(self, database, size=8, timeout=10.0, pragmas=None):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas or {}
+        self.factory = sqlite3.Connection  # metrics.py swaps in a connection class that times every statement
+        self._idle = queue.LifoQueue()  # LIFO so the warmest connection (hot page cache) is reused first
+        self._lock = threading.Lock()
+        self._all = []  # Every connection we have opened, so close_all() can find them
+        self._created = 0
+        self._in_use = 0
+        self._acquired = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+
+    # Open a new connection and tune it
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False, timeout=self.timeout, factory=self.factory)
+        conn.row_factory = sqlite3.Row  # This allows us to access columns by name
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    # Borrow a connection, blocking up to `timeout` seconds if the pool is exhausted
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+                with self._lock:
+                    self._all.append(conn)
+            else:
+                started = time.perf_counter()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise PoolTimeout(f"No database connection available after {self.timeout}s")
+                finally:
+                    with self._lock:
+                        self._waits += 1
+                        self._wait_time += time.perf_counter() - started
+
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+        return conn
+
+    # Give a connection back, discarding anything the request left uncommitted
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    def close_all(self):
+        with self._lock:
+            conns, self._all = self._all, []
+            self._created = 0
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        for conn in conns:
+            conn.close()
+
+    # Counters for the /stats/db endpoint
+    def stats(self):
+        with self._lock:
+            return {
+                'database': self.database,
+                'size': self.size,
+                'created': self._created,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                'acquired_total': self._acquired,
+                'waits_total': self._waits,
+                'wait_seconds_total': round(self._wait_time, 6),
+                'timeouts_total': self._timeouts,
+            }
+
+
+# Register the pool on the app and return connections at the end of each request
+def init_app(app):
+    app.config.setdefault('DATABASE', 'database.db')
+    app.config.setdefault('DB_POOL_SIZE', 8)
+    app.config.setdefault('DB_POOL_TIMEOUT', 10.0)
+    app.config.setdefault('DB_PRAGMAS', {
+        'journal_mode': 'WAL',       # Readers don't block the writer
+        'synchronous': 'NORMAL',     # Safe with WAL, far fewer fsyncs than FULL
+        'foreign_keys': 'ON',
+        'cache_size': -16000,        # ~16 MB page cache per connection
+        'mmap_size': 268435456,      # 256 MB memory-mapped reads
+        'temp_store': 'MEMORY',
+    })
+
+    app.extensions['db_pool'] = ConnectionPool(
+        app.config['DATABASE'],
+        size=app.config['DB_POOL_SIZE'],
+        timeout=app.config['DB_POOL_TIMEOUT'],
+        pragmas=app.config['DB_PRAGMAS'],
+    )
+    app.teardown_appcontext(close_db)
+    logging.info(f"Database pool ready: {app.config['DATABASE']} (size {app.config['DB_POOL_SIZE']})")
+
+
+def get_pool():
+    return current_app.extensions['db_pool']
+
+
+# Function to return the database connection for the current request.
+# The first call borrows a connection from the pool; later calls in the same request reuse it.
+def get_db():
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+
+# Teardown hook - hands the request's connection back to the pool
+def close_db(exception=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+
+
+def pool_stats():
+    return get_pool().stats()
@@ -0,0 +1,330 @@
+import json
+import time
+import asyncio
+import atexit
+import logging
+import threading
+from collections import deque
+
+from flask import current_app
+
+import db
+import models
+import signals
+
+# Live like counts and comments, pushed to open pages over Server-Sent Events (/events).
+#
+# A page subscribes to the artworks it shows. like_artwork and post_comment publish through
+# the signals in signals.py; one broadcaster thread per process collects what was published
+# and, at most once every EVENTS_COALESCE_SECONDS, sends each watched artwork's latest like
+# count (however many clicks there were) and any new comments. Each event is serialised once
+# and the same bytes are queued for every watcher, so a thousand viewers of one artwork cost
+# one JSON encode plus a thousand list appends.
+#
+# Streams are per process. With EVENTS_BACKEND = 'redis' every process publishes to a Redis
+# channel and feeds its own subscribers from it, so pre-forked workers see each other's events.
+#
+# Under WSGI each open stream holds a request thread, so a process serves at most
+# EVENTS_MAX_THREAD_STREAMS of them; large audiences belong on the asyncio server (asgi.py),
+# where a stream is just a coroutine.
+
+RETRY = b'retry: 3000\n\n'          # Browsers reconnect after 3 s if the stream drops
+KEEPALIVE = b': keepalive\n\n'      # Comment line, keeps proxies from closing an idle stream
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+def format_event(kind, data):
+    return f'event: {kind}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'.encode()
+
+
+# Parse ?artworks=1,2,3 into a list of IDs; raises ValueError
+def parse_artwork_ids(text, limit):
+    artwork_ids = sorted({int(part) for part in text.split(',') if part.strip()})
+    if not artwork_ids:
+        raise ValueError("Give the artworks to watch, e.g. ?artworks=1,2,3")
+    if len(artwork_ids) > limit:
+        raise ValueError(f"At most {limit} artworks per stream.")
+    return artwork_ids
+
+
+# One open stream. Messages are appended by the broadcaster thread and taken by the request
+# thread (get) or coroutine (get_async). A client too slow to keep up loses its oldest messages.
+class Subscriber:
+    def __init__(self, artwork_ids, max_queue, loop=None):
+        self.artwork_ids = frozenset(artwork_ids)
+        self._messages = deque(maxlen=max_queue)
+        self._ready = threading.Condition()
+        self._loop = loop
+        self._event = asyncio.Event() if loop is not None else None
+        self.dropped = 0
+
+    def put(self, message):
+        with self._ready:
+            if len(self._messages) == self._messages.maxlen:
+                self.dropped += 1
+            self._messages.append(message)
+            self._ready.notify()
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._event.set)
+            except RuntimeError:
+                pass  # The event loop has closed
+
+    def _drain(self):
+        messages = list(self._messages)
+        self._messages.clear()
+        return messages
+
+    # Wait up to `timeout` seconds; returns the queued messages, or [] on timeout
+    def get(self, timeout):
+        with self._ready:
+            if not self._messages:
+                self._ready.wait(timeout)
+            return self._drain()
+
+    async def get_async(self, timeout):
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._event.clear()
+        with self._ready:
+            return self._drain()
+
+
+class EventHub:
+    def __init__(self, app):
+        self.interval = app.config['EVENTS_COALESCE_SECONDS']
+        self.max_queue = app.config['EVENTS_MAX_QUEUE']
+        self.max_thread_streams = app.config['EVENTS_MAX_THREAD_STREAMS']
+        self.max_streams = app.config['EVENTS_MAX_STREAMS']
+        self.relay = RedisRelay(app.config['EVENTS_REDIS_URL'], self) if app.config['EVENTS_BACKEND'] == 'redis' else None
+
+        self._lock = threading.Lock()
+        self._watchers = {}     # artwork_id -> set of Subscribers
+        self._counts = {}       # artwork_id -> latest like_count, not yet sent
+        self._sent = {}         # artwork_id -> like_count last sent (for the delta)
+        self._comments = []     # (artwork_id, comment) not yet sent
+        self._streams = 0
+        self._thread_streams = 0
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.events_sent = 0
+        self.messages_queued = 0
+
+    # Started with the first stream, so a pre-fork parent never owns the thread
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='event-broadcaster', daemon=True)
+                self._thread.start()
+                if self.relay is not None:
+                    self.relay.start()
+                atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    # loop=None for a request thread that will block in get(); an event loop for get_async()
+    def subscribe(self, artwork_ids, loop=None):
+        subscriber = Subscriber(artwork_ids, self.max_queue, loop)
+        with self._lock:
+            if self._streams >= self.max_streams or (loop is None and self._thread_streams >= self.max_thread_streams):
+                raise TooManyStreams()
+            self._streams += 1
+            if loop is None:
+                self._thread_streams += 1
+            for artwork_id in subscriber.artwork_ids:
+                self._watchers.setdefault(artwork_id, set()).add(subscriber)
+        self._start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._streams -= 1
+            if subscriber._loop is None:
+                self._thread_streams -= 1
+            for artwork_id in subscriber.artwork_ids:
+                watchers = self._watchers.get(artwork_id)
+                if watchers is not None:
+                    watchers.discard(subscriber)
+                    if not watchers:
+                        del self._watchers[artwork_id]
+                        self._sent.pop(artwork_id, None)
+
+    def publish_like(self, artwork_id, like_count):
+        if self.relay is not None:
+            self.relay.publish('likes', {'artwork_id': artwork_id, 'like_count': like_count})
+        else:
+            self._queue_like(artwork_id, like_count)
+
+    def publish_comment(self, artwork_id, comment):
+        if self.relay is not None:
+            self.relay.publish('comment', dict(comment, artwork_id=artwork_id))
+        else:
+            self._queue_comment(artwork_id, comment)
+
+    def watched(self, artwork_id):
+        return self.relay is not None or artwork_id in self._watchers
+
+    def _queue_like(self, artwork_id, like_count):
+        with self._lock:
+            if artwork_id not in self._watchers:
+                return
+            self._counts[artwork_id] = like_count  # Replaces any count not yet sent
+        self._wake.set()
+
+    def _queue_comment(self, artwork_id, comment):
+        with self._lock:
+            if artwork_id not in self._watchers:
+                return
+            self._comments.append((artwork_id, comment))
+        self._wake.set()
+
+    # Wait for something to send, send it, then hold off for the coalescing interval
+    def _run(self):
+        while True:
+            self._wake.wait()
+            if self._stop.is_set():
+                return
+            self._wake.clear()
+            try:
+                self._deliver()
+            except Exception:
+                logging.exception("Event delivery failed")
+            self._stop.wait(self.interval)
+
+    def _deliver(self):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            comments, self._comments = self._comments, []
+            deliveries = []
+            for artwork_id, like_count in counts.items():
+                previous = self._sent.get(artwork_id)
+                if previous == like_count:
+                    continue
+                self._sent[artwork_id] = like_count
+                data = {'artwork_id': artwork_id, 'like_count': like_count,
+                        'delta': like_count - previous if previous is not None else None}
+                deliveries.append((artwork_id, format_event('likes', data)))
+            for artwork_id, comment in comments:
+                deliveries.append((artwork_id, format_event('comment', dict(comment, artwork_id=artwork_id))))
+            deliveries = [(message, list(self._watchers.get(artwork_id, ()))) for artwork_id, message in deliveries]
+
+        for message, watchers in deliveries:
+            for subscriber in watchers:
+                subscriber.put(message)
+            self.events_sent += 1
+            self.messages_queued += len(watchers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'redis' if self.relay is not None else 'memory',
+                'streams': self._streams,
+                'thread_streams': self._thread_streams,
+                'watched_artworks': len(self._watchers),
+                'events_sent_total': self.events_sent,
+                'messages_queued_total': self.messages_queued,
+            }
+
+
+# Carries published events between processes over one Redis pub/sub channel
+class RedisRelay:
+    def __init__(self, url, hub, channel='georgie:events'):
+        import redis  # Optional dependency, only needed for EVENTS_BACKEND = 'redis'
+        self._redis = redis.Redis.from_url(url)
+        self.hub = hub
+        self.channel = channel
+        self._thread = None
+
+    def publish(self, kind, data):
+        try:
+            self._redis.publish(self.channel, json.dumps({'kind': kind, 'data': data}))
+        except Exception as e:
+            logging.warning(f"Could not publish {kind} event: {e}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._listen, name='event-relay', daemon=True)
+        self._thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    event = json.loads(message['data'])
+                    data = event['data']
+                    if event['kind'] == 'likes':
+                        self.hub._queue_like(data['artwork_id'], data['like_count'])
+                    else:
+                        self.hub._queue_comment(data.pop('artwork_id'), data)
+            except Exception as e:
+                logging.warning(f"Event relay lost its Redis connection ({e}); reconnecting")
+                time.sleep(1)
+
+
+# The body of an SSE response, for a request thread
+def stream(hub, subscriber, keepalive):
+    try:
+        yield RETRY
+        while True:
+            messages = subscriber.get(keepalive)
+            yield b''.join(messages) if messages else KEEPALIVE
+    finally:
+        hub.unsubscribe(subscriber)
+
+
+# The same, for the asyncio server
+async def stream_async(hub, subscriber, keepalive):
+    try:
+        yield RETRY
+        while True:
+            messages = await subscriber.get_async(keepalive)
+            yield b''.join(messages) if messages else KEEPALIVE
+    finally:
+        hub.unsubscribe(subscriber)
+
+
+# Event handlers - publish what the routes did
+def _on_liked(app, artwork_id, like_count, **extra):
+    app.extensions['events'].publish_like(artwork_id, like_count)
+
+
+def _on_comment(app, artwork_id, comment_id, **extra):
+    hub = app.extensions['events']
+    if hub.watched(artwork_id):
+        comment = models.get_comment(db.get_db(), comment_id)
+        if comment is not None:
+            del comment['user_id']
+            comment['cursor'] = models.encode_comment_cursor(comment)  # Where the page's catch-up fetch resumes
+            hub.publish_comment(artwork_id, comment)
+
+
+def init_app(app):
+    app.config.setdefault('EVENTS_BACKEND', 'memory')       # 'memory' (one process) or 'redis' (shared)
+    app.config.setdefault('EVENTS_REDIS_URL', app.config.get('CACHE_URL', 'redis://localhost:6379/0'))
+    app.config.setdefault('EVENTS_COALESCE_SECONDS', 1.0)   # At most one like-count update per artwork this often
+    app.config.setdefault('EVENTS_KEEPALIVE', 15)           # Seconds between keep-alive comments on idle streams
+    app.config.setdefault('EVENTS_MAX_ARTWORKS', 100)       # Artworks one stream may watch
+    app.config.setdefault('EVENTS_MAX_QUEUE', 256)          # Messages held for a slow client before dropping
+    app.config.setdefault('EVENTS_MAX_STREAMS', 10000)      # Open streams per process
+    app.config.setdefault('EVENTS_MAX_THREAD_STREAMS', 4)   # Of those, streams holding a WSGI request thread
+
+    app.extensions['events'] = EventHub(app)
+    signals.artwork_liked.connect(_on_liked, app)
+    signals.comment_posted.connect(_on_comment, app)
+    logging.info(f"Live events ready ({app.config['EVENTS_BACKEND']})")
+
+
+def get_hub():
+    return current_app.extensions['events']
@@ -0,0 +1,196 @@
+import time
+import random
+import logging
+import threading
+
+from flask import current_app
+
+import db
+import signals
+
+# Featured artworks for the home page, without ORDER BY RANDOM().
+#
+# Each process keeps the approved artwork IDs in an array, alongside a Fenwick (binary indexed)
+# tree of their weights, so picking k of them costs O(k log n) whatever the archive size:
+#   - uniform: k random slots of the array
+#   - 'likes': each artwork drawn with probability proportional to like_count + 1
+# Approvals, rejections and likes made in this process update the array as they happen. Other
+# worker processes' changes arrive with the full reload every FEATURED_RELOAD_INTERVAL seconds.
+#
+# With FEATURED_ROTATE_SECONDS set, one selection is shown to everyone for that long (and its
+# rendered HTML is cached); 0 draws a fresh selection for every request.
+
+
+class WeightTree:
+    def __init__(self, weights=()):
+        self._tree = [0, *weights]  # 1-based; _tree[i] holds the sum of weights (i - lowbit(i), i]
+        for i in range(1, len(self._tree)):  # Build in O(n)
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self):
+        return len(self._tree) - 1
+
+    def prefix(self, i):
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def total(self):
+        return self.prefix(len(self))
+
+    def append(self, weight):
+        i = len(self._tree)
+        self._tree.append(weight + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+
+    # Drop the last slot; nothing else covers it, so the rest of the tree is unchanged
+    def pop(self):
+        self._tree.pop()
+
+    def add(self, i, delta):
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    # The slot where the running total of weights passes `target` (0 <= target < total)
+    def find(self, target):
+        position = 0
+        step = 1 << (len(self).bit_length())
+        while step:
+            nxt = position + step
+            if nxt < len(self._tree) and self._tree[nxt] <= target:
+                position = nxt
+                target -= self._tree[nxt]
+            step >>= 1
+        return position
+
+
+class FeaturedSampler:
+    def __init__(self, app):
+        self.app = app
+        self.reload_interval = app.config['FEATURED_RELOAD_INTERVAL']
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._ids = []         # slot -> artwork_id
+        self._weights = []     # slot -> like_count + 1
+        self._slots = {}       # artwork_id -> slot
+        self._tree = WeightTree()
+        self._loaded_at = None
+        self._random = random.Random()
+        self.reloads = 0
+
+    # Read every approved artwork (O(n), but only once per FEATURED_RELOAD_INTERVAL)
+    def reload(self):
+        with self.app.app_context():
+            rows = db.get_db().execute('SELECT artwork_id, like_count FROM Artworks WHERE pending = 0').fetchall()
+        ids = [row[0] for row in rows]
+        weights = [row[1] + 1 for row in rows]
+        tree = WeightTree(weights)
+        with self._lock:
+            self._ids, self._weights, self._tree = ids, weights, tree
+            self._slots = {artwork_id: slot for slot, artwork_id in enumerate(ids)}
+            self._loaded_at = time.monotonic()
+            self.reloads += 1
+
+    # One thread reloads a stale array while the others carry on sampling the old one
+    def _ensure_loaded(self):
+        loaded_at = self._loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at <= self.reload_interval:
+            return
+        if not self._reload_lock.acquire(blocking=loaded_at is None):
+            return
+        try:
+            if self._loaded_at is loaded_at:
+                self.reload()
+        finally:
+            self._reload_lock.release()
+
+    def add(self, artwork_id, like_count=0):
+        with self._lock:
+            if self._loaded_at is None or artwork_id in self._slots:
+                return
+            self._slots[artwork_id] = len(self._ids)
+            self._ids.append(artwork_id)
+            self._weights.append(like_count + 1)
+            self._tree.append(like_count + 1)
+
+    # Move the last slot into the removed one, so the array stays dense
+    def remove(self, artwork_id):
+        with self._lock:
+            slot = self._slots.pop(artwork_id, None)
+            if slot is None:
+                return
+            last = len(self._ids) - 1
+            if slot != last:
+                moved_id, moved_weight = self._ids[last], self._weights[last]
+                self._tree.add(slot, moved_weight - self._weights[slot])
+                self._ids[slot], self._weights[slot] = moved_id, moved_weight
+                self._slots[moved_id] = slot
+            self._tree.add(last, -self._weights[last])
+            self._tree.pop()
+            self._ids.pop()
+            self._weights.pop()
+
+    def set_likes(self, artwork_id, like_count):
+        with self._lock:
+            slot = self._slots.get(artwork_id)
+            if slot is not None:
+                self._tree.add(slot, like_count + 1 - self._weights[slot])
+                self._weights[slot] = like_count + 1
+
+    # Up to k distinct approved artwork IDs
+    def sample(self, k, weighting='uniform'):
+        self._ensure_loaded()
+        with self._lock:
+            k = min(k, len(self._ids))
+            if weighting != 'likes':
+                return [self._ids[slot] for slot in self._random.sample(range(len(self._ids)), k)]
+
+            # Weighted without replacement: zero each pick's weight while drawing the rest
+            picked = []
+            for _ in range(k):
+                slot = self._tree.find(self._random.randrange(self._tree.total()))
+                picked.append(slot)
+                self._tree.add(slot, -self._weights[slot])
+            for slot in picked:
+                self._tree.add(slot, self._weights[slot])
+            return [self._ids[slot] for slot in picked]
+
+    def stats(self):
+        with self._lock:
+            return {'artworks': len(self._ids), 'reloads_total': self.reloads}
+
+
+# Event handlers - keep the array in step with this process's changes
+def _on_approved(app, artwork_id, **extra):
+    app.extensions['featured'].add(artwork_id)
+
+
+def _on_rejected(app, artwork_id, **extra):
+    app.extensions['featured'].remove(artwork_id)
+    app.extensions['fragment_cache'].bump('featured')  # Don't keep showing it for the rest of the rotation
+
+
+def _on_liked(app, artwork_id, like_count, **extra):
+    app.extensions['featured'].set_likes(artwork_id, like_count)
+
+
+def init_app(app):
+    app.config.setdefault('FEATURED_COUNT', 3)                 # Artworks on the home page
+    app.config.setdefault('FEATURED_WEIGHTING', 'likes')       # 'uniform' or 'likes'
+    app.config.setdefault('FEATURED_ROTATE_SECONDS', 60)       # Keep one selection this long (0 = every request)
+    app.config.setdefault('FEATURED_RELOAD_INTERVAL', 600)     # Seconds between full reloads of the ID array
+
+    app.extensions['featured'] = FeaturedSampler(app)
+    signals.artwork_approved.connect(_on_approved, app)
+    signals.artwork_rejected.connect(_on_rejected, app)
+    signals.artwork_liked.connect(_on_liked, app)
+    logging.info(f"Featured artworks: {app.config['FEATURED_COUNT']}, {app.config['FEATURED_WEIGHTING']} weighting")
+
+
+def get_sampler():
+    return current_app.extensions['featured']
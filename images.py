@@ -0,0 +1,125 @@
+import os
+import json
+import atexit
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app, url_for
+
+import db
+import models
+import signals
+
+# Pillow is optional - without it uploads still work, the gallery just serves the originals
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+# Resize one uploaded image into every variant width, as WebP plus a JPEG/PNG fallback.
+# Runs in a worker process, so it only takes plain values and returns a plain dict:
+#   {'thumb': {'width': 320, 'webp': 'uploads/x_thumb.webp', 'fallback': 'uploads/x_thumb.jpg'}, ...}
+# Re-encoding drops EXIF/GPS and other metadata; the EXIF rotation is applied first.
+def make_variants(static_folder, image_path, widths, quality=82):
+    stem = os.path.splitext(image_path)[0]
+    variants = {}
+
+    with Image.open(os.path.join(static_folder, image_path)) as original:
+        original = ImageOps.exif_transpose(original)
+        has_alpha = original.mode in ('RGBA', 'LA') or (original.mode == 'P' and 'transparency' in original.info)
+        original = original.convert('RGBA' if has_alpha else 'RGB')
+        fallback_ext, fallback_format = ('png', 'PNG') if has_alpha else ('jpg', 'JPEG')
+
+        for name, width in sorted(widths.items(), key=lambda item: item[1]):
+            if variants and variants[last]['width'] == original.width:
+                break  # Never upscale - the previous variant is already full size
+            width = min(width, original.width)
+            height = max(1, round(original.height * width / original.width))
+            resized = original.resize((width, height), Image.LANCZOS)
+
+            webp_path = f'{stem}_{name}.webp'
+            fallback_path = f'{stem}_{name}.{fallback_ext}'
+            resized.save(os.path.join(static_folder, webp_path), 'WEBP', quality=quality, method=4)
+            resized.save(os.path.join(static_folder, fallback_path), fallback_format,
+                         quality=quality, optimize=True, progressive=True)
+            variants[name] = {'width': width, 'webp': webp_path, 'fallback': fallback_path}
+            last = name
+
+    return variants
+
+
+# Hands uploads to a pool of worker processes so request threads never wait on resizing
+class ImagePipeline:
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config['IMAGE_WORKERS']
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            atexit.register(self.shutdown)
+        return self._executor
+
+    # Queue the variants for an artwork. With IMAGE_WORKERS = 0 the work is done inline.
+    def submit(self, artwork_id, image_path):
+        if Image is None:
+            logging.warning("Pillow is not installed - skipping image variants")
+            return None
+
+        args = (self.app.static_folder, image_path, self.app.config['IMAGE_VARIANT_WIDTHS'],
+                self.app.config['IMAGE_QUALITY'])
+        if not self.workers:
+            self._save(artwork_id, make_variants(*args))
+            return None
+
+        future = self._get_executor().submit(make_variants, *args)
+        future.add_done_callback(lambda f: self._done(artwork_id, image_path, f))
+        return future
+
+    def _done(self, artwork_id, image_path, future):
+        try:
+            variants = future.result()
+        except Exception as e:
+            logging.error(f"Image processing failed for '{image_path}': {e}")
+            return
+        self._save(artwork_id, variants)
+
+    # Record the variant paths on the artwork (runs in the app process, so it can use the pool),
+    # then let cached fragments that still show the original know they are stale
+    def _save(self, artwork_id, variants):
+        with self.app.app_context():
+            models.set_image_variants(db.get_db(), artwork_id, json.dumps(variants))
+        signals.artwork_updated.send(self.app, artwork_id=artwork_id)
+        logging.info(f"Image variants ready for artwork {artwork_id}: {', '.join(variants)}")
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+# Build a srcset attribute value from an artwork's image_variants JSON.
+# fmt is 'webp' or 'fallback'. Returns '' when the variants haven't been made yet.
+def srcset(variants, fmt='fallback'):
+    if not variants:
+        return ''
+    if isinstance(variants, str):
+        variants = json.loads(variants)
+    return ', '.join(
+        f"{url_for('static', filename=v[fmt])} {v['width']}w"
+        for v in sorted(variants.values(), key=lambda v: v['width'])
+    )
+
+
+def init_app(app):
+    app.config.setdefault('IMAGE_WORKERS', 2)
+    app.config.setdefault('IMAGE_QUALITY', 82)
+    app.config.setdefault('IMAGE_VARIANT_WIDTHS', {'thumb': 320, 'medium': 800, 'full': 1600})
+    app.extensions['image_pipeline'] = ImagePipeline(app)
+    app.add_template_filter(srcset)
+
+
+def get_pipeline():
+    return current_app.extensions['image_pipeline']
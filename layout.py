@@ -0,0 +1,78 @@
+import os
+import time
+import logging
+
+from flask import current_app, session
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+# The page layout shared by every template (templates/base.html) and what keeps it cheap.
+#
+#  - Compiled templates are kept on disk in TEMPLATE_CACHE_DIR as Jinja bytecode, so a new
+#    worker (or one started by a reload) loads them instead of parsing and compiling each one
+#    on its first request. `flask --app app compile-templates` fills the cache at build time;
+#    serve.py's preload reads it before forking.
+#  - The parts of the layout that are the same for every visitor of a kind - the <head> links,
+#    the masthead and the nav bar (one per guest / member / admin) - are rendered once per
+#    process and reused for LAYOUT_CACHE_SECONDS, through chrome() in base.html. Flash messages
+#    and the greeting are per visitor and rendered every time.
+
+CHROME = ('head', 'masthead', 'nav')  # templates/fragments/<name>.html
+
+
+def nav_variant():
+    if 'user_id' not in session:
+        return 'guest'
+    return 'admin' if session.get('user_type') == 'admin' else 'member'
+
+
+class Chrome:
+    def __init__(self, app):
+        self.ttl = app.config['LAYOUT_CACHE_SECONDS']
+        self._rendered = {}  # (name, variant) -> (Markup, rendered_at)
+        self.hits = 0
+        self.misses = 0
+
+    # {{ chrome('nav') }} - one of the CHROME fragments, rendered on first use and then reused
+    def __call__(self, name):
+        if name not in CHROME:
+            raise ValueError(f"Unknown layout fragment {name!r}")
+        variant = nav_variant() if name == 'nav' else None
+        key = (name, variant)
+        entry = self._rendered.get(key)
+        now = time.monotonic()
+        if entry is not None and now - entry[1] < self.ttl:
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        html = Markup(current_app.jinja_env.get_template(f'fragments/{name}.html').render(variant=variant))
+        if self.ttl:
+            self._rendered[key] = (html, now)
+        return html
+
+    def stats(self):
+        return {'fragments': len(self._rendered), 'hits': self.hits, 'misses': self.misses}
+
+
+# Load every template, so the bytecode cache holds them all. Returns how many there are.
+def compile_templates(app):
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def init_app(app):
+    app.config.setdefault('TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'jinja-cache'))  # None = no cache
+    app.config.setdefault('LAYOUT_CACHE_SECONDS', 0 if app.debug else 300)  # Reuse rendered nav etc. this long
+
+    directory = app.config['TEMPLATE_CACHE_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+    chrome = Chrome(app)
+    app.extensions['layout'] = chrome
+    app.add_template_global(chrome, 'chrome')
+    logging.info(f"Template bytecode cache: {directory or 'off'}")
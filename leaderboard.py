@@ -0,0 +1,405 @@
+import time
+import bisect
+import logging
+import threading
+from collections import deque
+
+from flask import current_app
+
+import db
+from featured import WeightTree
+
+# People's Choice leaderboard: artworks ranked by likes, all time, this competition year and
+# over rolling windows (LEADERBOARD_WINDOWS, e.g. the last hour), answered from memory.
+#
+# Each board is a ScoreBoard - a Fenwick tree counting how many artworks have each score, plus
+# the artworks at each score kept sorted - so "rank of artwork X" is one prefix sum, O(log n),
+# and the top N are sliced off the highest scores with O(log n) per distinct score.
+#
+# Boards follow the database rather than the like buttons, so every worker process sees every
+# process's likes: at most every LEADERBOARD_SYNC_INTERVAL seconds a request catches its process
+# up on new Likes rows (like_id > the last one seen) and on the LikeRemovals log, which a trigger
+# fills as likes are deleted (unlikes, rejections). Likes reach the Likes table with the
+# next batch from likes.py, so a click shows up here within a second or two.
+#
+# Every LEADERBOARD_SNAPSHOT_INTERVAL seconds one process writes the all-time and yearly scores,
+# with the feed position they reflect, to LeaderboardScores. A restarted worker loads that and
+# replays only the feed since, instead of counting every like again. Rolling windows are short,
+# so they are always rebuilt from the Likes timestamp index.
+#
+# YearRanks answers the profile and artwork-stats ranks (artists by their likes in a competition
+# year, artworks among that year's approved ones) from ScoreBoards too, instead of a COUNT(*)
+# per read. A year's boards are read in one indexed scan when first asked for and re-read once
+# they are LEADERBOARD_YEAR_RANK_TTL seconds old, so a rank can trail the like count that long.
+
+YEAR_BOARDS = ('all', 'year')
+
+
+class ScoreBoard:
+    def __init__(self, scores=None):
+        scores = {artwork_id: score for artwork_id, score in (scores or {}).items() if score > 0}
+        counts = [0] * (max(scores.values(), default=0) + 1)
+        self._buckets = {}     # score -> sorted list of the artwork_ids with that score
+        for artwork_id, score in scores.items():
+            counts[score] += 1
+            self._buckets.setdefault(score, []).append(artwork_id)
+        for bucket in self._buckets.values():
+            bucket.sort()
+        self._scores = scores  # artwork_id -> score; artworks at 0 aren't kept
+        self._tree = WeightTree(counts)  # slot s = how many artworks have score s
+
+    def __len__(self):
+        return len(self._scores)
+
+    def score(self, artwork_id):
+        return self._scores.get(artwork_id, 0)
+
+    def add(self, artwork_id, delta):
+        old = self._scores.get(artwork_id, 0)
+        new = max(0, old + delta)
+        if new == old:
+            return
+        if old:
+            self._tree.add(old, -1)
+            bucket = self._buckets[old]
+            del bucket[bisect.bisect_left(bucket, artwork_id)]
+            if not bucket:
+                del self._buckets[old]
+        if new:
+            while len(self._tree) <= new:
+                self._tree.append(0)
+            self._tree.add(new, 1)
+            bisect.insort(self._buckets.setdefault(new, []), artwork_id)
+            self._scores[artwork_id] = new
+        else:
+            del self._scores[artwork_id]
+
+    # 1 + the number of artworks with a higher score (ties share a rank)
+    def rank(self, artwork_id):
+        score = self._scores.get(artwork_id, 0)
+        return 1 + len(self._scores) - self._tree.prefix(score + 1)
+
+    # [(artwork_id, score, rank)] from the offset-th highest score down; ties by artwork_id
+    def top(self, limit, offset=0):
+        entries = []
+        position = len(self._scores) - offset  # Artworks not yet passed, counting from the lowest score
+        while position > 0 and len(entries) < limit:
+            score = self._tree.find(position - 1)
+            at_or_below = self._tree.prefix(score + 1)
+            rank = 1 + len(self._scores) - at_or_below
+            bucket = self._buckets[score]
+            skip = at_or_below - position
+            for artwork_id in bucket[skip:skip + limit - len(entries)]:
+                entries.append((artwork_id, score, rank))
+            position -= len(bucket) - skip
+        return entries
+
+    def scores(self):
+        return dict(self._scores)
+
+
+# The last `seconds` of likes: a board plus the likes in it, oldest first, to expire
+class RollingWindow:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.board = ScoreBoard()
+        self._order = deque()  # (timestamp, like_id)
+        self._live = {}        # like_id -> artwork_id, for likes still in the window
+
+    def cutoff(self, now):
+        return _timestamp(now - self.seconds)
+
+    def add(self, like_id, artwork_id, timestamp):
+        self._order.append((timestamp, like_id))
+        self._live[like_id] = artwork_id
+        self.board.add(artwork_id, 1)
+
+    def remove(self, like_id):
+        artwork_id = self._live.pop(like_id, None)
+        if artwork_id is not None:
+            self.board.add(artwork_id, -1)
+
+    def expire(self, now):
+        cutoff = self.cutoff(now)
+        while self._order and self._order[0][0] < cutoff:
+            self.remove(self._order.popleft()[1])
+
+
+# Likes.timestamp is SQLite's CURRENT_TIMESTAMP: UTC, 'YYYY-MM-DD HH:MM:SS'
+def _timestamp(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+
+def _current_year(now):
+    return time.strftime('%Y', time.gmtime(now))
+
+
+class Leaderboard:
+    def __init__(self, app):
+        self.app = app
+        self.sync_interval = app.config['LEADERBOARD_SYNC_INTERVAL']
+        self.snapshot_interval = app.config['LEADERBOARD_SNAPSHOT_INTERVAL']
+        self.retention = app.config['LEADERBOARD_FEED_RETENTION']
+        self.window_seconds = dict(app.config['LEADERBOARD_WINDOWS'])
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._boards = {}
+        self._windows = {}
+        self._like_cursor = 0       # Highest like_id applied
+        self._removal_cursor = 0    # Highest LikeRemovals.removal_id applied
+        self._year = None
+        self._synced_at = None
+        self._snapshot_at = time.monotonic()
+        self.syncs = 0
+        self.loads = 0
+        self.snapshots = 0
+
+    @property
+    def boards(self):
+        return (*YEAR_BOARDS, *self.window_seconds)
+
+    def _board(self, name):
+        if name in self._windows:
+            return self._windows[name].board
+        if name in self._boards:
+            return self._boards[name]
+        raise ValueError(f"Unknown leaderboard {name!r} - one of {', '.join(self.boards)}")
+
+    def top(self, board, limit, offset=0):
+        self._ensure_current()
+        with self._lock:
+            return self._board(board).top(limit, offset)
+
+    # (rank, score, artworks with any likes) for one artwork on one board
+    def rank(self, board, artwork_id):
+        self._ensure_current()
+        with self._lock:
+            scores = self._board(board)
+            return scores.rank(artwork_id), scores.score(artwork_id), len(scores)
+
+    # One request thread syncs while the others read the boards as they are
+    def _ensure_current(self):
+        synced_at = self._synced_at
+        if synced_at is not None and time.monotonic() - synced_at <= self.sync_interval:
+            return
+        if not self._sync_lock.acquire(blocking=synced_at is None):
+            return
+        try:
+            if self._synced_at is synced_at:
+                self.sync()
+        finally:
+            self._sync_lock.release()
+
+    def sync(self):
+        now = time.time()
+        idle = self._synced_at is not None and time.monotonic() - self._synced_at > self.retention / 2
+        with self.app.app_context():
+            conn = db.get_db()
+            conn.execute('BEGIN')  # One read snapshot for everything below
+            try:
+                if self._synced_at is None or idle:  # The removal log may have been pruned past us
+                    self._load(conn, now)
+                else:
+                    self._catch_up(conn, now)
+            finally:
+                conn.rollback()
+        with self._lock:
+            for window in self._windows.values():
+                window.expire(now)
+        self._synced_at = time.monotonic()
+        self.syncs += 1
+
+        if self.snapshot_interval and time.monotonic() - self._snapshot_at > self.snapshot_interval:
+            self._snapshot_at = time.monotonic()
+            threading.Thread(target=self._snapshot_quietly, name='leaderboard-snapshot', daemon=True).start()
+
+    # Fill every board: the yearly ones from the last snapshot plus the feed since (or by
+    # counting, if there is no usable snapshot), the rolling windows from the Likes index
+    def _load(self, conn, now):
+        year = _current_year(now)
+        state = dict(conn.execute('SELECT key, value FROM LeaderboardState').fetchall())
+        if state.get('year') == year:
+            boards = {name: {} for name in YEAR_BOARDS}
+            for board, artwork_id, score in conn.execute('SELECT board, artwork_id, score FROM LeaderboardScores'):
+                if board in boards:
+                    boards[board][artwork_id] = score
+            like_cursor, removal_cursor = int(state['like_cursor']), int(state['removal_cursor'])
+        else:
+            boards = {
+                'all': dict(conn.execute('SELECT artwork_id, like_count FROM Artworks WHERE like_count > 0')),
+                'year': dict(conn.execute('SELECT artwork_id, COUNT(*) FROM Likes WHERE timestamp >= ? '
+                                          'GROUP BY artwork_id', (f'{year}-01-01',))),
+            }
+            like_cursor = conn.execute('SELECT COALESCE(MAX(like_id), 0) FROM Likes').fetchone()[0]
+            removal_cursor = conn.execute('SELECT COALESCE(MAX(removal_id), 0) FROM LikeRemovals').fetchone()[0]
+
+        windows = {name: RollingWindow(seconds) for name, seconds in self.window_seconds.items()}
+        for window in windows.values():
+            for like_id, artwork_id, timestamp in conn.execute(
+                    'SELECT like_id, artwork_id, timestamp FROM Likes WHERE timestamp >= ? AND like_id <= ? '
+                    'ORDER BY timestamp, like_id', (window.cutoff(now), like_cursor)):
+                window.add(like_id, artwork_id, timestamp)
+
+        with self._lock:
+            self._boards = {name: ScoreBoard(scores) for name, scores in boards.items()}
+            self._windows = windows
+            self._like_cursor, self._removal_cursor, self._year = like_cursor, removal_cursor, year
+        self._catch_up(conn, now)
+        self.loads += 1
+
+    # Apply likes added and removed since the cursors. A removal only counts against a like
+    # this process had already seen; one added and removed in between was never counted.
+    def _catch_up(self, conn, now):
+        year = _current_year(now)
+        added = conn.execute('SELECT like_id, artwork_id, timestamp FROM Likes WHERE like_id > ? ORDER BY like_id',
+                             (self._like_cursor,)).fetchall()
+        removed = conn.execute('SELECT removal_id, like_id, artwork_id, liked_at FROM LikeRemovals '
+                               'WHERE removal_id > ? ORDER BY removal_id', (self._removal_cursor,)).fetchall()
+        with self._lock:
+            if year != self._year:  # New competition year - nobody has any likes in it yet
+                self._boards['year'] = ScoreBoard()
+                self._year = year
+            counted = self._like_cursor
+            for like_id, artwork_id, timestamp in added:
+                self._boards['all'].add(artwork_id, 1)
+                if timestamp >= f'{year}-01-01':
+                    self._boards['year'].add(artwork_id, 1)
+                for window in self._windows.values():
+                    if timestamp >= window.cutoff(now):
+                        window.add(like_id, artwork_id, timestamp)
+                self._like_cursor = like_id
+            for removal_id, like_id, artwork_id, liked_at in removed:
+                if like_id <= counted:
+                    self._boards['all'].add(artwork_id, -1)
+                    if liked_at is not None and liked_at >= f'{year}-01-01':
+                        self._boards['year'].add(artwork_id, -1)
+                for window in self._windows.values():
+                    window.remove(like_id)
+                self._removal_cursor = removal_id
+
+    def _snapshot_quietly(self):
+        try:
+            self.snapshot()
+        except Exception:
+            logging.exception("Leaderboard snapshot failed")
+
+    # Save the yearly boards and the feed position they reflect, unless another process has
+    # saved a newer one; then drop removal-log entries older than LEADERBOARD_FEED_RETENTION
+    def snapshot(self):
+        with self._snapshot_lock:
+            with self._lock:
+                if self._synced_at is None:
+                    return False
+                state = {'like_cursor': self._like_cursor, 'removal_cursor': self._removal_cursor,
+                         'year': self._year, 'taken_at': time.time()}
+                boards = {name: self._boards[name].scores() for name in YEAR_BOARDS}
+
+            with self.app.app_context():
+                conn = db.get_db()
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    saved = dict(conn.execute('SELECT key, value FROM LeaderboardState').fetchall())
+                    if saved.get('year') == state['year'] and int(saved.get('like_cursor', 0)) >= state['like_cursor'] \
+                            and int(saved.get('removal_cursor', 0)) >= state['removal_cursor']:
+                        conn.rollback()
+                        return False
+                    conn.execute('DELETE FROM LeaderboardScores')
+                    conn.executemany('INSERT INTO LeaderboardScores (board, artwork_id, score) VALUES (?, ?, ?)',
+                                     [(name, artwork_id, score) for name, scores in boards.items()
+                                      for artwork_id, score in scores.items()])
+                    conn.executemany('INSERT OR REPLACE INTO LeaderboardState (key, value) VALUES (?, ?)',
+                                     [(key, str(value)) for key, value in state.items()])
+                    conn.execute('DELETE FROM LikeRemovals WHERE removed_at < ? AND removal_id <= ?',
+                                 (_timestamp(state['taken_at'] - self.retention), state['removal_cursor']))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+        self.snapshots += 1
+        logging.info(f"Leaderboard snapshot saved at like {state['like_cursor']}")
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'boards': {name: len(self._board(name)) for name in self.boards if self._synced_at is not None},
+                'like_cursor': self._like_cursor,
+                'removal_cursor': self._removal_cursor,
+                'syncs_total': self.syncs,
+                'loads_total': self.loads,
+                'snapshots_total': self.snapshots,
+            }
+
+
+# Ranks within a competition year (the year of submission_date), from ArtistStats and Artworks
+class YearRanks:
+    QUERIES = {
+        'artists': 'SELECT user_id, likes FROM ArtistStats WHERE year = ?',
+        'artworks': 'SELECT artwork_id, like_count FROM Artworks '
+                    'WHERE substr(submission_date, 1, 4) = ? AND pending = 0',
+    }
+
+    def __init__(self, app):
+        self.app = app
+        self.ttl = app.config['LEADERBOARD_YEAR_RANK_TTL']
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._boards = {}  # (kind, year) -> (ScoreBoard, entries including those at 0, loaded_at)
+        self.loads = 0
+
+    # (rank, artists that year) for an artist's likes in `year`
+    def artist(self, year, user_id):
+        board, entries = self._get('artists', year)
+        rank = board.rank(user_id)
+        return rank, max(rank, entries)  # An artist new to the year isn't on a board read before they were
+
+    # Rank of an approved artwork among the approved artworks submitted in `year`
+    def artwork(self, year, artwork_id):
+        board, entries = self._get('artworks', year)
+        return board.rank(artwork_id)
+
+    # One thread re-reads a stale year while the others use it as it is
+    def _get(self, kind, year):
+        key = (kind, year)
+        entry = self._boards.get(key)
+        if entry is not None and time.monotonic() - entry[2] <= self.ttl:
+            return entry[:2]
+        if not self._refresh_lock.acquire(blocking=entry is None):
+            return entry[:2]
+        try:
+            if self._boards.get(key) is entry:
+                with self.app.app_context():
+                    scores = dict(db.get_db().execute(self.QUERIES[kind], (year,)).fetchall())
+                entry = (ScoreBoard(scores), len(scores), time.monotonic())
+                with self._lock:
+                    self._boards[key] = entry
+                self.loads += 1
+            return self._boards[key][:2]
+        finally:
+            self._refresh_lock.release()
+
+    def stats(self):
+        with self._lock:
+            return {'year_boards': len(self._boards), 'year_loads_total': self.loads}
+
+
+def init_app(app):
+    app.config.setdefault('LEADERBOARD_WINDOWS', {'hour': 3600, 'day': 86400})  # Rolling boards, in seconds
+    app.config.setdefault('LEADERBOARD_SYNC_INTERVAL', 1.0)        # Seconds between catching up on new likes
+    app.config.setdefault('LEADERBOARD_SNAPSHOT_INTERVAL', 300)    # Seconds between saved snapshots (0 = never)
+    app.config.setdefault('LEADERBOARD_FEED_RETENTION', 86400)     # Seconds of removed likes kept for catching up
+    app.config.setdefault('LEADERBOARD_SIZE', 20)                  # Artworks on the leaderboard page
+    app.config.setdefault('LEADERBOARD_YEAR_RANK_TTL', 30)         # Seconds before a year's profile ranks are re-read
+
+    app.extensions['leaderboard'] = Leaderboard(app)
+    app.extensions['year_ranks'] = YearRanks(app)
+    logging.info(f"Leaderboard ready ({', '.join(app.extensions['leaderboard'].boards)})")
+
+
+def get_leaderboard():
+    return current_app.extensions['leaderboard']
+
+
+def get_year_ranks():
+    return current_app.extensions['year_ranks']
@@ -0,0 +1,330 @@
+import os
+import glob
+import json
+import time
+import atexit
+import sqlite3
+import logging
+import threading
+
+from flask import current_app
+
+import db
+import models
+import signals
+
+# Write-batching like service.
+#
+# A like/unlike is applied to an in-memory table straight away and the new count is returned
+# from memory. A background thread writes the accumulated changes to the Likes table in one
+# transaction every LIKE_FLUSH_INTERVAL seconds, so a voting spike takes SQLite's write lock
+# a few times a second instead of once per click.
+#
+# Every change is appended to a journal file before it is acknowledged. If the process dies
+# before a flush, the journal is replayed on the next start. Entries hold the final state
+# (liked or not), so replaying one twice is harmless. Each process writes its own
+# journal (<LIKE_JOURNAL>.<pid>), and only journals of processes that are gone are replayed.
+#
+# Counts are per process; they are re-read from Artworks.like_count after LIKE_COUNT_TTL
+# seconds, and reconcile() rebuilds like_count from COUNT(*) every LIKE_RECONCILE_INTERVAL.
+
+
+class ArtworkNotFound(LookupError):
+    pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class LikeService:
+    def __init__(self, app):
+        self.app = app
+        self.flush_interval = app.config['LIKE_FLUSH_INTERVAL']
+        self.count_ttl = app.config['LIKE_COUNT_TTL']
+        self.reconcile_interval = app.config['LIKE_RECONCILE_INTERVAL']
+        self.journal_base = app.config['LIKE_JOURNAL']
+        self.fsync = app.config['LIKE_JOURNAL_FSYNC']
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}     # (user_id, artwork_id) -> liked, only for pairs that differ from the database
+        self._deltas = {}      # artwork_id -> net change to like_count in _pending
+        self._flushing = {}    # The batch being written, until it commits ...
+        self._flushing_deltas = {}  # ... and its net changes
+        self._counts = {}      # artwork_id -> (like_count, loaded_at)
+        self._journal = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.flushes = 0
+        self.flushed_ops = 0
+        self.failed_flushes = 0
+
+    # Worked out on use rather than in __init__, so a forked worker gets its own file
+    @property
+    def journal_path(self):
+        return f'{self.journal_base}.{os.getpid()}'
+
+    # Like or unlike. Returns (is_liked, like_count) without writing to the database.
+    def toggle(self, conn, user_id, artwork_id):
+        key = (user_id, artwork_id)
+        self._start()
+
+        # Database reads happen outside the lock (they never wait for the writer in WAL mode)
+        with self._lock:
+            liked_now = self._state(key)
+            need_count = self._fresh_count(artwork_id) is None
+        if liked_now is None:
+            liked_now = models.has_liked(conn, user_id, artwork_id)
+        db_count = None
+        if need_count:
+            row = conn.execute('SELECT like_count FROM Artworks WHERE artwork_id = ?', (artwork_id,)).fetchone()
+            if row is None:
+                raise ArtworkNotFound(artwork_id)
+            db_count = row['like_count']
+
+        with self._lock:
+            # Another request for the same pair may have got in while we were reading
+            state = self._state(key)
+            if state is not None:
+                liked_now = state
+            count = self._fresh_count(artwork_id)
+            loaded_at = self._counts[artwork_id][1] if count is not None else time.monotonic()
+            if count is None:
+                # like_count doesn't include changes that haven't been flushed yet.
+                # (A flush landing between the read and here can skew this by a vote or two;
+                # the TTL and reconcile() put it right.)
+                count = (db_count if db_count is not None else self._counts[artwork_id][0]) \
+                    + self._deltas.get(artwork_id, 0) + self._flushing_deltas.get(artwork_id, 0)
+
+            liked = not liked_now
+            delta = 1 if liked else -1
+            count = max(0, count + delta)
+            self._write_journal(user_id, artwork_id, liked)
+            if key in self._pending:
+                del self._pending[key]  # Toggled back to what the database has - nothing to write
+            else:
+                self._pending[key] = liked
+            self._deltas[artwork_id] = self._deltas.get(artwork_id, 0) + delta
+            if not self._deltas[artwork_id]:
+                del self._deltas[artwork_id]
+            self._counts[artwork_id] = (count, loaded_at)
+        return liked, count
+
+    # Overlay not-yet-flushed changes on liked ids read from the database
+    def liked_ids(self, conn, user_id, artwork_ids):
+        liked = models.get_liked_ids(conn, user_id, artwork_ids)
+        with self._lock:
+            for artwork_id in artwork_ids:
+                state = self._state((user_id, artwork_id))
+                if state is True:
+                    liked.add(artwork_id)
+                elif state is False:
+                    liked.discard(artwork_id)
+        return liked
+
+    def has_liked(self, conn, user_id, artwork_id):
+        with self._lock:
+            state = self._state((user_id, artwork_id))
+        return models.has_liked(conn, user_id, artwork_id) if state is None else state
+
+    # Call with self._lock held
+    def _fresh_count(self, artwork_id):
+        entry = self._counts.get(artwork_id)
+        if entry and time.monotonic() - entry[1] < self.count_ttl:
+            return entry[0]
+        return None
+
+    # Like state not yet in the database, or None. Call with self._lock held
+    def _state(self, key):
+        state = self._pending.get(key)
+        return self._flushing.get(key) if state is None else state
+
+    # Call with self._lock held
+    def _write_journal(self, user_id, artwork_id, liked):
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', buffering=1)
+        self._journal.write(json.dumps([user_id, artwork_id, liked]) + '\n')
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    # Write everything pending to the Likes table in one transaction. Returns how many changes.
+    def flush(self):
+        with self._flush_lock:
+            journal_path = self.journal_path
+            flushing_path = journal_path + '.flushing'
+
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, {}
+                deltas, self._deltas = self._deltas, {}
+                self._flushing, self._flushing_deltas = batch, deltas
+                # New changes go to a fresh journal; this batch's stays until it has committed
+                if self._journal is not None:
+                    self._journal.close()
+                    self._journal = None
+                if os.path.exists(journal_path):
+                    if os.path.exists(flushing_path):  # Left by a failed flush - keep it, in order
+                        with open(flushing_path, 'a') as older, open(journal_path) as newer:
+                            older.write(newer.read())
+                        os.remove(journal_path)
+                    else:
+                        os.replace(journal_path, flushing_path)
+
+            try:
+                with self.app.app_context():
+                    self._apply(db.get_db(), batch)
+            except Exception:
+                self.failed_flushes += 1
+                with self._lock:
+                    for key, liked in batch.items():
+                        if key in self._pending:
+                            del self._pending[key]  # A newer click undid it
+                        else:
+                            self._pending[key] = liked
+                    for artwork_id, delta in deltas.items():
+                        self._deltas[artwork_id] = self._deltas.get(artwork_id, 0) + delta
+                        if not self._deltas[artwork_id]:
+                            del self._deltas[artwork_id]
+                    self._flushing, self._flushing_deltas = {}, {}
+                raise
+
+            with self._lock:
+                self._flushing, self._flushing_deltas = {}, {}
+
+            if os.path.exists(flushing_path):
+                os.remove(flushing_path)
+            self.flushes += 1
+            self.flushed_ops += len(batch)
+
+        signals.likes_flushed.send(self.app, artwork_ids={artwork_id for _, artwork_id in batch})
+        return len(batch)
+
+    # INSERT OR IGNORE / DELETE are idempotent, so a batch (or a replayed journal) can be applied twice
+    def _apply(self, conn, batch):
+        added = [key for key, liked in batch.items() if liked]
+        removed = [key for key, liked in batch.items() if not liked]
+        try:
+            conn.executemany('INSERT OR IGNORE INTO Likes (user_id, artwork_id) VALUES (?, ?)', added)
+            conn.executemany('DELETE FROM Likes WHERE user_id = ? AND artwork_id = ?', removed)
+            conn.commit()
+        except sqlite3.IntegrityError:
+            # Usually an artwork rejected since the click - apply one by one and drop the bad ones
+            conn.rollback()
+            for user_id, artwork_id in added:
+                try:
+                    conn.execute('INSERT OR IGNORE INTO Likes (user_id, artwork_id) VALUES (?, ?)',
+                                 (user_id, artwork_id))
+                except sqlite3.IntegrityError:
+                    logging.warning(f"Dropping like of missing artwork {artwork_id} by user {user_id}")
+            conn.executemany('DELETE FROM Likes WHERE user_id = ? AND artwork_id = ?', removed)
+            conn.commit()
+
+    # Apply journals left behind by processes that died before flushing
+    def replay_journals(self):
+        journals = {}
+        for path in glob.glob(glob.escape(self.journal_base) + '.*'):
+            pid = path[len(self.journal_base) + 1:].split('.')[0]
+            if pid.isdigit() and (int(pid) == os.getpid() or not _pid_alive(int(pid))):
+                journals.setdefault(int(pid), []).append(path)
+
+        replayed = 0
+        for paths in journals.values():
+            batch = {}
+            for path in sorted(paths, key=lambda p: not p.endswith('.flushing')):  # .flushing is older
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            user_id, artwork_id, liked = json.loads(line)
+                        except ValueError:
+                            break  # Torn last line from the crash
+                        batch[(user_id, artwork_id)] = liked
+            if batch:
+                with self.app.app_context():
+                    self._apply(db.get_db(), batch)
+                replayed += len(batch)
+            for path in paths:
+                os.remove(path)
+
+        if replayed:
+            logging.info(f"Replayed {replayed} unflushed likes from the journal")
+        return replayed
+
+    # Rebuild Artworks.like_count from the Likes table and forget cached counts
+    def reconcile(self):
+        self.flush()
+        with self.app.app_context():
+            conn = db.get_db()
+            fixed = conn.execute('''
+                UPDATE Artworks
+                SET like_count = (SELECT COUNT(*) FROM Likes WHERE Likes.artwork_id = Artworks.artwork_id)
+                WHERE like_count != (SELECT COUNT(*) FROM Likes WHERE Likes.artwork_id = Artworks.artwork_id)
+            ''').rowcount
+            conn.commit()
+        with self._lock:
+            self._counts.clear()
+        if fixed:
+            logging.warning(f"Reconciled like_count on {fixed} artworks")
+        return fixed
+
+    # The flusher thread starts on the first like, so CLI commands and
+    # pre-fork parents never own a thread
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='like-flusher', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def _run(self):
+        last_reconcile = time.monotonic()
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                if self.reconcile_interval and time.monotonic() - last_reconcile > self.reconcile_interval:
+                    self.reconcile()
+                    last_reconcile = time.monotonic()
+            except Exception:
+                logging.exception("Like flush failed; will retry")
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'cached_counts': len(self._counts),
+                'flushes_total': self.flushes,
+                'flushed_likes_total': self.flushed_ops,
+                'failed_flushes_total': self.failed_flushes,
+            }
+
+
+def init_app(app):
+    app.config.setdefault('LIKE_FLUSH_INTERVAL', 0.25)       # Seconds between batched writes
+    app.config.setdefault('LIKE_COUNT_TTL', 30)              # Seconds before an in-memory count is re-read
+    app.config.setdefault('LIKE_RECONCILE_INTERVAL', 900)    # Seconds between like_count rebuilds (0 = never)
+    app.config.setdefault('LIKE_JOURNAL', app.config['DATABASE'] + '.likes-journal')
+    app.config.setdefault('LIKE_JOURNAL_FSYNC', False)       # True survives power loss, not just a crash
+
+    service = LikeService(app)
+    app.extensions['likes'] = service
+    try:
+        service.replay_journals()
+    except sqlite3.Error as e:
+        logging.error(f"Could not replay the like journal yet: {e}")
+
+
+def get_service():
+    return current_app.extensions['likes']
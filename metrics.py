@@ -0,0 +1,271 @@
+import time
+import sqlite3
+import logging
+import threading
+import contextvars
+
+from flask import g, request, current_app
+
+# Request and SQL instrumentation.
+#
+#  - Every SQL statement run through the pool is timed by InstrumentedConnection. The count and
+#    time are added up per request, so an N+1 shows up as a high query count on one endpoint.
+#  - Statements slower than SLOW_QUERY_MS are logged with their parameters.
+#  - Each response gets a Server-Timing header (total time, SQL time and query count), which
+#    browser dev tools show in the network panel.
+#  - /metrics serves latency and query histograms per endpoint, plus the pool, cache and like
+#    counters, in the Prometheus text format. The numbers are per worker process.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SQL_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+# SQL totals for the request being handled. A context variable rather than g, so database calls
+# made on aiodb's threads (which run with a copy of the request's context) are counted too.
+_request_sql = contextvars.ContextVar('request_sql', default=None)
+
+
+class RequestSQL:
+    __slots__ = ('queries', 'seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, labels=()):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.labels = labels
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted(self._series.items())
+            items = [(labels, list(series)) for labels, series in items]
+        for label_values, series in items:
+            labels = ','.join(f'{k}="{_escape(v)}"' for k, v in zip(self.labels, label_values))
+            prefix = labels + ',' if labels else ''
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series[-1]}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {series[-2]:.6f}')
+            lines.append(f'{self.name}_count{suffix} {series[-1]}')
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    def __init__(self, app):
+        self.app = app
+        self.slow_query_seconds = app.config['SLOW_QUERY_MS'] / 1000
+        self.server_timing = app.config['METRICS_SERVER_TIMING']
+        endpoint = ('endpoint', 'method', 'status')
+        self.request_seconds = Histogram('http_request_duration_seconds', 'Time to produce a response.',
+                                         LATENCY_BUCKETS, endpoint)
+        self.request_queries = Histogram('http_request_sql_queries', 'SQL statements run per request.',
+                                         QUERY_COUNT_BUCKETS, endpoint)
+        self.request_sql_seconds = Histogram('http_request_sql_seconds', 'Time spent in SQL per request.',
+                                             LATENCY_BUCKETS, endpoint)
+        self.sql_seconds = Histogram('sql_statement_duration_seconds', 'Time per SQL statement.', SQL_BUCKETS)
+        self.slow_queries = 0
+
+    # Called by InstrumentedCursor after every statement, from any thread
+    def record_sql(self, sql, params, elapsed):
+        totals = _request_sql.get()
+        if totals is not None:
+            totals.queries += 1
+            totals.seconds += elapsed
+        self.sql_seconds.observe(elapsed)
+        if elapsed >= self.slow_query_seconds:
+            self.slow_queries += 1
+            logging.warning(f"Slow query ({elapsed * 1000:.1f} ms): {' '.join(sql.split())} -- params {_short(params)}")
+
+    def before_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_token = _request_sql.set(RequestSQL())
+
+    def after_request(self, response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        totals = _request_sql.get() or RequestSQL()
+
+        rule = request.url_rule
+        labels = (rule.endpoint if rule is not None else 'unmatched', request.method, str(response.status_code))
+        self.request_seconds.observe(elapsed, *labels)
+        self.request_queries.observe(totals.queries, *labels)
+        self.request_sql_seconds.observe(totals.seconds, *labels)
+
+        if self.server_timing:
+            response.headers.add('Server-Timing', f'db;dur={totals.seconds * 1000:.2f};desc="{totals.queries} queries"')
+            response.headers.add('Server-Timing', f'app;dur={elapsed * 1000:.2f}')
+        return response
+
+    def teardown_request(self, exception=None):
+        token = g.pop('metrics_token', None)
+        if token is not None:
+            _request_sql.reset(token)
+
+    # Everything for /metrics, in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        for histogram in (self.request_seconds, self.request_queries, self.request_sql_seconds, self.sql_seconds):
+            lines += histogram.render()
+        lines += _counter('sql_slow_queries_total', 'Statements slower than SLOW_QUERY_MS.', self.slow_queries)
+
+        extensions = self.app.extensions
+        pool = extensions['db_pool'].stats()
+        lines += _gauge('db_pool_connections_in_use', 'Pooled connections lent out.', pool['in_use'])
+        lines += _gauge('db_pool_connections_idle', 'Pooled connections waiting.', pool['idle'])
+        lines += _counter('db_pool_waits_total', 'Times a request waited for a connection.', pool['waits_total'])
+        lines += _counter('db_pool_timeouts_total', 'Times a request gave up waiting.', pool['timeouts_total'])
+        if 'fragment_cache' in extensions:
+            stats = extensions['fragment_cache'].stats()
+            lines += _counter('fragment_cache_hits_total', 'Fragment cache hits.', stats['hits'])
+            lines += _counter('fragment_cache_misses_total', 'Fragment cache misses.', stats['misses'])
+        if 'likes' in extensions:
+            stats = extensions['likes'].stats()
+            lines += _gauge('likes_pending', 'Likes not yet written to the database.', stats['pending'])
+            lines += _counter('likes_flushes_total', 'Batched like writes.', stats['flushes_total'])
+            lines += _counter('likes_failed_flushes_total', 'Batched like writes that failed.',
+                              stats['failed_flushes_total'])
+        if 'upload_collector' in extensions:
+            stats = extensions['upload_collector'].stats()
+            lines += _counter('upload_gc_removed_total', 'Orphaned upload files deleted.', stats['removed_total'])
+            lines += _counter('upload_gc_freed_bytes_total', 'Bytes freed by deleting orphaned uploads.',
+                              stats['freed_bytes_total'])
+        if 'events' in extensions:
+            stats = extensions['events'].stats()
+            lines += _gauge('events_streams_open', 'Open Server-Sent Event streams.', stats['streams'])
+            lines += _counter('events_sent_total', 'Coalesced events sent (each to every watcher).',
+                              stats['events_sent_total'])
+        if 'leaderboard' in extensions:
+            stats = extensions['leaderboard'].stats()
+            lines += _counter('leaderboard_syncs_total', 'Times the leaderboards caught up on new likes.',
+                              stats['syncs_total'])
+            lines += _counter('leaderboard_snapshots_total', 'Leaderboard snapshots saved.', stats['snapshots_total'])
+        if 'compression' in extensions:
+            stats = extensions['compression'].stats()
+            lines += _counter('compressed_responses_total', 'Responses sent gzip or brotli compressed.',
+                              stats['responses'])
+            lines += _counter('compression_bytes_in_total', 'Bytes of those responses before compression.',
+                              stats['bytes_in'])
+            lines += _counter('compression_bytes_out_total', 'Bytes of those responses as sent.', stats['bytes_out'])
+        if 'password_hasher' in extensions:
+            lines += _counter('password_hasher_rejected_total', 'Hashes refused because the pool was full.',
+                              extensions['password_hasher'].rejected)
+        return '\n'.join(lines) + '\n'
+
+
+def _counter(name, help_text, value):
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} counter', f'{name} {value}']
+
+
+def _gauge(name, help_text, value):
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+
+
+def _short(params, limit=200):
+    text = repr(params)
+    return text if len(text) <= limit else text[:limit] + '…'
+
+
+# Cursor that times each statement and its fetches
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.connection.metrics.record_sql(sql, params, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            self.connection.metrics.record_sql(sql, '(executemany)', time.perf_counter() - started)
+
+    def executescript(self, script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            self.connection.metrics.record_sql(script, '(script)', time.perf_counter() - started)
+
+    # Rows are stepped out of SQLite as they are fetched, so that time is SQL time too
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+    def _timed_fetch(self, fetch, *args):
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            totals = _request_sql.get()
+            if totals is not None:
+                totals.seconds += time.perf_counter() - started
+
+
+# sqlite3.Connection.execute() doesn't go through cursor(), so each shortcut is routed explicitly
+class InstrumentedConnection(sqlite3.Connection):
+    metrics = None  # Set on the per-app subclass made by connection_factory()
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+
+def connection_factory(metrics):
+    return type('InstrumentedConnection', (InstrumentedConnection,), {'metrics': metrics})
+
+
+def init_app(app):
+    app.config.setdefault('SLOW_QUERY_MS', 100)             # Statements at least this slow are logged
+    app.config.setdefault('METRICS_SERVER_TIMING', True)    # Add Server-Timing headers to responses
+
+    metrics = Metrics(app)
+    app.extensions['metrics'] = metrics
+    app.extensions['db_pool'].factory = connection_factory(metrics)
+    app.before_request(metrics.before_request)
+    app.after_request(metrics.after_request)
+    app.teardown_request(metrics.teardown_request)
+
+
+def get_metrics():
+    return current_app.extensions['metrics']
@@ -0,0 +1,459 @@
+import logging
+
+# Versioned schema migrations.
+# The database's PRAGMA user_version records the last migration applied, and migrate()
+# runs the newer ones in order - existing data is upgraded in place, never dropped.
+# To change the schema, append a new migration to MIGRATIONS; never edit one that has shipped.
+
+
+# 1 - The original tables
+BASELINE = '''
+    CREATE TABLE IF NOT EXISTS Users (
+        user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL UNIQUE,
+        email TEXT NOT NULL UNIQUE,
+        password TEXT NOT NULL,
+        first_name TEXT NOT NULL,
+        surname TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS Artworks (
+        artwork_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        description TEXT,
+        submission_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        image_path TEXT,
+        pending INTEGER DEFAULT 1,
+        FOREIGN KEY (user_id) REFERENCES Users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS Comments (
+        comment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        artwork_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        comment TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (artwork_id) REFERENCES Artworks(artwork_id),
+        FOREIGN KEY (user_id) REFERENCES Users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS Likes (
+        like_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        artwork_id INTEGER NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES Users(user_id),
+        FOREIGN KEY (artwork_id) REFERENCES Artworks(artwork_id),
+        UNIQUE (user_id, artwork_id)
+    );
+'''
+
+
+# 2 - Artworks.like_count, backfilled from Likes and kept in step by triggers.
+# Databases made by the old init_db() may already have the column.
+def add_like_count(conn):
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(Artworks)')}
+    if 'like_count' not in columns:
+        conn.execute('ALTER TABLE Artworks ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0')
+    conn.execute('''
+        UPDATE Artworks
+        SET like_count = (SELECT COUNT(*) FROM Likes WHERE Likes.artwork_id = Artworks.artwork_id)
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS likes_after_insert AFTER INSERT ON Likes
+        BEGIN
+            UPDATE Artworks SET like_count = like_count + 1 WHERE artwork_id = NEW.artwork_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS likes_after_delete AFTER DELETE ON Likes
+        BEGIN
+            UPDATE Artworks SET like_count = like_count - 1 WHERE artwork_id = OLD.artwork_id;
+        END
+    ''')
+
+
+# 3 - Indexes for the gallery, moderation queue, artist pages, comments and like counts
+INDEXES = '''
+    CREATE INDEX IF NOT EXISTS idx_artworks_pending_date ON Artworks(pending, submission_date, artwork_id);
+    CREATE INDEX IF NOT EXISTS idx_artworks_user_date ON Artworks(user_id, submission_date);
+    CREATE INDEX IF NOT EXISTS idx_comments_artwork_time ON Comments(artwork_id, timestamp, comment_id);
+    CREATE INDEX IF NOT EXISTS idx_likes_artwork ON Likes(artwork_id, user_id);
+'''
+
+
+# 4 - Resized/WebP copies of each upload, as JSON written by the image pipeline (see images.py)
+IMAGE_VARIANTS = '''
+    ALTER TABLE Artworks ADD COLUMN image_variants TEXT;
+'''
+
+
+# 5 - Uploads are content-addressed, so look artworks up by file to reuse variants and find orphans
+IMAGE_PATH_INDEX = '''
+    CREATE INDEX IF NOT EXISTS idx_artworks_image_path ON Artworks(image_path);
+'''
+
+
+# 6 - Account types, so judges can moderate submissions ('flask --app app make-admin <username>')
+USER_TYPE = '''
+    ALTER TABLE Users ADD COLUMN user_type TEXT NOT NULL DEFAULT 'artist'
+        CHECK (user_type IN ('artist', 'enthusiast', 'admin'));
+'''
+
+
+# 7 - Full-text search (see search.py). ArtworkSearch holds each approved artwork's title,
+# description and artist names under rowid = artwork_id - pending artworks are left out, so
+# "ORDER BY rank LIMIT n" is answered inside FTS5. CommentSearch indexes Comments in place.
+# Triggers keep both current.
+def add_search_index(conn):
+    statements = [
+        '''CREATE VIRTUAL TABLE ArtworkSearch USING fts5(
+               title, description, artist,
+               tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''',
+        """INSERT INTO ArtworkSearch(ArtworkSearch, rank) VALUES ('rank', 'bm25(10.0, 2.0, 5.0)')""",
+        '''CREATE VIRTUAL TABLE CommentSearch USING fts5(
+               comment, artwork_id UNINDEXED,
+               content = 'Comments', content_rowid = 'comment_id',
+               tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''',
+
+        '''CREATE TRIGGER artworks_search_insert AFTER INSERT ON Artworks WHEN NEW.pending = 0
+           BEGIN
+               INSERT INTO ArtworkSearch (rowid, title, description, artist)
+               SELECT NEW.artwork_id, NEW.title, NEW.description,
+                      u.username || ' ' || u.first_name || ' ' || u.surname
+               FROM Users u WHERE u.user_id = NEW.user_id;
+           END''',
+        '''CREATE TRIGGER artworks_search_update AFTER UPDATE OF title, description, user_id, pending ON Artworks
+           BEGIN
+               DELETE FROM ArtworkSearch WHERE rowid = OLD.artwork_id;
+               INSERT INTO ArtworkSearch (rowid, title, description, artist)
+               SELECT NEW.artwork_id, NEW.title, NEW.description,
+                      u.username || ' ' || u.first_name || ' ' || u.surname
+               FROM Users u WHERE u.user_id = NEW.user_id AND NEW.pending = 0;
+           END''',
+        '''CREATE TRIGGER artworks_search_delete AFTER DELETE ON Artworks
+           BEGIN
+               DELETE FROM ArtworkSearch WHERE rowid = OLD.artwork_id;
+           END''',
+        '''CREATE TRIGGER users_search_update AFTER UPDATE OF username, first_name, surname ON Users
+           BEGIN
+               UPDATE ArtworkSearch SET artist = NEW.username || ' ' || NEW.first_name || ' ' || NEW.surname
+               WHERE rowid IN (SELECT artwork_id FROM Artworks WHERE user_id = NEW.user_id);
+           END''',
+
+        '''CREATE TRIGGER comments_search_insert AFTER INSERT ON Comments
+           BEGIN
+               INSERT INTO CommentSearch (rowid, comment, artwork_id)
+               VALUES (NEW.comment_id, NEW.comment, NEW.artwork_id);
+           END''',
+        '''CREATE TRIGGER comments_search_update AFTER UPDATE ON Comments
+           BEGIN
+               INSERT INTO CommentSearch (CommentSearch, rowid, comment, artwork_id)
+               VALUES ('delete', OLD.comment_id, OLD.comment, OLD.artwork_id);
+               INSERT INTO CommentSearch (rowid, comment, artwork_id)
+               VALUES (NEW.comment_id, NEW.comment, NEW.artwork_id);
+           END''',
+        '''CREATE TRIGGER comments_search_delete AFTER DELETE ON Comments
+           BEGIN
+               INSERT INTO CommentSearch (CommentSearch, rowid, comment, artwork_id)
+               VALUES ('delete', OLD.comment_id, OLD.comment, OLD.artwork_id);
+           END''',
+
+        # Index what is already there
+        '''INSERT INTO ArtworkSearch (rowid, title, description, artist)
+           SELECT a.artwork_id, a.title, a.description, u.username || ' ' || u.first_name || ' ' || u.surname
+           FROM Artworks a JOIN Users u ON u.user_id = a.user_id
+           WHERE a.pending = 0''',
+        """INSERT INTO CommentSearch (CommentSearch) VALUES ('rebuild')""",
+    ]
+    for statement in statements:
+        conn.execute(statement)
+
+
+# 8 - Server-side sessions (see sessions.py)
+SESSIONS = '''
+    CREATE TABLE IF NOT EXISTS Sessions (
+        session_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_sessions_expires ON Sessions (expires_at);
+'''
+
+
+# 9 - Which archive entries have been imported (see archive.py), so an interrupted import resumes
+ARCHIVE_IMPORTS = '''
+    CREATE TABLE IF NOT EXISTS ArchiveImports (
+        source TEXT PRIMARY KEY,
+        artwork_id INTEGER NOT NULL
+    ) WITHOUT ROWID;
+'''
+
+
+# 10 - Summary statistics for artist profiles (see models.get_artist_profile).
+# Artworks.comment_count is kept by Comments triggers, as like_count is by the Likes ones.
+# ArtistStats holds one row per artist per competition year (the year of submission_date) with
+# their approved uploads and the likes and comments on them. Triggers on Artworks apply every
+# approval, rejection and like_count/comment_count change as a delta, so likes flushed by
+# likes.py, comments, moderation, reconcile-likes and archive imports all land in the same
+# place and a profile reads a few rows however busy the artist has been.
+def add_artist_stats(conn):
+    statements = [
+        'ALTER TABLE Artworks ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0',
+        """UPDATE Artworks
+           SET comment_count = (SELECT COUNT(*) FROM Comments WHERE Comments.artwork_id = Artworks.artwork_id)""",
+        """CREATE TRIGGER comments_after_insert AFTER INSERT ON Comments
+           BEGIN
+               UPDATE Artworks SET comment_count = comment_count + 1 WHERE artwork_id = NEW.artwork_id;
+           END""",
+        """CREATE TRIGGER comments_after_delete AFTER DELETE ON Comments
+           BEGIN
+               UPDATE Artworks SET comment_count = comment_count - 1 WHERE artwork_id = OLD.artwork_id;
+           END""",
+
+        """CREATE TABLE ArtistStats (
+               user_id INTEGER NOT NULL,
+               year TEXT NOT NULL,
+               uploads INTEGER NOT NULL DEFAULT 0,
+               likes INTEGER NOT NULL DEFAULT 0,
+               comments INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (user_id, year)
+           ) WITHOUT ROWID""",
+        # Rank within a year = 1 + artists that year with more likes
+        'CREATE INDEX idx_artist_stats_year_likes ON ArtistStats (year, likes)',
+        # The same for artworks, among the approved ones
+        """CREATE INDEX idx_artworks_year_likes ON Artworks (substr(submission_date, 1, 4), like_count)
+           WHERE pending = 0""",
+
+        """CREATE TRIGGER artist_stats_insert AFTER INSERT ON Artworks WHEN NEW.pending = 0
+           BEGIN
+               INSERT INTO ArtistStats (user_id, year, uploads, likes, comments)
+               VALUES (NEW.user_id, substr(NEW.submission_date, 1, 4), 1, NEW.like_count, NEW.comment_count)
+               ON CONFLICT (user_id, year) DO UPDATE SET uploads = uploads + 1,
+                   likes = likes + excluded.likes, comments = comments + excluded.comments;
+           END""",
+        """CREATE TRIGGER artist_stats_approve AFTER UPDATE OF pending ON Artworks
+           WHEN OLD.pending != 0 AND NEW.pending = 0
+           BEGIN
+               INSERT INTO ArtistStats (user_id, year, uploads, likes, comments)
+               VALUES (NEW.user_id, substr(NEW.submission_date, 1, 4), 1, NEW.like_count, NEW.comment_count)
+               ON CONFLICT (user_id, year) DO UPDATE SET uploads = uploads + 1,
+                   likes = likes + excluded.likes, comments = comments + excluded.comments;
+           END""",
+        """CREATE TRIGGER artist_stats_counts AFTER UPDATE OF like_count, comment_count ON Artworks
+           WHEN OLD.pending = 0 AND NEW.pending = 0
+           BEGIN
+               UPDATE ArtistStats
+               SET likes = likes + NEW.like_count - OLD.like_count,
+                   comments = comments + NEW.comment_count - OLD.comment_count
+               WHERE user_id = NEW.user_id AND year = substr(NEW.submission_date, 1, 4);
+           END""",
+        # A rejected artwork's likes and comments are deleted first, so only the upload is left to take off
+        """CREATE TRIGGER artist_stats_delete AFTER DELETE ON Artworks WHEN OLD.pending = 0
+           BEGIN
+               UPDATE ArtistStats
+               SET uploads = uploads - 1, likes = likes - OLD.like_count, comments = comments - OLD.comment_count
+               WHERE user_id = OLD.user_id AND year = substr(OLD.submission_date, 1, 4);
+               DELETE FROM ArtistStats
+               WHERE user_id = OLD.user_id AND year = substr(OLD.submission_date, 1, 4) AND uploads = 0;
+           END""",
+
+        """INSERT INTO ArtistStats (user_id, year, uploads, likes, comments)
+           SELECT user_id, substr(submission_date, 1, 4), COUNT(*), SUM(like_count), SUM(comment_count)
+           FROM Artworks WHERE pending = 0
+           GROUP BY user_id, substr(submission_date, 1, 4)""",
+    ]
+    for statement in statements:
+        conn.execute(statement)
+
+
+# 11 - Leaderboard feed and snapshots (see leaderboard.py). Workers follow new Likes rows by
+# like_id and deleted ones through LikeRemovals, filled by a trigger; rolling windows are built
+# from the timestamp index. LeaderboardScores/State hold the last saved boards and feed position.
+def add_leaderboard(conn):
+    statements = [
+        'CREATE INDEX idx_likes_timestamp ON Likes(timestamp)',
+        """CREATE TABLE LikeRemovals (
+               removal_id INTEGER PRIMARY KEY AUTOINCREMENT,
+               like_id INTEGER NOT NULL,
+               artwork_id INTEGER NOT NULL,
+               liked_at TIMESTAMP,
+               removed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )""",
+        """CREATE TRIGGER likes_log_delete AFTER DELETE ON Likes
+           BEGIN
+               INSERT INTO LikeRemovals (like_id, artwork_id, liked_at)
+               VALUES (OLD.like_id, OLD.artwork_id, OLD.timestamp);
+           END""",
+        """CREATE TABLE LeaderboardScores (
+               board TEXT NOT NULL,
+               artwork_id INTEGER NOT NULL,
+               score INTEGER NOT NULL,
+               PRIMARY KEY (board, artwork_id)
+           ) WITHOUT ROWID""",
+        """CREATE TABLE LeaderboardState (
+               key TEXT PRIMARY KEY,
+               value TEXT NOT NULL
+           ) WITHOUT ROWID""",
+    ]
+    for statement in statements:
+        conn.execute(statement)
+
+MIGRATIONS = [
+    (1, 'baseline tables', BASELINE),
+    (2, 'Artworks.like_count and Likes triggers', add_like_count),
+    (3, 'secondary indexes', INDEXES),
+    (4, 'Artworks.image_variants', IMAGE_VARIANTS),
+    (5, 'index on Artworks.image_path', IMAGE_PATH_INDEX),
+    (6, 'Users.user_type', USER_TYPE),
+    (7, 'full-text search tables and triggers', add_search_index),
+    (8, 'Sessions table', SESSIONS),
+    (9, 'ArchiveImports table', ARCHIVE_IMPORTS),
+    (10, 'Artworks.comment_count and ArtistStats summary table', add_artist_stats),
+    (11, 'leaderboard feed and snapshot tables', add_leaderboard),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+# Apply every migration newer than the database's user_version.
+# Each migration runs in its own IMMEDIATE transaction together with the version bump,
+# so a failure leaves the database at the previous version and two processes starting
+# at once can't both apply the same step. Returns the list of versions applied.
+def migrate(conn, target=LATEST_VERSION):
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version > target:
+            break
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if schema_version(conn) >= version:  # Already done (possibly by another process)
+                conn.rollback()
+                continue
+
+            if callable(step):
+                step(conn)
+            else:
+                for statement in step.split(';'):
+                    if statement.strip():
+                        conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logging.exception(f"Migration {version} ({description}) failed")
+            raise
+
+        logging.info(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+# The queries behind the busiest pages (see also sql.txt). check_query_plans() makes sure none of them
+# falls back to scanning a whole table (or index) or sorting rows in a temporary B-tree.
+HOT_QUERIES = {
+    'gallery first page': (
+        '''SELECT a.artwork_id, a.like_count, u.username, l.like_id
+           FROM Artworks a
+           JOIN Users u ON u.user_id = a.user_id
+           LEFT JOIN Likes l ON l.artwork_id = a.artwork_id AND l.user_id = ?
+           WHERE a.pending = 0
+           ORDER BY a.submission_date DESC, a.artwork_id DESC LIMIT ?''',
+        (1, 25)),
+    'gallery next page': (
+        '''SELECT a.artwork_id, a.like_count, u.username, l.like_id
+           FROM Artworks a
+           JOIN Users u ON u.user_id = a.user_id
+           LEFT JOIN Likes l ON l.artwork_id = a.artwork_id AND l.user_id = ?
+           WHERE a.pending = 0 AND (a.submission_date, a.artwork_id) < (?, ?)
+           ORDER BY a.submission_date DESC, a.artwork_id DESC LIMIT ?''',
+        (1, '2025-01-01 00:00:00', 1, 25)),
+    'pending artworks': (
+        'SELECT * FROM Artworks WHERE pending = 1 ORDER BY submission_date, artwork_id', ()),
+    'moderation next page': (
+        '''SELECT a.artwork_id, u.username
+           FROM Artworks a
+           JOIN Users u ON u.user_id = a.user_id
+           WHERE a.pending = 1 AND (a.submission_date, a.artwork_id) > (?, ?)
+           ORDER BY a.submission_date, a.artwork_id LIMIT ?''',
+        ('2025-01-01 00:00:00', 1, 51)),
+    'pending count': (
+        'SELECT COUNT(*) FROM Artworks WHERE pending = 1', ()),
+    'artworks by user': (
+        'SELECT * FROM Artworks WHERE user_id = ? ORDER BY submission_date DESC', (1,)),
+    'comments for artwork': (
+        'SELECT * FROM Comments WHERE artwork_id = ? ORDER BY timestamp DESC', (1,)),
+    'older comments': (
+        '''SELECT comment_id, user_id, comment, timestamp FROM Comments
+           WHERE artwork_id = ? AND (timestamp, comment_id) < (?, ?)
+           ORDER BY timestamp DESC, comment_id DESC LIMIT ?''',
+        (1, '2025-01-01 00:00:00', 1, 21)),
+    'comments since': (
+        '''SELECT comment_id, user_id, comment, timestamp FROM Comments
+           WHERE artwork_id = ? AND (timestamp, comment_id) > (?, ?)
+           ORDER BY timestamp, comment_id LIMIT ?''',
+        (1, '2025-01-01 00:00:00', 1, 100)),
+    'like count for artwork': (
+        'SELECT COUNT(*) FROM Likes WHERE artwork_id = ?', (1,)),
+    'like toggle': (
+        'SELECT 1 FROM Likes WHERE user_id = ? AND artwork_id = ?', (1, 1)),
+    'variants for image': (
+        'SELECT image_variants FROM Artworks WHERE image_path = ? AND image_variants IS NOT NULL LIMIT 1',
+        ('uploads/x.jpg',)),
+    'search artworks': (
+        # Only the full-text part - search.py then joins and re-sorts the (at most 20) rows it returns
+        'SELECT rowid, rank FROM ArtworkSearch WHERE ArtworkSearch MATCH ? ORDER BY rank LIMIT 20',
+        ('"sun"*',)),
+    'session by id': (
+        'SELECT data, expires_at FROM Sessions WHERE session_id = ? AND expires_at > ?', ('abc', 0)),
+    'expired sessions': (
+        'DELETE FROM Sessions WHERE expires_at < ?', (0,)),
+    'user by username': (
+        'SELECT * FROM Users WHERE username = ?', ('JohnDoe',)),
+    'artist stats by year': (
+        'SELECT year, uploads, likes, comments FROM ArtistStats WHERE user_id = ? ORDER BY year DESC', (1,)),
+    'artists ranked in year': (
+        'SELECT user_id, likes FROM ArtistStats WHERE year = ?', ('2025',)),
+    'artist artworks page': (
+        '''SELECT a.artwork_id, a.like_count, a.comment_count FROM Artworks a
+           WHERE a.user_id = ? AND a.pending = 0 AND (a.submission_date, a.artwork_id) < (?, ?)
+           ORDER BY a.submission_date DESC, a.artwork_id DESC LIMIT ?''',
+        (1, '2025-01-01 00:00:00', 1, 25)),
+    'artworks ranked in year': (
+        '''SELECT artwork_id, like_count FROM Artworks
+           WHERE substr(submission_date, 1, 4) = ? AND pending = 0''', ('2025',)),
+    'new likes since': (
+        'SELECT like_id, artwork_id, timestamp FROM Likes WHERE like_id > ? ORDER BY like_id', (1000,)),
+    'like removals since': (
+        '''SELECT removal_id, like_id, artwork_id, liked_at FROM LikeRemovals
+           WHERE removal_id > ? ORDER BY removal_id''', (0,)),
+    'likes in window': (
+        '''SELECT like_id, artwork_id, timestamp FROM Likes WHERE timestamp >= ? AND like_id <= ?
+           ORDER BY timestamp, like_id''', ('2025-01-01 00:00:00', 1000)),
+}
+
+
+# EXPLAIN QUERY PLAN every hot query. Returns {query name: [offending plan lines]}
+# for the ones that SCAN (walk a whole table, or a whole index) or sort with a temp B-tree.
+# A healthy plan only has SEARCH lines (and FTS5 lookups, which EXPLAIN shows as a
+# "SCAN ... VIRTUAL TABLE INDEX" but which go through the full-text index).
+def check_query_plans(conn, queries=HOT_QUERIES):
+    problems = {}
+    for name, (sql, params) in queries.items():
+        bad = []
+        for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params):
+            detail = row[3]
+            if 'VIRTUAL TABLE INDEX' in detail:
+                continue
+            if detail.startswith('SCAN ') or detail.startswith('USE TEMP B-TREE'):
+                bad.append(detail)
+        if bad:
+            problems[name] = bad
+    return problems
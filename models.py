@@ -0,0 +1,368 @@
+import sqlite3
+import base64
+
+# SQL used by the routes. Every function takes an open connection (from db.get_db())
+# so the same queries can be reused by scripts and benchmarks.
+
+
+# Gallery cursors are opaque strings wrapping the (submission_date, artwork_id)
+# of the last artwork on the previous page. Comment cursors wrap (timestamp, comment_id).
+def encode_cursor(artwork):
+    return _encode_key(artwork['submission_date'], artwork['artwork_id'])
+
+
+def encode_comment_cursor(comment):
+    return _encode_key(comment['timestamp'], comment['comment_id'])
+
+
+def _encode_key(timestamp, row_id):
+    raw = f"{timestamp}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+# Sorts before every comment, for a page that has none yet
+FIRST_COMMENT_CURSOR = _encode_key('', 0)
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, row_id = raw.rsplit('|', 1)
+        return timestamp, int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+# Most ? placeholders put in one statement (SQLite before 3.32 allowed only 999)
+MAX_VARIABLES = 500
+
+
+def _chunks(ids, size=MAX_VARIABLES):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+# One page of approved artworks, newest first, with their artist, like count and
+# whether `user_id` liked them. Returns (artworks, next_cursor); next_cursor is None on the last page.
+#
+# Keyset pagination: instead of OFFSET we continue from the last (submission_date, artwork_id)
+# we handed out, so page 500 costs the same as page 1. like_count is kept on the Artworks row
+# by the Likes triggers and the LEFT JOIN hits the UNIQUE(user_id, artwork_id) index.
+def get_gallery_page(conn, user_id=None, after=None, limit=24):
+    params = [user_id]
+    where = 'a.pending = 0'
+    if after:
+        where += ' AND (a.submission_date, a.artwork_id) < (?, ?)'
+        params.extend(decode_cursor(after))
+    params.append(limit + 1)  # One extra row tells us whether there is another page
+
+    rows = conn.execute(f'''
+        SELECT a.artwork_id, a.user_id, a.title, a.description, a.submission_date,
+               a.image_path, a.image_variants, a.like_count, u.username AS artist_name,
+               l.like_id IS NOT NULL AS is_liked
+        FROM Artworks a
+        JOIN Users u ON u.user_id = a.user_id
+        LEFT JOIN Likes l ON l.artwork_id = a.artwork_id AND l.user_id = ?
+        WHERE {where}
+        ORDER BY a.submission_date DESC, a.artwork_id DESC
+        LIMIT ?
+    ''', params).fetchall()
+
+    artworks = [dict(row) for row in rows[:limit]]
+    next_cursor = encode_cursor(artworks[-1]) if len(rows) > limit else None
+    return artworks, next_cursor
+
+
+# Store a new submission; it stays hidden from the gallery until an admin approves it
+def create_artwork(conn, user_id, title, description, image_path):
+    cursor = conn.execute('''
+        INSERT INTO Artworks (user_id, title, description, image_path, pending)
+        VALUES (?, ?, ?, ?, 1)
+    ''', (user_id, title, description, image_path))
+    conn.commit()
+    return cursor.lastrowid
+
+
+# Variants already made for an image file (shared by every artwork uploaded with the same bytes)
+def get_image_variants(conn, image_path):
+    row = conn.execute(
+        'SELECT image_variants FROM Artworks WHERE image_path = ? AND image_variants IS NOT NULL LIMIT 1',
+        (image_path,)
+    ).fetchone()
+    return row['image_variants'] if row else None
+
+
+def set_image_variants(conn, artwork_id, variants_json):
+    conn.execute('UPDATE Artworks SET image_variants = ? WHERE artwork_id = ?', (variants_json, artwork_id))
+    conn.commit()
+
+
+# Gallery rows (same columns as get_gallery_page, without is_liked) for specific artworks
+def get_artworks_by_ids(conn, artwork_ids):
+    if not artwork_ids:
+        return []
+    placeholders = ', '.join('?' * len(artwork_ids))
+    rows = conn.execute(f'''
+        SELECT a.artwork_id, a.user_id, a.title, a.description, a.submission_date,
+               a.image_path, a.image_variants, a.like_count, u.username AS artist_name
+        FROM Artworks a
+        JOIN Users u ON u.user_id = a.user_id
+        WHERE a.artwork_id IN ({placeholders})
+    ''', list(artwork_ids)).fetchall()
+    return [dict(row) for row in rows]
+
+
+# like_count of each approved artwork in `artwork_ids`, as {artwork_id: like_count}
+def get_like_counts(conn, artwork_ids):
+    if not artwork_ids:
+        return {}
+    placeholders = ', '.join('?' * len(artwork_ids))
+    rows = conn.execute(
+        f'SELECT artwork_id, like_count FROM Artworks WHERE pending = 0 AND artwork_id IN ({placeholders})',
+        list(artwork_ids)
+    ).fetchall()
+    return {row['artwork_id']: row['like_count'] for row in rows}
+
+
+# Which of `artwork_ids` the user has liked - one query for a whole page
+def get_liked_ids(conn, user_id, artwork_ids):
+    if not artwork_ids:
+        return set()
+    placeholders = ', '.join('?' * len(artwork_ids))
+    rows = conn.execute(
+        f'SELECT artwork_id FROM Likes WHERE user_id = ? AND artwork_id IN ({placeholders})',
+        [user_id, *artwork_ids]
+    ).fetchall()
+    return {row['artwork_id'] for row in rows}
+
+
+def has_liked(conn, user_id, artwork_id):
+    return conn.execute(
+        'SELECT 1 FROM Likes WHERE user_id = ? AND artwork_id = ?', (user_id, artwork_id)
+    ).fetchone() is not None
+
+
+def get_artwork(conn, artwork_id):
+    row = conn.execute('''
+        SELECT a.*, u.username AS artist_name
+        FROM Artworks a
+        JOIN Users u ON u.user_id = a.user_id
+        WHERE a.artwork_id = ?
+    ''', (artwork_id,)).fetchone()
+    return dict(row) if row else None
+
+
+# One page of an artwork's comments, newest first, continuing after the `before` cursor.
+# Returns (comments, next_cursor); next_cursor points at older comments, None on the last page.
+# Keyset pagination on the (artwork_id, timestamp, comment_id) index, so page 100 of a
+# winner's thread costs the same as page 1.
+def get_comments(conn, artwork_id, before=None, limit=20):
+    params = [artwork_id]
+    where = 'artwork_id = ?'
+    if before:
+        where += ' AND (timestamp, comment_id) < (?, ?)'
+        params.extend(decode_cursor(before))
+    params.append(limit + 1)
+
+    rows = conn.execute(f'''
+        SELECT comment_id, user_id, comment, timestamp
+        FROM Comments
+        WHERE {where}
+        ORDER BY timestamp DESC, comment_id DESC
+        LIMIT ?
+    ''', params).fetchall()
+
+    comments = _with_usernames(conn, [dict(row) for row in rows[:limit]])
+    next_cursor = encode_comment_cursor(comments[-1]) if len(rows) > limit else None
+    return comments, next_cursor
+
+
+# Comments posted after the `after` cursor, oldest first, for refreshing an open page.
+# Returns (comments, newest_cursor); pass newest_cursor back next time. With more than
+# `limit` new comments only the oldest `limit` are returned - ask again from the new cursor.
+def get_comments_since(conn, artwork_id, after, limit=100):
+    rows = conn.execute('''
+        SELECT comment_id, user_id, comment, timestamp
+        FROM Comments
+        WHERE artwork_id = ? AND (timestamp, comment_id) > (?, ?)
+        ORDER BY timestamp, comment_id
+        LIMIT ?
+    ''', (artwork_id, *decode_cursor(after), limit)).fetchall()
+
+    comments = _with_usernames(conn, [dict(row) for row in rows])
+    return comments, encode_comment_cursor(comments[-1]) if comments else after
+
+
+def get_comment(conn, comment_id):
+    row = conn.execute('SELECT comment_id, user_id, comment, timestamp FROM Comments WHERE comment_id = ?',
+                       (comment_id,)).fetchone()
+    return _with_usernames(conn, [dict(row)])[0] if row else None
+
+
+# Usernames for a page of comments in one query, however many comments each user wrote
+def _with_usernames(conn, comments):
+    user_ids = sorted({comment['user_id'] for comment in comments})
+    names = {}
+    for chunk in _chunks(user_ids):
+        placeholders = ', '.join('?' * len(chunk))
+        rows = conn.execute(f'SELECT user_id, username FROM Users WHERE user_id IN ({placeholders})', chunk)
+        names.update((row['user_id'], row['username']) for row in rows)
+    for comment in comments:
+        comment['username'] = names.get(comment['user_id'], '[deleted]')
+    return comments
+
+
+def add_comment(conn, artwork_id, user_id, comment):
+    cursor = conn.execute('INSERT INTO Comments (artwork_id, user_id, comment) VALUES (?, ?, ?)',
+                          (artwork_id, user_id, comment))
+    conn.commit()
+    return cursor.lastrowid
+
+
+# One page of the moderation queue, oldest first. Keyset-paginated like the gallery,
+# so the 2,000th pending artwork costs the same to reach as the first.
+def get_moderation_page(conn, after=None, limit=50):
+    params = []
+    where = 'a.pending = 1'
+    if after:
+        where += ' AND (a.submission_date, a.artwork_id) > (?, ?)'
+        params.extend(decode_cursor(after))
+    params.append(limit + 1)
+
+    rows = conn.execute(f'''
+        SELECT a.artwork_id, a.user_id, a.title, a.description, a.submission_date,
+               a.image_path, a.image_variants, u.username AS artist_name
+        FROM Artworks a
+        JOIN Users u ON u.user_id = a.user_id
+        WHERE {where}
+        ORDER BY a.submission_date, a.artwork_id
+        LIMIT ?
+    ''', params).fetchall()
+
+    artworks = [dict(row) for row in rows[:limit]]
+    next_cursor = encode_cursor(artworks[-1]) if len(rows) > limit else None
+    return artworks, next_cursor
+
+
+def count_pending(conn):
+    return conn.execute('SELECT COUNT(*) FROM Artworks WHERE pending = 1').fetchone()[0]
+
+
+# Approve any number of pending artworks in one transaction. Returns the IDs that were approved
+# (IDs that don't exist or were already approved are left out).
+def approve_artworks(conn, artwork_ids):
+    approved = []
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for chunk in _chunks(artwork_ids):
+            placeholders = ', '.join('?' * len(chunk))
+            found = [row[0] for row in conn.execute(
+                f'SELECT artwork_id FROM Artworks WHERE pending = 1 AND artwork_id IN ({placeholders})', chunk
+            )]
+            if found:
+                conn.execute(f"UPDATE Artworks SET pending = 0 WHERE artwork_id IN ({', '.join('?' * len(found))})",
+                             found)
+                approved.extend(found)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return approved
+
+
+def approve_artwork(conn, artwork_id):
+    return bool(approve_artworks(conn, [artwork_id]))
+
+
+# Remove any number of artworks, with their likes and comments (they reference them), in one
+# transaction. Returns the deleted rows' artwork_id, image_path and image_variants; the files
+# are left for the upload collector (uploads.py), as another artwork may share them.
+def reject_artworks(conn, artwork_ids):
+    rejected = []
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for chunk in _chunks(artwork_ids):
+            placeholders = ', '.join('?' * len(chunk))
+            rows = conn.execute(
+                f'SELECT artwork_id, image_path, image_variants FROM Artworks WHERE artwork_id IN ({placeholders})',
+                chunk
+            ).fetchall()
+            if not rows:
+                continue
+            found = [row['artwork_id'] for row in rows]
+            placeholders = ', '.join('?' * len(found))
+            conn.execute(f'DELETE FROM Likes WHERE artwork_id IN ({placeholders})', found)
+            conn.execute(f'DELETE FROM Comments WHERE artwork_id IN ({placeholders})', found)
+            conn.execute(f'DELETE FROM Artworks WHERE artwork_id IN ({placeholders})', found)
+            rejected.extend(dict(row) for row in rows)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return rejected
+
+
+def reject_artwork(conn, artwork_id):
+    return bool(reject_artworks(conn, [artwork_id]))
+
+
+# An artist's public profile: their Users row with totals and per-year figures (uploads, likes and
+# comments on them) from ArtistStats, which triggers keep current (migration 10). A handful of
+# indexed rows, however many likes and comments the artist has had. Ranks among each year's
+# artists come from leaderboard.YearRanks. Returns None if there is no such user.
+def get_artist_profile(conn, username):
+    user = conn.execute(
+        'SELECT user_id, username, first_name, surname, user_type FROM Users WHERE username = ?', (username,)
+    ).fetchone()
+    if user is None:
+        return None
+
+    years = [dict(row) for row in conn.execute(
+        'SELECT year, uploads, likes, comments FROM ArtistStats WHERE user_id = ? ORDER BY year DESC',
+        (user['user_id'],)).fetchall()]
+
+    profile = dict(user)
+    profile['years'] = years
+    profile['totals'] = {key: sum(year[key] for year in years) for key in ('uploads', 'likes', 'comments')}
+    return profile
+
+
+# One page of an artist's approved artworks, newest first, in the same shape as gallery rows.
+# Returns (artworks, next_cursor). Keyset-paginated on the (user_id, submission_date) index.
+def get_artist_artworks(conn, user_id, after=None, limit=24):
+    params = [user_id]
+    where = 'a.user_id = ? AND a.pending = 0'
+    if after:
+        where += ' AND (a.submission_date, a.artwork_id) < (?, ?)'
+        params.extend(decode_cursor(after))
+    params.append(limit + 1)
+
+    rows = conn.execute(f'''
+        SELECT a.artwork_id, a.user_id, a.title, a.description, a.submission_date,
+               a.image_path, a.image_variants, a.like_count, a.comment_count, u.username AS artist_name
+        FROM Artworks a
+        JOIN Users u ON u.user_id = a.user_id
+        WHERE {where}
+        ORDER BY a.submission_date DESC, a.artwork_id DESC
+        LIMIT ?
+    ''', params).fetchall()
+
+    artworks = [dict(row) for row in rows[:limit]]
+    next_cursor = encode_cursor(artworks[-1]) if len(rows) > limit else None
+    return artworks, next_cursor
+
+
+# Submissions of the artist's still waiting for moderation (shown to them on their own profile)
+def count_pending_for_artist(conn, user_id):
+    return conn.execute('SELECT COUNT(*) FROM Artworks WHERE user_id = ? AND pending = 1', (user_id,)).fetchone()[0]
+
+
+# An artwork's likes and comments, and the competition year it is ranked in (see
+# leaderboard.YearRanks). Returns None if there is no such artwork.
+def get_artwork_stats(conn, artwork_id):
+    row = conn.execute('''
+        SELECT artwork_id, user_id, like_count, comment_count, pending, substr(submission_date, 1, 4) AS year
+        FROM Artworks WHERE artwork_id = ?
+    ''', (artwork_id,)).fetchone()
+    return dict(row) if row else None
@@ -0,0 +1,120 @@
+import atexit
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Password hashing in a separate pool of processes.
+#
+# Hashes are slow on purpose, and a burst of logins hashing on the request threads would hold
+# the GIL and stall every other page. Here a request thread hands the work to PASSWORD_WORKERS
+# processes and just waits. At most PASSWORD_QUEUE_LIMIT hashes may be running or queued;
+# beyond that HasherBusy is raised straight away, and the caller answers 503 + Retry-After.
+#
+# PASSWORD_METHOD is the Werkzeug method string exactly as it appears at the start of a stored
+# hash (e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'). When it changes, each user's hash is
+# upgraded the next time they log in.
+
+
+class HasherBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'Password hasher is saturated, retry in {retry_after}s')
+        self.retry_after = retry_after
+
+
+# Worker-process functions - plain values in, plain values out
+def _hash(password, method):
+    return generate_password_hash(password, method)
+
+
+# Returns (matches, new_hash); new_hash is set when the stored hash used an older method
+def _verify(pwhash, password, method):
+    if not check_password_hash(pwhash, password):
+        return False, None
+    if pwhash.split('$', 1)[0] != method:
+        return True, generate_password_hash(password, method)
+    return True, None
+
+
+class PasswordHasher:
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config['PASSWORD_WORKERS']
+        self.method = app.config['PASSWORD_METHOD']
+        self.timeout = app.config['PASSWORD_TIMEOUT']
+        self.retry_after = app.config['PASSWORD_RETRY_AFTER']
+        self._slots = threading.BoundedSemaphore(app.config['PASSWORD_QUEUE_LIMIT'])
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._dummy_hash = None
+        self.rejected = 0
+
+    # Created on first use, so a pre-fork parent never owns worker processes
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                atexit.register(self.shutdown)
+            return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HasherBusy(self.retry_after)
+        if not self.workers:
+            try:
+                return fn(*args)
+            finally:
+                self._slots.release()
+
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is freed when the work is really done, even if this request gave up on it
+        future.add_done_callback(lambda f: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            self.rejected += 1
+            raise HasherBusy(self.retry_after)
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    # Check a password. Returns (matches, new_hash) - store new_hash if it isn't None.
+    # Pass pwhash=None for an unknown user: a dummy hash is checked so the response takes as
+    # long as a real one and doesn't reveal which usernames exist.
+    def verify(self, pwhash, password):
+        if pwhash is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = self.hash('not a real password')
+            self._run(_verify, self._dummy_hash, password, self.method)
+            return False, None
+        return self._run(_verify, pwhash, password, self.method)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {'workers': self.workers, 'method': self.method, 'rejected_total': self.rejected}
+
+
+def init_app(app):
+    app.config.setdefault('PASSWORD_WORKERS', 2)             # Hashing processes (0 = hash on the request thread)
+    app.config.setdefault('PASSWORD_QUEUE_LIMIT', 16)        # Hashes running or waiting before we answer 503
+    app.config.setdefault('PASSWORD_METHOD', 'scrypt:32768:8:1')  # Werkzeug method string, sets the cost
+    app.config.setdefault('PASSWORD_TIMEOUT', 10)            # Seconds a request waits for its hash
+    app.config.setdefault('PASSWORD_RETRY_AFTER', 2)         # Retry-After (seconds) sent with a 503
+    app.extensions['password_hasher'] = PasswordHasher(app)
+    logging.info(f"Password hashing: {app.config['PASSWORD_METHOD']} on {app.config['PASSWORD_WORKERS']} workers")
+
+
+def get_hasher():
+    return current_app.extensions['password_hasher']
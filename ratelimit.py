@@ -0,0 +1,93 @@
+import time
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+# Token-bucket rate limiting, kept in memory per process.
+# Each key (an IP address, a username) gets a bucket of `burst` tokens that refills at `rate`
+# tokens per second; a request takes one token or is turned away with how long to wait.
+# Only the most recently seen `max_keys` buckets are kept, so a flood of new keys can't
+# exhaust memory - an evicted bucket simply starts full again.
+#
+# Behind a reverse proxy (nginx, as with ASSET_SENDFILE = 'x-accel') every request comes from the
+# proxy's address, so all clients would share one per-IP bucket. Set TRUSTED_PROXIES to the
+# number of proxies in front of the app and the client address is taken from X-Forwarded-For
+# instead. Leave it at 0 when clients connect directly: they could send any X-Forwarded-For.
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    # Take a token for key. Returns 0 if allowed, otherwise the seconds until a token is free.
+    def take(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens >= 1:
+                wait = 0
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.limited += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    # Refill key's bucket, e.g. after a successful login
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self._buckets), 'limited_total': self.limited}
+
+
+# Login attempts are limited per client IP and per username, so neither one address trying
+# many accounts nor many addresses trying one account can keep the password hasher busy.
+class LoginLimiter:
+    def __init__(self, app):
+        per_minute = 60.0
+        self.by_ip = TokenBucketLimiter(app.config['LOGIN_RATE_PER_IP'] / per_minute,
+                                        app.config['LOGIN_BURST_PER_IP'])
+        self.by_username = TokenBucketLimiter(app.config['LOGIN_RATE_PER_USERNAME'] / per_minute,
+                                              app.config['LOGIN_BURST_PER_USERNAME'])
+
+    # Returns 0 if the attempt may go ahead, otherwise the seconds to wait
+    def check(self, ip, username):
+        wait = self.by_ip.take(ip)
+        if wait:
+            return wait
+        return self.by_username.take(username.lower())
+
+    def succeeded(self, username):
+        self.by_username.reset(username.lower())
+
+    def stats(self):
+        return {'ip': self.by_ip.stats(), 'username': self.by_username.stats()}
+
+
+def init_app(app):
+    app.config.setdefault('LOGIN_RATE_PER_IP', 20)         # Attempts per minute from one address
+    app.config.setdefault('LOGIN_BURST_PER_IP', 10)
+    app.config.setdefault('LOGIN_RATE_PER_USERNAME', 5)    # Attempts per minute at one account
+    app.config.setdefault('LOGIN_BURST_PER_USERNAME', 5)
+    app.config.setdefault('TRUSTED_PROXIES', 0)            # Proxies in front whose X-Forwarded-* to believe
+    if app.config['TRUSTED_PROXIES']:
+        proxies = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
+    app.extensions['login_limiter'] = LoginLimiter(app)
+
+
+def get_login_limiter():
+    return current_app.extensions['login_limiter']
@@ -0,0 +1,81 @@
+import re
+
+from markupsafe import escape, Markup
+
+# Full-text search over the FTS5 tables created by migration 7.
+# Artwork matches (title, description, artist) are ranked with bm25 - title weighs most,
+# then artist, then description - and comment matches are added after them.
+
+# highlight()/snippet() wrap matches in these private-use characters; the text is HTML-escaped
+# first and only then are they turned into <mark>, so user text can't inject markup.
+MARK_START = ''
+MARK_END = ''
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+# Turn what the visitor typed into a safe FTS5 query: every word must appear, the last one
+# may be a prefix ("sun set" -> "sun" AND "set"*). Returns None if there is nothing to search for.
+def build_query(text, max_terms=8):
+    words = WORD.findall(text or '')[:max_terms]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def to_html(text):
+    if text is None:
+        return Markup('')
+    return Markup(str(escape(text)).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+# Search approved artworks. Returns a list of dicts, best match first.
+def search_artworks(conn, text, limit=20):
+    query = build_query(text)
+    if query is None:
+        return []
+
+    results = {}
+    # The inner queries let FTS5 pick the best `limit` rows by rank before anything is joined.
+    # ArtworkSearch only holds approved artworks; comments are filtered on the way out.
+    rows = conn.execute(f'''
+        SELECT a.artwork_id, a.title, a.image_path, a.image_variants, a.like_count,
+               u.username AS artist_name, s.title_marked, s.snippet_marked
+        FROM (SELECT rowid, rank,
+                     highlight(ArtworkSearch, 0, '{MARK_START}', '{MARK_END}') AS title_marked,
+                     snippet(ArtworkSearch, 1, '{MARK_START}', '{MARK_END}', '…', 16) AS snippet_marked
+              FROM ArtworkSearch WHERE ArtworkSearch MATCH ? ORDER BY rank LIMIT ?) s
+        JOIN Artworks a ON a.artwork_id = s.rowid
+        JOIN Users u ON u.user_id = a.user_id
+        ORDER BY s.rank
+    ''', (query, limit)).fetchall()
+    for row in rows:
+        result = dict(row)
+        result['matched'] = 'artwork'
+        results[row['artwork_id']] = result
+
+    # Artworks whose comments match, if there is room left
+    if len(results) < limit:
+        rows = conn.execute(f'''
+            SELECT a.artwork_id, a.title, a.image_path, a.image_variants, a.like_count,
+                   u.username AS artist_name, a.title AS title_marked, s.snippet_marked
+            FROM (SELECT artwork_id, rank,
+                         snippet(CommentSearch, 0, '{MARK_START}', '{MARK_END}', '…', 16) AS snippet_marked
+                  FROM CommentSearch WHERE CommentSearch MATCH ? ORDER BY rank LIMIT ?) s
+            JOIN Artworks a ON a.artwork_id = s.artwork_id
+            JOIN Users u ON u.user_id = a.user_id
+            WHERE a.pending = 0
+            ORDER BY s.rank
+        ''', (query, limit * 2)).fetchall()
+        for row in rows:
+            if row['artwork_id'] not in results and len(results) < limit:
+                result = dict(row)
+                result['matched'] = 'comment'
+                results[row['artwork_id']] = result
+
+    for result in results.values():
+        result['title_html'] = to_html(result.pop('title_marked'))
+        result['snippet_html'] = to_html(result.pop('snippet_marked'))
+    return list(results.values())
@@ -0,0 +1,404 @@
+# Production server - a pre-forking, multi-threaded WSGI server built on Werkzeug.
+#
+#   python serve.py [--host 0.0.0.0] [--port 8000] [--workers N] [--threads 8] [--keep-alive 2] [--migrate]
+#
+# The master process builds the app once, loads every template and checks the schema, then
+# forks --workers processes that share its listening socket. Each worker answers requests on a
+# pool of --threads threads. Background machinery (like flusher, image and password pools)
+# starts lazily inside each worker, never in the master.
+#
+# Signals to the master:
+#   TERM / INT  graceful shutdown - workers stop accepting, finish in-flight requests and exit
+#   HUP         graceful reload - the master re-executes itself (new code, same socket), starts
+#               fresh workers and only then retires the old ones, so no request is dropped
+#
+# Settings come from the environment, as for the dev server (DATABASE, SESSION_BACKEND, ...).
+# Session signing keys are kept in SECRET_KEY_FILE, so workers and reloads all share them.
+#
+# Several workers need the backends that hold shared state to be shared too (see PER_PROCESS):
+# the fragment cache is invalidated, and live events are published, only in the worker that
+# handled the write, and 'memory' sessions exist in one worker only. While any of them is
+# 'memory', serve.py runs a single worker (with a warning if --workers asked for more).
+#
+# Live updates (/events, Server-Sent Events) don't scale here: each open stream holds one of a
+# worker's request threads, so a worker keeps at most EVENTS_MAX_THREAD_STREAMS of them open and
+# answers the rest with 503, and those pages fall back to polling. Serve live audiences with asgi.py.
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import logging
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import InternalServerError
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
+
+import db
+import layout
+import compression
+import migrations
+from app import create_app
+
+LISTEN_FD = 'SERVE_LISTEN_FD'        # Passed across a reload: the inherited socket
+OLD_WORKERS = 'SERVE_OLD_WORKERS'    # ... and the workers the new master must retire
+KEEPALIVE_MAX_SKIP = 64 * 1024       # Unread request body skipped to keep a connection open
+
+# Backend settings whose 'memory' choice keeps state in one process. (Featured picks and login
+# rate limits are per process as well, but separate copies are harmless: picks are random and
+# the limits just add up across workers.)
+PER_PROCESS = (('CACHE_BACKEND', 'fragment cache'), ('EVENTS_BACKEND', 'live events'),
+               ('SESSION_BACKEND', 'sessions'))
+
+
+# Werkzeug's request handler, but with HTTP/1.1 keep-alive: Werkzeug ends every response with
+# "Connection: close". Here the connection stays open for the client's next request when
+#   - the client wants that (HTTP/1.1, or HTTP/1.0 with Connection: keep-alive),
+#   - the response's end can be seen - it has a Content-Length or is sent chunked, and
+#   - the request body has been read to its end (what the app left unread is skipped, up to
+#     KEEPALIVE_MAX_SKIP bytes; a bigger leftover closes the connection instead).
+class RequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = 15     # Seconds a request may stall while it is being read or answered
+    keep_alive = 2   # Seconds an idle connection waits for the next request before its thread is freed
+
+    def run_wsgi(self):
+        self.connection.settimeout(self.timeout)
+        if self.headers.get('Expect', '').lower().strip(' \t') == '100-continue':
+            self.wfile.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        environ = self.environ = self.make_environ()
+        body = None
+        if self.server.draining:
+            self.close_connection = True
+        if environ.get('wsgi.input_terminated'):
+            self.close_connection = True  # Chunked request body
+        else:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                self.close_connection = True
+            else:
+                body = environ['wsgi.input'] = LimitedStream(self.rfile, length)
+
+        status_set = headers_set = None
+        headers_sent = chunked = False
+
+        def write(data):
+            nonlocal headers_sent, chunked
+            if not headers_sent:
+                headers_sent = True
+                code, _, reason = status_set.partition(' ')
+                code = int(code)
+                self.send_response(code, reason)
+                keys = set()
+                for key, value in headers_set:
+                    self.send_header(key, value)
+                    keys.add(key.lower())
+                if not ('content-length' in keys or environ['REQUEST_METHOD'] == 'HEAD'
+                        or 100 <= code < 200 or code in (204, 304)):
+                    if self.request_version == 'HTTP/1.1':
+                        chunked = True
+                        self.send_header('Transfer-Encoding', 'chunked')
+                    else:
+                        self.close_connection = True  # The end of the body is the end of the connection
+                if body is not None and length - body.tell() > KEEPALIVE_MAX_SKIP:
+                    self.close_connection = True
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                elif self.request_version != 'HTTP/1.1':
+                    self.send_header('Connection', 'keep-alive')
+                self.end_headers()
+            if data:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data) if chunked else data)
+            self.wfile.flush()
+
+        def start_response(status, headers, exc_info=None):
+            nonlocal status_set, headers_set
+            if exc_info:
+                try:
+                    if headers_sent:
+                        raise exc_info[1].with_traceback(exc_info[2])
+                finally:
+                    exc_info = None
+            elif headers_set:
+                raise AssertionError("Headers already set")
+            status_set, headers_set = status, headers
+            return write
+
+        def execute(app):
+            application_iter = app(environ, start_response)
+            try:
+                for data in application_iter:
+                    write(data)
+                if not headers_sent:
+                    write(b'')
+                if chunked:
+                    self.wfile.write(b'0\r\n\r\n')
+            finally:
+                if hasattr(application_iter, 'close'):
+                    application_iter.close()
+
+        try:
+            execute(self.server.app)
+        except (ConnectionError, socket.timeout) as e:
+            self.close_connection = True
+            self.connection_dropped(e, environ)
+            return
+        except Exception:
+            logging.exception(f"Error on request {environ['REQUEST_METHOD']} {environ['PATH_INFO']}")
+            self.close_connection = True
+            if not headers_sent:  # Otherwise part of a response has gone out - closing is all that's left
+                status_set = headers_set = None
+                try:
+                    execute(InternalServerError())
+                except Exception:
+                    pass
+            return
+
+        if body is not None and not self.close_connection:
+            body.exhaust()
+        self.connection.settimeout(self.keep_alive)
+
+    # An idle kept-alive connection timing out is routine, not an error
+    def log_error(self, format, *args):
+        if not format.startswith('Request timed out'):
+            super().log_error(format, *args)
+
+
+# Werkzeug's server, answering each connection on a fixed pool of threads
+# (its ThreadedWSGIServer starts an unbounded thread per connection instead)
+class PooledWSGIServer(BaseWSGIServer):
+    multithread = True
+    daemon_threads = True
+    draining = False  # Set on shutdown: requests still arriving on kept-alive connections close them
+
+    def __init__(self, host, port, app, threads, fd):
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    # Stop accepting, then wait for the requests already being answered
+    def drain(self):
+        self.draining = True
+        self.shutdown()
+        self.executor.shutdown(wait=True)
+
+
+def bind(host, port, backlog=2048):
+    inherited = os.environ.pop(LISTEN_FD, None)
+    if inherited is not None:
+        sock = socket.socket(fileno=int(inherited))
+    else:
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+# Everything worth doing once, before the fork, so workers share it copy-on-write
+def preload(app, migrate):
+    layout.compile_templates(app)  # From the bytecode cache when it has them
+    compression.precompress_static(app)  # .br/.gz siblings of static text files, if missing or stale
+
+    with app.app_context():
+        conn = db.get_db()
+        if migrate:
+            applied = migrations.migrate(conn)
+            logging.info(f"Migrations applied: {applied or 'none'}")
+        version = migrations.schema_version(conn)
+    # SQLite connections must not cross a fork - each worker opens its own
+    app.extensions['db_pool'].close_all()
+
+    if version != migrations.LATEST_VERSION:
+        sys.exit(f"Database is at schema version {version}, the code expects {migrations.LATEST_VERSION}. "
+                 f"Run with --migrate (or `flask --app app migrate`).")
+
+
+def run_worker(app, sock, args):
+    RequestHandler.keep_alive = args.keep_alive
+    server = PooledWSGIServer(args.host, args.port, app, args.threads, sock.fileno())
+
+    def stop(signum, frame):
+        threading.Thread(target=server.drain, name='drain').start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole group; the master decides
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    logging.info(f"Worker {os.getpid()} serving on {args.threads} threads")
+    server.serve_forever()
+    server.executor.shutdown(wait=True)
+
+
+class Master:
+    def __init__(self, app, sock, args):
+        self.app = app
+        self.sock = sock
+        self.args = args
+        self.workers = set()
+        self.retiring = set()  # Workers from before a reload, finishing their last requests
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(self.app, self.sock, self.args)
+            except BaseException:
+                logging.exception(f"Worker {os.getpid()} crashed")
+                os._exit(1)
+            # Exiting normally runs the atexit hooks: pending likes are flushed, process pools shut down
+            sys.exit(0)
+        self.workers.add(pid)
+        return pid
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        for _ in range(self.args.workers):
+            self.spawn()
+        self._retire_previous_generation()
+        logging.info(f"Master {os.getpid()} listening on {self.args.host}:{self.args.port} "
+                     f"with {self.args.workers} workers")
+
+        while not self.stopping:
+            if self.reloading:
+                self._reload()
+            self._reap(restart=True)
+            time.sleep(0.5)
+        self._shutdown()
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reloading = True
+
+    # Collect exited workers, replacing any that died unexpectedly
+    def _reap(self, restart):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.retiring.discard(pid)
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if restart and not self.stopping:
+                    logging.warning(f"Worker {pid} exited ({status}); starting a replacement")
+                    self._replay_likes()
+                    self.spawn()
+
+    # A worker that died may have acknowledged likes it never flushed - write them from its journal
+    def _replay_likes(self):
+        try:
+            self.app.extensions['likes'].replay_journals()
+        except Exception:
+            logging.exception("Could not replay the like journal; it will be retried at the next start")
+        finally:
+            self.app.extensions['db_pool'].close_all()  # No connection may cross the next fork
+
+    def _shutdown(self):
+        logging.info("Shutting down: waiting for workers to finish their requests")
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.args.graceful_timeout
+        while (self.workers or self.retiring) and time.monotonic() < deadline:
+            self._reap(restart=False)
+            time.sleep(0.1)
+        for pid in self.workers | self.retiring:
+            logging.warning(f"Worker {pid} did not stop in time; killing it")
+            os.kill(pid, signal.SIGKILL)
+
+    # Re-execute this program in place. The pid, the socket and the running workers carry over;
+    # the new master starts its own workers and then retires the old ones.
+    def _reload(self):
+        self.reloading = False
+        check = subprocess.run([sys.executable, '-c', 'import app'], capture_output=True, text=True)
+        if check.returncode != 0:
+            logging.error(f"Not reloading - the new code does not import:\n{check.stderr}")
+            return
+        logging.info("Reloading")
+        os.environ[LISTEN_FD] = str(self.sock.fileno())
+        os.environ[OLD_WORKERS] = ','.join(str(pid) for pid in self.workers | self.retiring)
+        args = [a for a in sys.argv if a != '--migrate']
+        os.execv(sys.executable, [sys.executable] + args)
+
+    def _retire_previous_generation(self):
+        old = [int(pid) for pid in os.environ.pop(OLD_WORKERS, '').split(',') if pid]
+        for pid in old:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+            else:
+                self.retiring.add(pid)  # Still our children; _reap() collects them without replacing them
+
+
+# The PER_PROCESS settings this app has at 'memory', as ['CACHE_BACKEND (fragment cache)', ...]
+def per_process_backends(app):
+    found = []
+    for key, name in PER_PROCESS:
+        if key == 'CACHE_BACKEND' and not app.config['CACHE_ENABLED']:
+            continue
+        if app.config[key] == 'memory':
+            found.append(f'{key} ({name})')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the app with several worker processes.',
+        epilog='Live updates (Server-Sent Events) only scale under asgi.py: here each open stream holds a '
+               'request thread, so a worker keeps at most EVENTS_MAX_THREAD_STREAMS of them open and '
+               'turns the rest away with 503 (those pages poll instead).')
+    parser.add_argument('--host', default=os.environ.get('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: one per CPU, or 1 while a backend is per-process)')
+    parser.add_argument('--threads', type=int, default=8, help='request threads per worker')
+    parser.add_argument('--keep-alive', type=float, default=RequestHandler.keep_alive,
+                        help='seconds an idle connection is kept open for its next request')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='seconds workers get to finish their requests on shutdown')
+    parser.add_argument('--migrate', action='store_true', help='apply pending migrations before starting')
+    args = parser.parse_args()
+
+    app = create_app()
+    unshared = per_process_backends(app)
+    if args.workers is None:
+        args.workers = 1 if unshared else os.cpu_count() or 2
+    elif args.workers > 1 and unshared:
+        logging.warning(f"Running 1 worker instead of {args.workers}: {', '.join(unshared)} "
+                        f"keep their state in one process. Set them to 'redis' to run several.")
+        args.workers = 1
+    preload(app, args.migrate)
+    sock = bind(args.host, args.port)
+    Master(app, sock, args).run()
+
+
+if __name__ == '__main__':
+    main()
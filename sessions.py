@@ -0,0 +1,448 @@
+import os
+import json
+import time
+import atexit
+import secrets
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+from flask import g, current_app, has_app_context
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from itsdangerous import Signer, BadSignature
+
+# Server-side sessions.
+#
+# The cookie holds only a short random session ID, signed with the key ring; the session data
+# lives in a store (SESSION_BACKEND):
+#   'sqlite'  the Sessions table - shared by every worker on this machine (default)
+#   'memory'  an in-process LRU - one process only (dev server, tests)
+#   'redis'   shared between machines (needs the redis package)
+#
+# The store is only read when a view actually touches `session`, and only written when the
+# session changed (or is due an expiry refresh) - not re-signed and re-sent on every response.
+# Expired sessions are swept by a background thread every SESSION_SWEEP_INTERVAL seconds.
+#
+# Keys: the key ring is a JSON file (SECRET_KEY_FILE) of signing keys, newest first, made on the
+# first start and kept across restarts, so every worker and every restart agrees on them.
+# `flask --app app rotate-keys` adds a new key; cookies signed with the older keys in the ring
+# stay valid until they drop off the end. A SECRET_KEY setting, if given, is used as the newest key.
+
+
+# Session stores. Every backend has the same methods; data is a dict, expires_at a Unix time.
+#   load(sid)                      -> (data, expires_at), or None if there is no live session with this ID
+#   save(sid, data, expires_at)
+#   touch(sid, expires_at)         push the expiry back without rewriting the data
+#   delete(sid)
+#   sweep()                        remove expired sessions, returning how many
+#   stats()                        a dict for /stats/sessions
+
+
+class MemorySessionStore:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # sid -> (data, expires_at), least recently used first
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._data.get(sid)
+            if entry is None or entry[1] < time.time():
+                return None
+            self._data.move_to_end(sid)
+            return session_json_serializer.loads(entry[0]), entry[1]
+
+    def save(self, sid, data, expires_at):
+        value = session_json_serializer.dumps(data)  # A copy, so later changes to the dict don't leak in
+        with self._lock:
+            self._data[sid] = (value, expires_at)
+            self._data.move_to_end(sid)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def touch(self, sid, expires_at):
+        with self._lock:
+            if sid in self._data:
+                self._data[sid] = (self._data[sid][0], expires_at)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, (_, expires_at) in self._data.items() if expires_at < now]
+            for sid in expired:
+                del self._data[sid]
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'sessions': len(self._data)}
+
+
+# Session writes never share a transaction with the request's own work. A request that already
+# holds a connection with nothing uncommitted lends it to the store; otherwise a second one is
+# borrowed - waiting for it while holding the first would deadlock once every request did so.
+class SQLiteSessionStore:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def _run(self, fn):
+        if has_app_context() and 'db' in g and not g.db.in_transaction:
+            return fn(g.db)
+        conn = self.pool.acquire()
+        try:
+            return fn(conn)
+        finally:
+            self.pool.release(conn)
+
+    def load(self, sid):
+        row = self._run(lambda conn: conn.execute(
+            'SELECT data, expires_at FROM Sessions WHERE session_id = ? AND expires_at > ?', (sid, time.time())
+        ).fetchone())
+        return (session_json_serializer.loads(row['data']), row['expires_at']) if row else None
+
+    def save(self, sid, data, expires_at):
+        def save(conn):
+            conn.execute('INSERT OR REPLACE INTO Sessions (session_id, data, expires_at) VALUES (?, ?, ?)',
+                         (sid, session_json_serializer.dumps(data), expires_at))
+            conn.commit()
+        self._run(save)
+
+    def touch(self, sid, expires_at):
+        def touch(conn):
+            conn.execute('UPDATE Sessions SET expires_at = ? WHERE session_id = ?', (expires_at, sid))
+            conn.commit()
+        self._run(touch)
+
+    def delete(self, sid):
+        def delete(conn):
+            conn.execute('DELETE FROM Sessions WHERE session_id = ?', (sid,))
+            conn.commit()
+        self._run(delete)
+
+    def sweep(self):
+        def sweep(conn):
+            removed = conn.execute('DELETE FROM Sessions WHERE expires_at < ?', (time.time(),)).rowcount
+            conn.commit()
+            return removed
+        return self._run(sweep)
+
+    def stats(self):
+        count = self._run(lambda conn: conn.execute('SELECT COUNT(*) FROM Sessions').fetchone()[0])
+        return {'backend': 'sqlite', 'sessions': count}
+
+
+class RedisSessionStore:
+    def __init__(self, url, prefix='georgie:session:'):
+        import redis  # Optional dependency, only needed for SESSION_BACKEND = 'redis'
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def load(self, sid):
+        pipe = self._redis.pipeline()
+        pipe.get(self.prefix + sid)
+        pipe.ttl(self.prefix + sid)
+        value, ttl = pipe.execute()
+        if value is None:
+            return None
+        return session_json_serializer.loads(value), time.time() + max(ttl, 0)
+
+    def save(self, sid, data, expires_at):
+        ttl = max(1, int(expires_at - time.time()))
+        self._redis.set(self.prefix + sid, session_json_serializer.dumps(data), ex=ttl)
+
+    def touch(self, sid, expires_at):
+        self._redis.expire(self.prefix + sid, max(1, int(expires_at - time.time())))
+
+    def delete(self, sid):
+        self._redis.delete(self.prefix + sid)
+
+    # Redis expires keys itself
+    def sweep(self):
+        return 0
+
+    def stats(self):
+        return {'backend': 'redis'}
+
+
+# Signing keys, newest first, kept in a JSON file and re-read when another process rotates them
+class KeyRing:
+    def __init__(self, path, size=3, check_interval=10, pinned=None):
+        self.path = path
+        self.size = size
+        self.check_interval = check_interval
+        self.pinned = pinned  # SECRET_KEY from the config, always the newest key
+        self._keys = []
+        self._mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self._load(create=True)
+
+    def _load(self, create=False):
+        try:
+            with open(self.path) as f:
+                keys = json.load(f)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            if not create:
+                return
+            keys = self._create()
+        self._keys = ([self.pinned] if self.pinned else []) + [k for k in keys if k != self.pinned]
+
+    # Made once; several workers starting together all end up with the same file
+    def _create(self):
+        keys = [secrets.token_urlsafe(32)]
+        self._write(keys, replace=False)
+        with open(self.path) as f:
+            keys = json.load(f)
+        self._mtime = os.stat(self.path).st_mtime_ns
+        return keys
+
+    def _write(self, keys, replace=True):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.keys-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(keys, f)
+            os.chmod(tmp, 0o600)
+            if replace:
+                os.replace(tmp, self.path)
+            else:
+                try:
+                    os.link(tmp, self.path)  # Fails if another process got there first
+                except FileExistsError:
+                    pass
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @property
+    def keys(self):
+        now = time.monotonic()
+        if now - self._checked_at > self.check_interval:
+            with self._lock:
+                self._checked_at = now
+                try:
+                    if os.stat(self.path).st_mtime_ns != self._mtime:
+                        self._load()
+                except FileNotFoundError:
+                    pass
+        return self._keys
+
+    @property
+    def current(self):
+        return self.keys[0]
+
+    # Add a fresh key at the front, dropping the oldest beyond `size`. Returns the new ring.
+    def rotate(self):
+        with self._lock:
+            with open(self.path) as f:
+                stored = json.load(f)
+            keys = ([secrets.token_urlsafe(32)] + stored)[:self.size]
+            self._write(keys)
+            self._load()
+        return self._keys
+
+
+class ServerSession(SessionMixin):
+    def __init__(self, store, sid=None):
+        self.store = store
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        self.expires_at = None
+        self.stale_sid = None  # Set by regenerate(), deleted from the store on save
+        self._data = None
+
+    # Nothing is read from the store until the session is first used
+    def _load(self):
+        if self._data is None:
+            self.accessed = True
+            entry = self.store.load(self.sid) if self.sid else None
+            if entry is None:
+                self._data = {}
+                if self.sid:  # Expired or unknown - start afresh under a new ID
+                    self.sid = None
+                    self.new = True
+            else:
+                self._data, self.expires_at = entry
+        return self._data
+
+    # Read the data now rather than on first use (asgi.py does this off the event loop)
+    def load(self):
+        self._load()
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def clear(self):
+        self._load().clear()
+        self.modified = True
+
+    # Move the data to a new ID - call on login, so an ID planted before login is useless after it
+    def regenerate(self):
+        self._load()
+        if self.sid:
+            self.stale_sid = self.sid
+        self.sid = None
+        self.new = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store, key_ring):
+        self.store = store
+        self.key_ring = key_ring
+
+    def _signer(self):
+        return Signer(list(reversed(self.key_ring.keys)), salt='session')  # Signs with the newest key
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        sid = None
+        if cookie:
+            try:
+                sid = self._signer().unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+        return ServerSession(self.store, sid)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed or session.loaded:
+            response.vary.add('Cookie')
+        if session.stale_sid:
+            self.store.delete(session.stale_sid)
+        if not session.loaded:
+            return  # Never touched - nothing to write, cookie unchanged
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        if not session._data:
+            if session.modified and session.sid:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app), httponly=self.get_cookie_httponly(app),
+                                       samesite=self.get_cookie_samesite(app))
+            return
+
+        set_cookie = False
+        if session.modified:
+            if session.sid is None:
+                session.sid = secrets.token_urlsafe(16)
+                set_cookie = True
+            session.expires_at = now + lifetime
+            self.store.save(session.sid, session._data, session.expires_at)
+        elif session.expires_at - now < lifetime / 2:
+            # Sliding expiry, but at most one write per half-lifetime
+            session.expires_at = now + lifetime
+            self.store.touch(session.sid, session.expires_at)
+            set_cookie = session.permanent
+        else:
+            return
+
+        if set_cookie:
+            response.set_cookie(
+                name, self._signer().sign(session.sid).decode(),
+                expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path, secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app), partitioned=self.get_cookie_partitioned(app),
+            )
+
+
+# Sweeps expired sessions from the store. Started by the first request, so CLI
+# commands and pre-fork parents never own the thread.
+class Sweeper:
+    def __init__(self, store, interval):
+        self.store = store
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.swept = 0
+
+    def start(self):
+        if self._thread is not None or not self.interval:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='session-sweeper', daemon=True)
+                self._thread.start()
+                atexit.register(self._stop.set)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                removed = self.store.sweep()
+                self.swept += removed
+                if removed:
+                    logging.info(f"Swept {removed} expired sessions")
+            except Exception:
+                logging.exception("Session sweep failed; will retry")
+
+
+def init_app(app):
+    app.config.setdefault('SESSION_BACKEND', 'sqlite')     # 'sqlite', 'memory' (one process) or 'redis'
+    app.config.setdefault('SESSION_REDIS_URL', app.config.get('CACHE_URL', 'redis://localhost:6379/0'))
+    app.config.setdefault('SESSION_MAX_ENTRIES', 10000)    # Memory backend only
+    app.config.setdefault('SESSION_SWEEP_INTERVAL', 300)   # Seconds between expiry sweeps (0 = never)
+    app.config.setdefault('SECRET_KEY_FILE', os.path.join(os.path.dirname(os.path.abspath(app.config['DATABASE'])),
+                                                          'secret_keys.json'))
+    app.config.setdefault('SECRET_KEY_RING_SIZE', 3)       # Keys kept, so the last rotations stay valid
+
+    key_ring = KeyRing(app.config['SECRET_KEY_FILE'], app.config['SECRET_KEY_RING_SIZE'],
+                       pinned=app.config.get('SECRET_KEY'))
+    app.secret_key = key_ring.current
+    app.config['SECRET_KEY_FALLBACKS'] = key_ring.keys[1:]
+
+    backend = app.config['SESSION_BACKEND']
+    if backend == 'memory':
+        store = MemorySessionStore(app.config['SESSION_MAX_ENTRIES'])
+    elif backend == 'redis':
+        store = RedisSessionStore(app.config['SESSION_REDIS_URL'])
+    else:
+        store = SQLiteSessionStore(app.extensions['db_pool'])
+
+    sweeper = Sweeper(store, app.config['SESSION_SWEEP_INTERVAL'])
+    app.session_interface = ServerSessionInterface(store, key_ring)
+    app.extensions['sessions'] = {'store': store, 'key_ring': key_ring, 'sweeper': sweeper}
+
+    @app.after_request
+    def start_sweeper(response):
+        sweeper.start()
+        return response
+
+    logging.info(f"Server-side sessions ready ({backend})")
+
+
+def get_store():
+    return current_app.extensions['sessions']['store']
@@ -0,0 +1,20 @@
+from blinker import Namespace
+
+# Events the routes send after changing data. Caches and other subsystems subscribe
+# to these instead of the routes having to know about every one of them.
+#
+#   artwork_liked.send(app, artwork_id=..., user_id=..., liked=True/False, like_count=...)
+#   comment_posted.send(app, artwork_id=..., comment_id=..., user_id=...)
+#   artwork_approved.send(app, artwork_id=...)
+#   artwork_rejected.send(app, artwork_id=...)
+#   likes_flushed.send(app, artwork_ids={...})   - batched likes reached the database (likes.py)
+#   artwork_updated.send(app, artwork_id=...)    - its image variants are ready (images.py)
+
+_signals = Namespace()
+
+artwork_liked = _signals.signal('artwork-liked')
+comment_posted = _signals.signal('comment-posted')
+artwork_approved = _signals.signal('artwork-approved')
+artwork_rejected = _signals.signal('artwork-rejected')
+likes_flushed = _signals.signal('likes-flushed')
+artwork_updated = _signals.signal('artwork-updated')
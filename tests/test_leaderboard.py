@@ -0,0 +1,139 @@
+import time
+import random
+
+import pytest
+from flask import Flask
+
+import db
+import leaderboard
+import migrations
+
+
+# What top() and rank() should say, worked out the slow way
+def brute_force(scores):
+    ranked = sorted(((artwork_id, score) for artwork_id, score in scores.items() if score > 0),
+                    key=lambda entry: (-entry[1], entry[0]))
+    return [(artwork_id, score, 1 + sum(1 for other in scores.values() if other > score))
+            for artwork_id, score in ranked]
+
+
+def test_scoreboard_matches_brute_force():
+    rng = random.Random(20)
+    scores = {artwork_id: rng.randint(0, 6) for artwork_id in range(1, 60)}
+    board = leaderboard.ScoreBoard(scores)
+    for step in range(500):
+        artwork_id = rng.randint(1, 80)
+        delta = rng.choice((1, 1, 1, -1, -1, 3, -4))
+        board.add(artwork_id, delta)
+        scores[artwork_id] = max(0, scores.get(artwork_id, 0) + delta)
+
+        if step % 25 == 0:
+            expected = brute_force(scores)
+            assert len(board) == len(expected)
+            assert board.top(len(expected) + 5) == expected
+            for offset, limit in ((0, 1), (0, 10), (3, 7), (10, 10), (len(expected) - 2, 5), (len(expected), 5)):
+                assert board.top(limit, offset) == expected[offset:offset + limit]
+            for artwork_id in range(1, 81):
+                score = scores.get(artwork_id, 0)
+                assert board.score(artwork_id) == score
+                assert board.rank(artwork_id) == 1 + sum(1 for other in scores.values() if other > score)
+    assert board.scores() == {artwork_id: score for artwork_id, score in scores.items() if score}
+
+
+# A database with three users and five approved artworks, and a Leaderboard that only syncs when told
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config.update(DATABASE=str(tmp_path / 'leaderboard.db'), LEADERBOARD_SNAPSHOT_INTERVAL=0)
+    db.init_app(app)
+    leaderboard.init_app(app)
+    with app.app_context():
+        conn = db.get_db()
+        migrations.migrate(conn)
+        conn.executemany("INSERT INTO Users (user_id, username, email, password, first_name, surname) "
+                         "VALUES (?, ?, ?, 'x', 'A', 'B')",
+                         [(u, f'user{u}', f'user{u}@example.com') for u in range(1, 4)])
+        conn.executemany("INSERT INTO Artworks (artwork_id, user_id, title, pending) VALUES (?, 1, 'Art', 0)",
+                         [(a,) for a in range(1, 6)])
+        conn.commit()
+    yield app
+    app.extensions['db_pool'].close_all()
+
+
+def execute(app, sql, params=()):
+    with app.app_context():
+        conn = db.get_db()
+        if isinstance(params, list):
+            conn.executemany(sql, params)
+        else:
+            conn.execute(sql, params)
+        conn.commit()
+
+
+def like_counts(app):
+    with app.app_context():
+        return dict(db.get_db().execute('SELECT artwork_id, like_count FROM Artworks WHERE like_count > 0'))
+
+
+# A restarted worker loads the saved boards, then catches up on likes added and removed since.
+# A like removed after the snapshot counts against it; one added and removed since never counted.
+def test_load_from_snapshot_then_catch_up(app):
+    like = 'INSERT INTO Likes (user_id, artwork_id) VALUES (?, ?)'
+    execute(app, like, [(1, 1), (2, 1), (3, 1), (1, 2), (2, 2), (1, 3)])
+
+    first = leaderboard.Leaderboard(app)
+    first.sync()
+    assert first.snapshot()
+
+    execute(app, 'DELETE FROM Likes WHERE user_id = 3 AND artwork_id = 1')  # Counted in the snapshot
+    execute(app, like, [(2, 3), (3, 3), (1, 4)])
+    execute(app, 'DELETE FROM Likes WHERE user_id = 1 AND artwork_id = 4')  # Never in the snapshot
+    execute(app, like, [(3, 5)])
+
+    restarted = leaderboard.Leaderboard(app)
+    restarted.sync()
+    expected = like_counts(app)
+    assert expected == {1: 2, 2: 2, 3: 3, 5: 1}
+    for name in restarted.boards:
+        assert {a: s for a, s, _ in restarted.top(name, 100)} == expected
+    assert restarted.rank('all', 3) == (1, 3, 4)
+    assert restarted.rank('all', 4) == (5, 0, 4)
+
+    # The running worker catches up on the same changes to the same scores
+    first.sync()
+    assert {a: s for a, s, _ in first.top('all', 100)} == expected
+
+
+# The yearly boards come from the snapshot rather than a recount
+def test_load_uses_snapshot(app):
+    execute(app, 'INSERT INTO Likes (user_id, artwork_id) VALUES (?, ?)', [(1, 1), (2, 2)])
+    first = leaderboard.Leaderboard(app)
+    first.sync()
+    assert first.snapshot()
+    assert not first.snapshot()  # Nothing newer to save
+
+    execute(app, "UPDATE LeaderboardScores SET score = 7 WHERE board = 'all' AND artwork_id = 2")
+    restarted = leaderboard.Leaderboard(app)
+    restarted.sync()
+    assert restarted.top('all', 2) == [(2, 7, 1), (1, 1, 2)]
+    assert restarted.top('hour', 2) == [(1, 1, 1), (2, 1, 1)]  # Windows are always rebuilt from Likes
+
+
+# Profile and artwork-stats ranks within a submission year, re-read once LEADERBOARD_YEAR_RANK_TTL passes
+def test_year_ranks(app):
+    execute(app, "INSERT INTO Artworks (artwork_id, user_id, title, pending, submission_date) "
+                 "VALUES (6, 2, 'Art', 0, '2024-06-01 12:00:00'), (7, 3, 'Art', 0, '2024-06-01 12:00:00')")
+    execute(app, "UPDATE Artworks SET like_count = ? WHERE artwork_id = ?", [(3, 2), (1, 3), (2, 7)])
+    ranks = app.extensions['year_ranks']
+    year = time.strftime('%Y', time.gmtime())  # Of CURRENT_TIMESTAMP, the other artworks' submission_date
+
+    assert [ranks.artwork(year, a) for a in (1, 2, 3, 4)] == [3, 1, 2, 3]
+    assert ranks.artist(year, 1) == (1, 1)
+    assert ranks.artwork('2024', 7) == 1 and ranks.artwork('2024', 6) == 2
+    assert ranks.artist('2024', 3) == (1, 2) and ranks.artist('2024', 2) == (2, 2)
+
+    execute(app, "UPDATE Artworks SET like_count = 5 WHERE artwork_id = 6")
+    assert ranks.artist('2024', 2) == (2, 2)  # Still the board read above
+    ranks.ttl = 0
+    assert ranks.artist('2024', 2) == (1, 2)
+    assert ranks.artwork('2024', 7) == 2
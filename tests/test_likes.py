@@ -0,0 +1,162 @@
+import os
+import json
+import sqlite3
+
+import pytest
+from flask import Flask
+
+import db
+import likes
+import migrations
+
+
+# A LikeService on a fresh database with one user and two approved artworks. The flusher thread
+# never wakes on its own, so each test decides when a flush happens.
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config.update(DATABASE=str(tmp_path / 'likes.db'), LIKE_FLUSH_INTERVAL=3600, LIKE_RECONCILE_INTERVAL=0)
+    db.init_app(app)
+    likes.init_app(app)
+    with app.app_context():
+        conn = db.get_db()
+        migrations.migrate(conn)
+        conn.execute("INSERT INTO Users (user_id, username, email, password, first_name, surname) "
+                     "VALUES (1, 'ada', 'ada@example.com', 'x', 'Ada', 'L')")
+        conn.executemany("INSERT INTO Artworks (artwork_id, user_id, title, pending) VALUES (?, 1, ?, 0)",
+                         [(1, 'One'), (2, 'Two')])
+        conn.commit()
+    yield app
+    app.extensions['likes'].stop()
+    app.extensions['db_pool'].close_all()
+
+
+@pytest.fixture
+def service(app):
+    return app.extensions['likes']
+
+
+def query(app, sql, params=()):
+    with app.app_context():
+        return [tuple(row) for row in db.get_db().execute(sql, params).fetchall()]
+
+
+def write_journal(path, entries, tail=''):
+    with open(path, 'w') as f:
+        f.writelines(json.dumps(entry) + '\n' for entry in entries)
+        f.write(tail)
+
+
+def test_toggle_back_leaves_nothing_to_write(app, service):
+    with app.app_context():
+        assert service.toggle(db.get_db(), 1, 1) == (True, 1)
+        assert service.toggle(db.get_db(), 1, 1) == (False, 0)
+    assert service._pending == {} and service._deltas == {}
+    assert service.flush() == 0
+    assert query(app, 'SELECT user_id, artwork_id FROM Likes') == []
+
+
+def test_flush_writes_likes(app, service):
+    with app.app_context():
+        service.toggle(db.get_db(), 1, 1)
+    assert service.flush() == 1
+    assert query(app, 'SELECT user_id, artwork_id FROM Likes') == [(1, 1)]
+    assert query(app, 'SELECT like_count FROM Artworks WHERE artwork_id = 1') == [(1,)]
+    assert not os.path.exists(service.journal_path + '.flushing')
+
+
+# A failed write puts the batch back, and its journal stays as .flushing for the next attempt
+def test_failed_flush_restores_pending(app, service, monkeypatch):
+    with app.app_context():
+        service.toggle(db.get_db(), 1, 1)
+        service.toggle(db.get_db(), 1, 2)
+
+    def locked(conn, batch):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(service, '_apply', locked)
+    with pytest.raises(sqlite3.OperationalError):
+        service.flush()
+
+    assert service._pending == {(1, 1): True, (1, 2): True}
+    assert service._deltas == {1: 1, 2: 1}
+    assert service._flushing == {} and service._flushing_deltas == {}
+    assert service.failed_flushes == 1
+    assert os.path.exists(service.journal_path + '.flushing')
+
+    monkeypatch.undo()
+    assert service.flush() == 2
+    assert query(app, 'SELECT user_id, artwork_id FROM Likes ORDER BY artwork_id') == [(1, 1), (1, 2)]
+
+
+# A click made while a failed batch was being written cancels the restored change, not doubles it
+def test_failed_flush_keeps_newer_clicks(app, service, monkeypatch):
+    with app.app_context():
+        service.toggle(db.get_db(), 1, 1)
+
+    def undo_during_flush(conn, batch):
+        with app.app_context():
+            service.toggle(db.get_db(), 1, 1)  # Unliked while the batch was being written
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(service, '_apply', undo_during_flush)
+    with pytest.raises(sqlite3.OperationalError):
+        service.flush()
+    monkeypatch.undo()
+
+    assert service._pending == {} and service._deltas == {}
+    assert service.flush() == 0
+    assert query(app, 'SELECT user_id, artwork_id FROM Likes') == []
+
+
+# A second failure appends the newer journal to the .flushing one, so order is kept
+def test_flushing_journal_merged_with_newer(app, service, monkeypatch):
+    def locked(conn, batch):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(service, '_apply', locked)
+
+    with app.app_context():
+        service.toggle(db.get_db(), 1, 1)
+        with pytest.raises(sqlite3.OperationalError):
+            service.flush()
+        service.toggle(db.get_db(), 1, 1)
+        service.toggle(db.get_db(), 1, 2)
+        with pytest.raises(sqlite3.OperationalError):
+            service.flush()
+
+    flushing_path = service.journal_path + '.flushing'
+    assert not os.path.exists(service.journal_path)
+    with open(flushing_path) as f:
+        assert [json.loads(line) for line in f] == [[1, 1, True], [1, 1, False], [1, 2, True]]
+
+
+# Replay reads .flushing before the newer journal, so the last click wins
+def test_replay_applies_flushing_before_newer(app, service):
+    base = f'{app.config["LIKE_JOURNAL"]}.{os.getpid()}'
+    write_journal(base + '.flushing', [[1, 1, True], [1, 2, True]])
+    write_journal(base, [[1, 1, False]])
+
+    assert service.replay_journals() == 2
+    assert query(app, 'SELECT user_id, artwork_id FROM Likes') == [(1, 2)]
+    assert not os.path.exists(base) and not os.path.exists(base + '.flushing')
+
+
+def test_replay_stops_at_torn_line(app, service):
+    path = f'{app.config["LIKE_JOURNAL"]}.{os.getpid()}'
+    write_journal(path, [[1, 1, True]], tail='[1, 2, tr')
+
+    assert service.replay_journals() == 1
+    assert query(app, 'SELECT user_id, artwork_id FROM Likes') == [(1, 1)]
+    assert not os.path.exists(path)
+
+
+# Liked ids come from the database with unflushed likes and unlikes laid over them
+def test_liked_ids_overlay_pending(app, service):
+    with app.app_context():
+        conn = db.get_db()
+        conn.execute('INSERT INTO Likes (user_id, artwork_id) VALUES (1, 1)')
+        conn.commit()
+        assert service.liked_ids(conn, 1, [1, 2]) == {1}
+
+        service.toggle(conn, 1, 1)
+        service.toggle(conn, 1, 2)
+        assert service.liked_ids(conn, 1, [1, 2]) == {2}
+        assert service.has_liked(conn, 1, 1) is False
@@ -0,0 +1,32 @@
+import sqlite3
+
+import pytest
+
+import migrations
+
+
+# A fresh database at the latest schema
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def test_migrations_reach_latest_version(conn):
+    assert migrations.schema_version(conn) == migrations.LATEST_VERSION
+
+
+# Every query in HOT_QUERIES must use an index - a full scan or temp sort here is a regression
+def test_hot_queries_use_indexes(conn):
+    assert migrations.check_query_plans(conn) == {}
+
+
+# The check itself must notice a scan, or the test above proves nothing
+def test_check_query_plans_reports_scans(conn):
+    queries = {'unindexed': ('SELECT * FROM Artworks WHERE description = ?', ('x',))}
+    problems = migrations.check_query_plans(conn, queries)
+    assert list(problems) == ['unindexed']
+    assert problems['unindexed'][0].startswith('SCAN ')
@@ -0,0 +1,128 @@
+import time
+from datetime import timedelta
+
+import pytest
+from flask import Flask, session
+from itsdangerous import Signer, BadSignature
+
+import sessions
+
+
+# A small app on the memory store, with its key ring in a temporary directory
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config.update(DATABASE=str(tmp_path / 'sessions.db'), SESSION_BACKEND='memory', SESSION_SWEEP_INTERVAL=0,
+                      PERMANENT_SESSION_LIFETIME=timedelta(seconds=100))
+    sessions.init_app(app)
+
+    @app.route('/set/<value>')
+    def set_value(value):
+        session['value'] = value
+        return ''
+
+    @app.route('/get')
+    def get_value():
+        return session.get('value', '')
+
+    @app.route('/plain')
+    def plain():
+        return 'ok'
+
+    @app.route('/login')
+    def login():
+        session.regenerate()
+        session['user_id'] = 1
+        return ''
+
+    return app
+
+
+@pytest.fixture
+def store(app):
+    return app.extensions['sessions']['store']
+
+
+def session_id(app, client):
+    cookie = client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+    return app.session_interface._signer().unsign(cookie.value).decode()
+
+
+# After a rotation the new key signs, and cookies signed with the old one still validate
+def test_key_rotation_keeps_old_cookies_valid(tmp_path):
+    ring = sessions.KeyRing(str(tmp_path / 'keys.json'), size=2, check_interval=0)
+    interface = sessions.ServerSessionInterface(sessions.MemorySessionStore(), ring)
+    old_key = ring.current
+    old_cookie = interface._signer().sign('abc')
+
+    ring.rotate()
+    assert ring.keys[1] == old_key and ring.current != old_key
+    assert interface._signer().unsign(old_cookie) == b'abc'
+    assert interface._signer().sign('abc') == Signer(ring.current, salt='session').sign('abc')
+
+    ring.rotate()  # The original key drops off the end of a ring of two
+    assert old_key not in ring.keys
+    with pytest.raises(BadSignature):
+        interface._signer().unsign(old_cookie)
+
+
+# Another process's rotation is picked up from the file
+def test_key_ring_rereads_rotated_file(tmp_path):
+    path = str(tmp_path / 'keys.json')
+    ring = sessions.KeyRing(path, check_interval=0)
+    other = sessions.KeyRing(path, check_interval=0)
+    assert other.keys == ring.keys
+
+    other.rotate()
+    assert ring.current == other.current
+
+
+# Logging in moves the data to a new ID and deletes the old one from the store
+def test_regenerate_deletes_stale_sid(app, store):
+    client = app.test_client()
+    client.get('/set/x')
+    before = session_id(app, client)
+    assert store.load(before) is not None
+
+    client.get('/login')
+    after = session_id(app, client)
+    assert after != before
+    assert store.load(before) is None
+    assert store.load(after)[0] == {'value': 'x', 'user_id': 1}
+
+
+# Reading a session pushes its expiry back, but writes at most once per half-lifetime
+def test_sliding_expiry_writes_once_per_half_lifetime(app, store, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    writes = []
+    save, touch = store.save, store.touch
+    monkeypatch.setattr(store, 'save', lambda sid, data, expires_at: (writes.append('save'), save(sid, data, expires_at)))
+    monkeypatch.setattr(store, 'touch', lambda sid, expires_at: (writes.append('touch'), touch(sid, expires_at)))
+
+    client = app.test_client()
+    client.get('/set/x')
+    assert writes == ['save']
+
+    for elapsed in (10, 30, 49):  # More than half the lifetime left - nothing written
+        now[0] = 1000000.0 + elapsed
+        assert client.get('/get').data == b'x'
+    assert writes == ['save']
+
+    now[0] = 1000000.0 + 51
+    assert client.get('/get').data == b'x'
+    assert writes == ['save', 'touch']
+    assert store.load(session_id(app, client))[1] == now[0] + 100
+
+    now[0] = 1000000.0 + 100  # Past the first expiry, but it was pushed back
+    assert client.get('/get').data == b'x'
+    assert writes == ['save', 'touch']
+
+
+# A request that never touches the session reads and writes nothing
+def test_untouched_session_not_loaded(app, store, monkeypatch):
+    client = app.test_client()
+    client.get('/set/x')
+    monkeypatch.setattr(store, 'load', lambda sid: pytest.fail('session was loaded'))
+    response = client.get('/plain')
+    assert response.data == b'ok' and 'Set-Cookie' not in response.headers
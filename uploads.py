@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import tempfile
+import logging
+import threading
+
+from flask import Request, current_app
+
+import db
+import signals
+
+# Streaming upload storage.
+# Werkzeug hands each chunk of a multipart file straight to HashingUpload.write(), which
+# appends it to a temp file next to the uploads and feeds it to SHA-256 - nothing holds the
+# whole file in memory. Once the request is parsed the temp file is renamed to <sha256>.<ext>,
+# so the same image uploaded twice is stored once.
+
+
+# First bytes of every image type we accept -> file extension
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+SNIFF_BYTES = max(len(signature) for signature, _ in IMAGE_SIGNATURES)
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def sniff_image_type(head):
+    for signature, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return None
+
+
+# Writable/readable temp file that hashes and type-checks an upload as it arrives
+class HashingUpload:
+    def __init__(self, directory, chunk_size):
+        fd, self.temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix='.part')
+        self._file = os.fdopen(fd, 'w+b', buffering=chunk_size)
+        self._sha256 = hashlib.sha256()
+        self._head = b''
+        self.size = 0
+        self.kind = None       # 'png' / 'jpg' / 'gif' once the magic bytes have been seen
+        self.rejected = False  # Not an image - the rest of the body is thrown away
+        self.stored = False
+
+    def write(self, data):
+        if self.rejected:
+            return len(data)
+
+        if len(self._head) < SNIFF_BYTES:
+            self._head += data[:SNIFF_BYTES - len(self._head)]
+            if len(self._head) == SNIFF_BYTES:
+                self.kind = sniff_image_type(self._head)
+                if self.kind is None:
+                    self.rejected = True
+                    self._discard()
+                    return len(data)
+
+        self._sha256.update(data)
+        self._file.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    # File API that Werkzeug's FileStorage expects
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def seek(self, offset, whence=0):
+        if self._file.closed:
+            return 0
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self):
+        self._file.flush()
+
+    def _discard(self):
+        self._file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    # Called by Werkzeug when the request ends - removes the temp file unless store() moved it
+    def close(self):
+        if not self.stored:
+            self._discard()
+
+    # Move the upload into `directory` as <sha256>.<ext>. Returns (filename, is_duplicate).
+    def store(self, directory):
+        if self.rejected or self.kind is None:
+            self._discard()
+            raise InvalidImage("The uploaded file is not a PNG, JPEG or GIF image.")
+
+        self._file.close()
+        filename = f'{self.hexdigest()}.{self.kind}'
+        destination = os.path.join(directory, filename)
+        self.stored = True
+        try:
+            os.utime(destination)  # Restarts the collector's grace period before the new row points at it
+        except FileNotFoundError:
+            pass  # Not there, or the collector has just deleted it - move ours into place
+        else:
+            os.remove(self.temp_path)  # Same bytes already on disk - share that file
+            return filename, True
+        os.replace(self.temp_path, destination)
+        return filename, False
+
+
+# Request class that streams uploaded files through HashingUpload instead of buffering them
+class StreamingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingUpload(upload_directory(current_app), current_app.config['UPLOAD_CHUNK_SIZE'])
+
+
+def upload_directory(app):
+    return os.path.join(app.static_folder, app.config['UPLOAD_FOLDER'])
+
+
+# Store an uploaded FileStorage under UPLOAD_FOLDER. Returns (image_path relative to static, is_duplicate).
+def save_upload(file_storage):
+    stream = file_storage.stream
+    if not isinstance(stream, HashingUpload):
+        raise InvalidImage("Upload was not streamed to disk.")
+
+    filename, duplicate = stream.store(upload_directory(current_app))
+    if duplicate:
+        logging.info(f"Upload '{file_storage.filename}' matches existing file {filename}")
+    return f"{current_app.config['UPLOAD_FOLDER']}/{filename}", duplicate
+
+
+# Background removal of upload files nothing points at any more: the originals and variants of
+# rejected artworks, variants of failed thumbnail runs, and temp files of interrupted uploads.
+#
+# Every UPLOAD_GC_INTERVAL seconds (and soon after a rejection) it reads the set of files the
+# Artworks table refers to, then walks the upload folder deleting the rest UPLOAD_GC_BATCH at a
+# time. Files younger than UPLOAD_GC_GRACE are never touched: an upload is written before its
+# row is committed, and variants before they are recorded. A duplicate upload refreshes the
+# file's mtime (see HashingUpload.store) for the same reason.
+class UploadCollector:
+    def __init__(self, app):
+        self.app = app
+        self.directory = upload_directory(app)
+        self.interval = app.config['UPLOAD_GC_INTERVAL']
+        self.grace = app.config['UPLOAD_GC_GRACE']
+        self.batch_size = app.config['UPLOAD_GC_BATCH']
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.runs = 0
+        self.removed = 0
+        self.freed_bytes = 0
+
+    def start(self):
+        if self._thread is not None or not self.interval:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='upload-collector', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    # Run a collection soon instead of at the next interval
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            if self._stop.is_set():
+                return
+            self._stop.wait(1)  # Let a burst of rejections finish first
+            self._wake.clear()
+            try:
+                self.collect()
+            except Exception:
+                logging.exception("Upload collection failed; will retry")
+
+    # Paths (relative to static/) of every file an artwork refers to
+    def referenced(self):
+        paths = set()
+        with self.app.app_context():
+            for image_path, variants in db.get_db().execute(
+                    'SELECT image_path, image_variants FROM Artworks WHERE image_path IS NOT NULL'):
+                paths.add(image_path)
+                if variants:
+                    for variant in json.loads(variants).values():
+                        paths.add(variant['webp'])
+                        paths.add(variant['fallback'])
+        return paths
+
+    # Delete unreferenced files older than `grace` seconds. Returns (files, bytes) removed -
+    # or that would be, with dry_run.
+    def collect(self, dry_run=False, grace=None):
+        grace = self.grace if grace is None else grace
+        folder = self.app.config['UPLOAD_FOLDER']
+        referenced = self.referenced()
+        cutoff = time.time() - grace
+        files = freed = 0
+        batch = []
+
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                if entry.name.startswith('.') and not entry.name.startswith('.upload-'):
+                    continue  # Not ours (.gitkeep and the like)
+                if f'{folder}/{entry.name}' in referenced:
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime > cutoff:
+                    continue
+                batch.append((entry.path, stat.st_size))
+                if len(batch) >= self.batch_size:
+                    removed, size = self._remove(batch, dry_run, cutoff)
+                    files, freed = files + removed, freed + size
+                    batch = []
+                    self._stop.wait(0.05)  # Spread the deletes out rather than saturate the disk
+        removed, size = self._remove(batch, dry_run, cutoff)
+        files, freed = files + removed, freed + size
+
+        if not dry_run:
+            self.runs += 1
+            self.removed += files
+            self.freed_bytes += freed
+            if files:
+                logging.info(f"Removed {files} orphaned upload files ({freed / 1024 / 1024:.1f} MB)")
+        return files, freed
+
+    # Each file is stat'ed again first: a duplicate upload touches the file it is about to share,
+    # and may have done so since the scan (see HashingUpload.store)
+    def _remove(self, batch, dry_run, cutoff):
+        if dry_run:
+            return len(batch), sum(size for _, size in batch)
+        files = freed = 0
+        for path, size in batch:
+            try:
+                if os.stat(path).st_mtime > cutoff:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue  # Another worker got there first
+            files += 1
+            freed += size
+        return files, freed
+
+    def stats(self):
+        return {'runs': self.runs, 'removed_total': self.removed, 'freed_bytes_total': self.freed_bytes}
+
+
+def _on_rejected(app, **extra):
+    app.extensions['upload_collector'].wake()
+
+
+def init_app(app):
+    app.config.setdefault('UPLOAD_CHUNK_SIZE', 64 * 1024)
+    app.config.setdefault('UPLOAD_GC_INTERVAL', 3600)   # Seconds between orphaned-file collections (0 = never)
+    app.config.setdefault('UPLOAD_GC_GRACE', 3600)      # Files younger than this are always kept
+    app.config.setdefault('UPLOAD_GC_BATCH', 500)       # Files deleted per batch
+    app.request_class = StreamingRequest
+    os.makedirs(upload_directory(app), exist_ok=True)
+
+    collector = UploadCollector(app)
+    app.extensions['upload_collector'] = collector
+    signals.artwork_rejected.connect(_on_rejected, app)
+
+    # Started by the first request, so a pre-fork parent never owns the thread
+    @app.after_request
+    def start_collector(response):
+        collector.start()
+        return response
+
+
+def get_collector():
+    return current_app.extensions['upload_collector']